@@ -1,4 +1,4 @@
-from math import sin, cos, ceil, floor, pi
+from math import floor, pi
 import importlib
 import bpy
 import mathutils
@@ -9,22 +9,44 @@ from contextlib import contextmanager
 from uuid import uuid4
 from bpy.utils import register_module, unregister_module
 from bpy import props as p
+from bpy.app.handlers import persistent
 import json
 import inspect
 from collections import OrderedDict
 import sys
 from functools import partial
 import tempfile
-from pyhull.delaunay import DelaunayTri as Delaunay
-import struct
+import shutil
+import numpy as np
+
+from .lightprobe_core.sh import (SH_BANDS, SH_MAX_BANDS,
+        mapping_to_coeff_matrix, coeff_matrix_to_mapping, resize_coeff_matrix,
+        get_glsl_coefficients, angle_to_ray)
+from .lightprobe_core.lightmap import make_lightmap, bilinear_interpolate
+from .lightprobe_core.geometry import shared_probe_mesh, clear_probe_mesh_cache
+from .lightprobe_core.analysis import (project_probe, project_probe_scalar,
+        project_probe_adaptive, project_cubemap, sample_probe_color)
+from .lightprobe_core.cubemap import (CUBEMAP_FACE_ROTATIONS,
+        equirect_to_cube_faces)
+from .lightprobe_core.tetra import (tetrahedralize,
+        clear_tetrahedralization_cache)
+from .lightprobe_core.formats import (write_lightprobe_json,
+        write_lightprobe_binary)
+from .lightprobe_core.checkpoint import CubeCheckpoint, checkpoint_dir
+from .lightprobe_core.frames import (sequence_frames, signature_digest,
+        vertex_digest, plan_frame_sources, ProgressClock)
+from .lightprobe_core.atlas import (atlas_layout, atlas_uvs,
+        atlas_tile_lightmap, ATLAS_PADDING)
+from .lightprobe_core.workers import (split_jobs, threads_per_worker,
+        blender_worker_command, run_workers, WorkerPool, WORKER_POLL_INTERVAL)
 
 
 
 bl_info = {
     "name": "Lightprobe",
     "description": "Gives ability to add light probes to a cycles render. \
-Light probes sample incoming light at that location and generate 9 \
-coefficients that can be used to quickly simluate that lighting in a real-time \
+Light probes sample incoming light at that location and generate spherical \
+harmonic coefficients (9 by default) that can be used to quickly simluate that lighting in a real-time \
 game engine.",
     "category": "Object",
     "author": "Andrew Moffat",
@@ -34,34 +56,19 @@ game engine.",
 
 
 JSON_FILE_NAME = "lightprobes.json"
-FAILSAFE_OFFSET = 0.00001
 BAKE_SIZE = 32
+ATLAS_IMAGE_NAME = "lightprobe-atlas"
+ATLAS_UV_LAYER = "atlas"
 CUBEMAP_EXTENSION = "cube"
 CUBEMAP_FORMAT = "exr"
 
-CUBEMAP_DIRECTION_LOOKUP = OrderedDict((
-    ("posx", Quaternion((0.5, 0.5, -0.5, -0.5))),
-    ("negx", Quaternion((0.5, 0.5, 0.5, 0.5))),
-    ("posy", Quaternion((0, 0.0, -1.0, 0.0))),
-    ("negy", Quaternion((0.0, 0.0, 0.0, -1.0))),
-    ("posz", Quaternion((0, 0, -0.7071067690849304, -0.70710688829422))),
-    ("negz", Quaternion((-0.70710688829422, -0.7071067690849304, 0, 0.0))),
-))
-
-# http://cseweb.ucsd.edu/~ravir/papers/envmap/envmap.pdf
-spherical_harmonics = {
-    (0, 0): lambda theta, phi: 0.282095,
-    
-    (1, -1): lambda theta, phi: 0.488603 * sin(theta) * sin(phi),
-    (1, 0): lambda theta, phi: 0.488603 * cos(theta),
-    (1, 1): lambda theta, phi: 0.488603 * sin(theta) * cos(phi),
-    
-    (2, -2): lambda theta, phi: 1.092548 * sin(theta) * cos(phi) * sin(theta) * sin(phi),
-    (2, -1): lambda theta, phi: 1.092548 * sin(theta) * sin(phi) * cos(theta),
-    (2, 0): lambda theta, phi: 0.315392 * (3 * cos(theta)**2 - 1),
-    (2, 1): lambda theta, phi: 1.092548 * sin(theta) * cos(phi) * cos(theta),
-    (2, 2): lambda theta, phi: 0.546274 * (((sin(theta) * cos(phi)) ** 2) - ((sin(theta) * sin(phi)) ** 2))
-}
+# the modal cubemap bake steps on every tick of its timer.  a rendered frame
+# blocks for far longer than this, so the next frame starts as soon as blender
+# has handled the events that queued up during the last one
+CUBEMAP_TICK_INTERVAL = 0.001
+
+CUBEMAP_DIRECTION_LOOKUP = OrderedDict((face, Quaternion(rotation))
+        for face, rotation in CUBEMAP_FACE_ROTATIONS.items())
 
 
 
@@ -81,14 +88,23 @@ def get_all_lightprobe_data():
     all_data = {
         "probes": probe_data,
     }
+    probe_keys = []
 
-    scale_by = bpy.context.scene.unit_settings.scale_length
+    scene = bpy.context.scene
+    scale_by = scene.unit_settings.scale_length
+    bands = scene.lightprobe.sh_bands
     
     for probe in all_active_lightprobes():
-        coeffs = get_coeff_prop(probe)
-        if not coeffs:
+        coeffs = get_coeff_array(probe)
+        if coeffs is None:
             continue
 
+        # every probe in the export has the scene's number of bands, even if
+        # it was baked with a different number
+        coeffs = coeff_matrix_to_mapping(resize_coeff_matrix(coeffs, bands))
+
+        probe_keys.append(probe.name)
+
         data = {}
         data["loc"] = [p*scale_by for p in list(probe.location)]
         data["name"] = probe.lightprobe.name or None
@@ -97,44 +113,18 @@ def get_all_lightprobe_data():
         probe_data.append(data)
 
     point_data = [d["loc"] for d in probe_data]
-    tris = Delaunay(point_data)
-    simplices = tris.vertices
+    simplices, neighbors = tetrahedralize(scene.name, probe_keys, point_data)
     all_data["simplices"] = simplices
-
-
-    # since we're using qhull now, and no longer scipy, we must construct our
-    # neighbor structure manually
-    neighbors = []
-    for simp_idx, simp in enumerate(simplices):
-        cur_neighbors = []
-        neighbors.append(cur_neighbors)
-
-        for vert_idx_idx, vert_idx in enumerate(simp):
-
-            # construct a set of vert indices that we want to search the other
-            # simplices for
-            to_match = list(simp)
-            to_match.pop(vert_idx_idx)
-            to_match = set(to_match)
-
-            neighbor = None
-
-            for search_simp_idx, search_simp in enumerate(simplices):
-                # skip the simplex that we're doing a search on
-                if simp_idx == search_simp_idx:
-                    continue
-
-                try_match = set(search_simp)
-                if to_match < try_match:
-                    neighbor = search_simp_idx
-                    break
-
-            cur_neighbors.append(neighbor)
-
     all_data["neighbors"] = neighbors
     return all_data
 
 
+@persistent
+def clear_caches(*args):
+    clear_tetrahedralization_cache()
+    clear_probe_mesh_cache()
+
+
 @contextmanager
 def values(values):
     restore_fns = []
@@ -161,38 +151,175 @@ def values(values):
             
 
 
-def render_cubemap(ctx, h, ob, size, progress_update=None):
+def plan_static_frames(scene, probe, frames, radius):
+    """ steps through the frames of a cubemap sequence, and returns the frame
+    that each one can take its faces from (see plan_frame_sources) """
+    old_frame = scene.frame_current
+    try:
+        signatures = []
+        for frame in frames:
+            scene.frame_set(frame)
+            signatures.append(frame_signature(scene, probe, radius))
+    finally:
+        scene.frame_set(old_frame)
+
+    return plan_frame_sources(frames, signatures)
+
+
+def probe_transforms(scene, probe, frames):
+    """ steps through the frames of a cubemap sequence, and returns the world
+    matrix of the probe in each one, as nested lists """
+    old_frame = scene.frame_current
+    try:
+        transforms = []
+        for frame in frames:
+            scene.frame_set(frame)
+            transforms.append([list(row) for row in probe.matrix_world])
+    finally:
+        scene.frame_set(old_frame)
+
+    return transforms
+
+
+def deformed_vertices(scene, ob):
+    """ returns a digest of the evaluated vertex positions of a mesh that is
+    deformed by modifiers or shape keys, or None for anything else.  its bounds
+    don't change when it only moves inside of them """
+    if ob.type != "MESH" or not (ob.modifiers or ob.data.shape_keys):
+        return None
+
+    mesh = ob.to_mesh(scene, True, "RENDER")
+    try:
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        return vertex_digest(co)
+    finally:
+        bpy.data.meshes.remove(mesh)
+
+
+def frame_signature(scene, probe, radius):
+    """ returns a digest of everything in the current frame that a cubemap
+    rendered from probe could see change: the transforms, bounds, deformed
+    vertices and materials of the objects within radius of the probe, every
+    lamp, and the world.  a radius of 0 includes every object """
+    center = probe.matrix_world.translation
+
+    def flatten(values):
+        return [tuple(v) for v in values]
+
+    def node_values(node_tree):
+        values = []
+        if node_tree:
+            for node in node_tree.nodes:
+                for socket in node.inputs:
+                    value = getattr(socket, "default_value", None)
+                    if hasattr(value, "__len__"):
+                        value = tuple(value)
+                    values.append((node.name, socket.identifier, value))
+        return values
+
+    def in_range(ob):
+        if not radius:
+            return True
+        corners = [ob.matrix_world * Vector(corner) for corner in ob.bound_box]
+        nearest = Vector([min(max(center[axis], min(c[axis] for c in corners)),
+            max(c[axis] for c in corners)) for axis in range(3)])
+        return (nearest - center).length <= radius
+
+    values = [flatten(probe.matrix_world)]
+
+    for ob in sorted(scene.objects, key=lambda ob: ob.name):
+        if ob == probe:
+            continue
+        is_lamp = ob.type == "LAMP"
+        if not is_lamp and not in_range(ob):
+            continue
+
+        if ob.hide_render:
+            values.append((ob.name, "hidden"))
+            continue
+
+        values.append((ob.name, flatten(ob.matrix_world), flatten(ob.bound_box),
+            deformed_vertices(scene, ob)))
+
+        if is_lamp:
+            values.append((tuple(ob.data.color), ob.data.energy,
+                node_values(ob.data.node_tree)))
+
+        for slot in ob.material_slots:
+            mat = slot.material
+            if mat:
+                values.append((mat.name, tuple(mat.diffuse_color),
+                    node_values(mat.node_tree)))
+
+    world = scene.world
+    if world:
+        values.append((tuple(world.horizon_color),
+            node_values(world.node_tree)))
+
+    return signature_digest(values)
+
+
+@contextmanager
+def cubemap_visibility(scene, probe):
+    """ hides what a cubemap probe shouldn't see while it renders: itself, or
+    everything but the sky if it is sky only """
+    restores = {
+        probe: hide_object(probe),
+    }
+    if probe.cubemap.sky_only:
+        restores = hide_all(scene)
+    restores[probe]()
+
+    try:
+        yield
+    finally:
+        for restore in restores.values():
+            restore()
+
+
+def render_cubemap(ctx, out_dir, ob, size, progress_update=None):
+    """ renders the six faces of a cubemap probe's current frame into out_dir,
+    the way its settings ask for """
+    if ob.cubemap.panoramic:
+        return render_cubemap_faces_panoramic(ctx, ob, size, out_dir,
+                progress_update)
+    return render_cubemap_faces(ctx, ob, size, out_dir, progress_update)
+
+
+@contextmanager
+def temp_camera(ctx, ob):
     scene = ctx.scene
 
+    bpy.ops.object.camera_add()
+    cam = ctx.active_object
+    
+    cam.location = ob.location
 
-    @contextmanager
-    def temp_camera():
-        bpy.ops.object.camera_add()
-        cam = ctx.active_object
-        
-        cam.data.lens_unit = "FOV"
-        cam.data.angle = pi/2
-        cam.location = ob.location
-        cam.rotation_mode = "QUATERNION"
+    try:
+        with no_interfere_ctx():
+            yield cam
+    finally:
+        scene.objects.unlink(cam)
 
-        try:
-            with no_interfere_ctx():
-                yield cam
-        finally:
-            scene.objects.unlink(cam)
 
+def render_cubemap_faces(ctx, ob, size, out_dir, progress_update=None):
+    """ renders the six faces of a cubemap from the location of ob into out_dir,
+    returning the paths of the rendered exr files, in CUBEMAP_FACES order """
+    scene = ctx.scene
 
     filepaths = []
-    name = ob.cubemap.name
 
     def render(direction):
 
-        with temp_camera() as cam:
+        with temp_camera(ctx, ob) as cam:
+            cam.data.lens_unit = "FOV"
+            cam.data.angle = pi/2
+            cam.rotation_mode = "QUATERNION"
             cam.scale.x *= -1
             cam.rotation_quaternion = CUBEMAP_DIRECTION_LOOKUP[direction]
 
-            filename = name + "-" + direction + ".exr"
-            filepath = join(tempfile.gettempdir(), filename)
+            filepath = join(out_dir, direction + ".exr")
 
             with values({scene.render: {"resolution_x": size, "resolution_y": size,
                     "filepath": filepath}, scene: {"camera": cam},
@@ -210,14 +337,69 @@ def render_cubemap(ctx, h, ob, size, progress_update=None):
         filepaths.append(filepath)
         
     bpy.ops.object.delete()
+    return filepaths
+
+
+def render_panorama(ctx, ob, size, out_dir):
+    """ renders an equirectangular panorama from the location of ob, in a single
+    render, and returns it as a Lightmap.  it is 4*size wide and 2*size high,
+    which is about as detailed as cube faces of size """
+    scene = ctx.scene
+    filepath = join(out_dir, "pano.exr")
+
+    with temp_camera(ctx, ob) as cam:
+        cam.data.type = "PANO"
+        cam.data.cycles.panorama_type = "EQUIRECTANGULAR"
+
+        # pointing down +x, with +z up, lines the panorama up with world
+        # directions, the same way as an environment texture
+        cam.rotation_mode = "XYZ"
+        cam.rotation_euler = Euler((pi/2, 0, -pi/2))
+
+        with values({scene.render: {"resolution_x": 4 * size,
+                "resolution_y": 2 * size, "filepath": filepath},
+                scene: {"camera": cam},
+                scene.render.image_settings: {"file_format": "OPEN_EXR"},
+                ob: {"hide": True}}):
+            bpy.ops.render.render(animation=False, write_still=True)
+
+    image = bpy.data.images.load(filepath)
+    try:
+        return read_lightmap(image)
+    finally:
+        bpy.data.images.remove(image)
+        os.remove(filepath)
+
+
+def render_cubemap_faces_panoramic(ctx, ob, size, out_dir,
+        progress_update=None):
+    """ like render_cubemap_faces, but renders a single panorama and resamples
+    it into the six faces, so cycles only prepares the scene once """
+    pano = render_panorama(ctx, ob, size, out_dir)
+
+    filepaths = []
+    for direction, face in zip(CUBEMAP_DIRECTION_LOOKUP.keys(),
+            equirect_to_cube_faces(pano, size)):
+        if progress_update:
+            progress_update()
+        filepath = join(out_dir, direction + ".exr")
+        save_exr(filepath, face)
+        filepaths.append(filepath)
+
+    return filepaths
+
 
-    # concatenate all of our directions together into a single env file
-    # containing all 6 cube faces
-    for filepath in filepaths:
-        with open(filepath, "rb") as j:
-            face = j.read()
-            h.write(struct.pack("<I", len(face)))
-            h.write(face)
+def save_exr(filepath, lightmap):
+    """ writes a Lightmap out to an exr file """
+    image = bpy.data.images.new(os.path.basename(filepath), lightmap.width,
+            lightmap.height, alpha=lightmap.channels == 4, float_buffer=True)
+    try:
+        image.pixels = lightmap.pixels
+        image.filepath_raw = filepath
+        image.file_format = "OPEN_EXR"
+        image.save()
+    finally:
+        bpy.data.images.remove(image)
         
 
 def get_or_create_probe_file():
@@ -233,8 +415,19 @@ def write_lightprobe_data(data):
     f.clear()        
     data = json.dumps(data, indent=4, sort_keys=True)
     f.write(data)
-    
-    
+
+
+def export_lightprobe_data(settings, data):
+    """ writes the data from get_all_lightprobe_data everywhere our scene
+    settings ask for it """
+    if settings.keep_text_block:
+        write_lightprobe_data(data)
+    if settings.export_path:
+        write_lightprobe_json(bpy.path.abspath(settings.export_path), data)
+    if settings.binary_path:
+        write_lightprobe_binary(bpy.path.abspath(settings.binary_path), data)
+
+
 def fetch_integration_callback(name):
     parts = name.split(".")
     fn_name = parts[-1]
@@ -277,26 +470,38 @@ def hide_object(ob):
         
 def set_coeff_prop(ob, coeffs):
     """ sets our SH coeffs onto an object datablock.  we can't use the python
-    dictionary that we've generated, so we'll flatten it to something that
-    can be stored in a datablock """
-        
-    ob["lightprobe_coeffs"] = json.dumps(coeffs)
+    dictionary that we've generated, so we'll flatten it to a fixed-order float
+    array (sh_coeff_order, then rgb), which can be stored in a datablock """
+    matrix = mapping_to_coeff_matrix(coeffs)
+    ob["lightprobe_coeffs"] = [float(c) for c in matrix.ravel()]
+
+
+def get_coeff_array(ob):
+    """ retrieve our SH coeffs from our object datablock as a coefficient
+    matrix, without building the mapping.  returns None for unbaked probes """
+    coeffs = ob.get("lightprobe_coeffs", None)
+    if coeffs is None:
+        return None
+
+    # probes baked by older versions have their coeffs stored as json
+    if isinstance(coeffs, str):
+        if not coeffs:
+            return None
+        return mapping_to_coeff_matrix(json.loads(coeffs))
+
+    return np.array(coeffs.to_list(), dtype=float).reshape(-1, 3)
     
     
 def get_coeff_prop(ob):
     """ retrieve our SH coeffs from our object datablock.  this is essentially
     unserializing it to our original data """
-    
-    coeffs = ob.get("lightprobe_coeffs", None)
-    if not coeffs:
+    coeffs = get_coeff_array(ob)
+    if coeffs is None:
         return None
-        
-    data = json.loads(coeffs)
-    return data
+    return coeff_matrix_to_mapping(coeffs)
     
     
 
-
 def setup_lightprobe_material(ob):
     scene = bpy.context.scene
     
@@ -399,6 +604,13 @@ def get_lightmap(ob):
     return bpy.data.images[ob.name]
 
 
+def read_lightmap(image):
+    """ copies the pixels of a blender image into a flat float buffer.  reading
+    image.pixels copies the whole image each time, so we do it once per probe
+    and take all of our samples from the buffer """
+    width, height = image.size
+    return make_lightmap(width, height, image.channels, image.pixels[:])
+
 def add_lightprobe():
     with no_interfere_ctx():
         bpy.ops.mesh.primitive_cube_add()
@@ -454,8 +666,15 @@ def add_cubemap_probe():
 
 
 def bake(ob):
-    with active_and_selected(ob):
+    bake_objects([ob])
+
+
+def bake_objects(obs):
+    """ bakes every object in obs in a single cycles bake, into the active image
+    of their materials """
+    with selected(obs):
         scene = bpy.context.scene
+        scene.objects.active = obs[0]
 
         cycles = scene.cycles
         old_samples = cycles.samples
@@ -466,237 +685,289 @@ def bake(ob):
         cycles.samples = old_samples
 
 
+def get_lightmap_node(ob):
+    """ returns the image node of the probe's material that its lightmap is
+    baked into """
+    image = get_lightmap(ob)
+    for slot in ob.material_slots:
+        mat = slot.material
+        if mat and mat.node_tree:
+            for node in mat.node_tree.nodes:
+                if node.type == "TEX_IMAGE" and node.image == image:
+                    return node
+    return None
+
+
+def set_atlas_uvs(ob, atlas, tile):
+    """ fills the probe's atlas uv layer with its lightmap uvs, moved into its
+    tile of the atlas """
+    mesh = ob.data
+    if ATLAS_UV_LAYER not in mesh.uv_textures:
+        mesh.uv_textures.new(ATLAS_UV_LAYER)
+
+    lightmap_uvs = mesh.uv_layers["lightmap"].data
+    uvs = np.empty(len(lightmap_uvs) * 2, dtype=np.float32)
+    lightmap_uvs.foreach_get("uv", uvs)
+
+    uvs = atlas_uvs(uvs, atlas, tile).astype(np.float32)
+    mesh.uv_layers[ATLAS_UV_LAYER].data.foreach_set("uv", uvs.ravel())
+
+
+def bake_atlas(probes, atlas):
+    """ bakes all of the probes at once, each into its own tile of a shared
+    atlas image, and returns the atlas as a Lightmap.  while baking, the probes'
+    materials bake into the atlas instead of their own lightmaps, through their
+    atlas uv layers """
+    # a wider margin would bleed into the neighboring tiles.  cycles bakes with
+    # render.bake.margin, render.bake_margin is blender internal's
+    bake_settings = bpy.context.scene.render.bake
+    swaps = OrderedDict()
+    swaps[bake_settings] = {"margin": min(bake_settings.margin, ATLAS_PADDING)}
+
+    lightmap_nodes = []
+    for probe in probes:
+        node = get_lightmap_node(probe)
+        if node is None:
+            raise ValueError("%s has no lightmap image node in its material "
+                    "to bake into" % probe.name)
+        lightmap_nodes.append(node)
+
+    image = bpy.data.images.new(ATLAS_IMAGE_NAME, atlas.width, atlas.height,
+            alpha=False, float_buffer=True)
+
+    try:
+        # the lightmap layer has to be re-activated on restore, so it goes
+        # before the atlas layer
+        for probe, tile, node in zip(probes, atlas.tiles, lightmap_nodes):
+            set_atlas_uvs(probe, atlas, tile)
+
+            uv_textures = probe.data.uv_textures
+            swaps[node] = {"image": image}
+            swaps[uv_textures["lightmap"]] = {"active": True,
+                    "active_render": True}
+            swaps[uv_textures[ATLAS_UV_LAYER]] = {"active": True,
+                    "active_render": True}
+
+        with values(swaps):
+            bake_objects(probes)
+
+        return read_lightmap(image)
+
+    finally:
+        bpy.data.images.remove(image)
+
+
 
 def get_lightprobe_coefficients(probe, theta_res, phi_res):
+    """ bakes and analyses probe, returning its coefficients and whether they
+    converged (see get_all_coefficients) """
+    settings = bpy.context.scene.lightprobe
+    if settings.bake_mode == "CUBEMAP":
+        return get_lightprobe_coefficients_cubemap(probe,
+                settings.cubemap_bake_size), True
+
     probe.data.calc_tessface()
     bake(probe)
-    lightmap = get_lightmap(probe)
+    lightmap = read_lightmap(get_lightmap(probe))
     return get_all_coefficients(probe, lightmap, theta_res, phi_res)
 
 
+def get_lightprobe_coefficients_cubemap(probe, size):
+    """ renders a small cubemap from the center of the probe and projects it
+    straight onto the SH basis, without baking or analysing the probe mesh """
+    ctx = bpy.context
+    scene = ctx.scene
 
+    out_dir = tempfile.mkdtemp(prefix="lightprobe-bake-")
+    try:
+        with values({scene.cycles: {"samples": scene.lightprobe.samples}}):
+            if scene.lightprobe.panoramic_bake:
+                pano = render_panorama(ctx, probe, size, out_dir)
+                faces = equirect_to_cube_faces(pano, size)
+            else:
+                faces = []
+                for filepath in render_cubemap_faces(ctx, probe, size,
+                        out_dir):
+                    image = bpy.data.images.load(filepath)
+                    try:
+                        faces.append(read_lightmap(image))
+                    finally:
+                        bpy.data.images.remove(image)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return coeff_matrix_to_mapping(project_cubemap(faces,
+        scene.lightprobe.sh_bands))
+
+
+def get_lightprobe_coefficients_atlas(probes, theta_res, phi_res):
+    """ bakes the probes together through shared atlases, paying for the cycles
+    scene setup once per atlas instead of once per probe, and yields each
+    (probe, coeffs, converged) as they are analysed """
+    # we go over the probes more than once
+    probes = list(probes)
+
+    if bpy.context.scene.lightprobe.bake_mode == "CUBEMAP":
+        for probe in probes:
+            yield (probe,) + get_lightprobe_coefficients(probe, theta_res,
+                    phi_res)
+        return
+
+    # probes sharing a mesh would share its atlas uvs, and bake into the same
+    # tile, so those get baked on their own
+    mesh_users = {}
+    for probe in probes:
+        mesh_users.setdefault(probe.data.name, []).append(probe)
+
+    atlas_probes = []
+    for probe in probes:
+        if len(mesh_users[probe.data.name]) > 1:
+            yield (probe,) + get_lightprobe_coefficients(probe, theta_res,
+                    phi_res)
+        else:
+            atlas_probes.append(probe)
 
-def sample_image(channels, width, height, pixel_data, loc):
-    """ samples a blender location at a particular xy integer location """    
-    x, y = loc[0], loc[1]
-    
-    pix_loc = int((y * width * channels) + x * channels)
-    r = pixel_data[pix_loc + 0]
-    g = pixel_data[pix_loc + 1]
-    b = pixel_data[pix_loc + 2]
-     
-    return mathutils.Color((r, g, b))
-    
-    
+    for atlas in atlas_layout(len(atlas_probes), BAKE_SIZE):
+        batch = atlas_probes[:len(atlas.tiles)]
+        atlas_probes = atlas_probes[len(atlas.tiles):]
 
-def bilinear_interpolate(image, uv):
-    """ performs bilinear interpolation of a blender image using texture-space
-    uv coordinates.  the boundary conditions are to extend the edges """
-    
-    lightmap_size = mathutils.Vector(image.size)
-    width, height = lightmap_size[0], lightmap_size[1]
-    
-    px_x, px_y = 1.0/width, 1.0/height
-    half_px_x, half_px_y = 1.0/(2*width), 1.0/(2*height)
-    
-    left_coord = ceil(width * (uv[0] - half_px_x) - 1)
-    right_coord = ceil(width * (uv[0] + half_px_x) - 1)
-    bottom_coord = ceil(height * (uv[1] - half_px_y) - 1)
-    top_coord = ceil(height * (uv[1] + half_px_y) - 1)
-    
-    
-    # these are asking how much of 1-pixel (in uv space) has our uv coordinate
-    # traversed, starting at the left/bottom pixel boundary
-    lerp_x = (uv[0] - (left_coord + 0.5) / width) / px_x
-    lerp_y = (uv[1] - (bottom_coord + 0.5) / height) / px_y
-    
-    
-    # boundary conditions
-    if right_coord + 1 > width:
-        right_coord = left_coord
-    
-    if left_coord < 0:
-        left_coord = right_coord
-        
-    if top_coord + 1 > height:
-        top_coord = bottom_coord
-        
-    if bottom_coord < 0:
-        bottom_coord = top_coord
-        
-    
-    ll_uv = mathutils.Vector((left_coord, bottom_coord))
-    lr_uv = mathutils.Vector((right_coord, bottom_coord))
-    ur_uv = mathutils.Vector((right_coord, top_coord))
-    ul_uv = mathutils.Vector((left_coord, top_coord))
-    
-    pixel_data = image.pixels[:]
-    chan = image.channels
-    width, height = image.size
-    
-    lower_left = mathutils.Vector(sample_image(chan, width, height, pixel_data, ll_uv))
-    lower_right = mathutils.Vector(sample_image(chan, width, height, pixel_data, lr_uv))
-    upper_right = mathutils.Vector(sample_image(chan, width, height, pixel_data, ur_uv))
-    upper_left = mathutils.Vector(sample_image(chan, width, height, pixel_data, ul_uv))
-    
-    del pixel_data
-    
-    top = upper_left.lerp(upper_right, lerp_x)
-    bottom = lower_left.lerp(lower_right, lerp_x)
-    color = mathutils.Color(bottom.lerp(top, lerp_y))
-    
-    return color
+        lightmap = bake_atlas(batch, atlas)
+        for probe, tile in zip(batch, atlas.tiles):
+            probe.data.calc_tessface()
+            tile_lightmap = atlas_tile_lightmap(lightmap, tile)
+            yield (probe,) + get_all_coefficients(probe, tile_lightmap,
+                    theta_res, phi_res)
 
 
 
 
-# http://en.wikipedia.org/wiki/M%C3%B6ller%E2%80%93Trumbore_intersection_algorithm
-def triangle_intersection(v1, v2, v3, ray, origin):
-    """ performs moller-trumbore ray-triangle intersection and returns
-    barycentric coordinates if an intersection exists, None otherwise """
-    
-    epsilon = 0.000001
-    edge1 = v2 - v1
-    edge2 = v3 - v1
-    
-    P = ray.cross(edge2)
-    det = edge1.dot(P)
-    
-    if det > -epsilon and det < epsilon:
-        return None
-    
-    inv_det = 1.0 / det
-    T = origin - v1
-    
-    u = T.dot(P) * inv_det
-    
-    if u < 0 or u > 1:
-        return None
-    
-    Q = T.cross(edge1)
-    v = ray.dot(Q) * inv_det
-    
-    if v < 0 or u + v > 1:
-        return None
-    
-    t = edge2.dot(Q) * inv_det
-    
-    if t > epsilon:
-        w = 1 - u - v
-        return mathutils.Vector((u, v, w))
-    
-    return None
+def worker_command(work_dir, num_workers):
+    """ saves a copy of the scene into work_dir for background workers to load,
+    and returns the function that makes their command lines """
+    blend_path = join(work_dir, "scene.blend")
+    bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True)
 
+    script = join(os.path.dirname(os.path.abspath(__file__)), "bake_worker.py")
+    threads = threads_per_worker(num_workers)
 
+    def make_command(job_path):
+        return blender_worker_command(bpy.app.binary_path, blend_path, script,
+                job_path, threads)
+    return make_command
 
 
+def bake_in_workers(context, probes, num_workers):
+    """ bakes probes across num_workers background blender processes, each
+    working on a saved copy of the scene, and sets the coefficients they send
+    back onto our probes.  returns a mapping of probe name to error message for
+    the probes that failed, and the names of the probes whose coefficients
+    didn't converge """
+    wm = context.window_manager
+    work_dir = tempfile.mkdtemp(prefix="lightprobe-bake-")
 
-    
+    try:
+        make_command = worker_command(work_dir, num_workers)
+        jobs = split_jobs([probe.name for probe in probes], num_workers)
+
+        wm.progress_begin(0, len(probes))
+        try:
+            coeffs, errors = run_workers(jobs, work_dir, make_command,
+                    wm.progress_update, task={"kind": "lightprobes"})
+        finally:
+            wm.progress_end()
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    unconverged = []
+    for probe in probes:
+        result = coeffs.get(probe.name, None)
+        if result is not None:
+            matrix = np.array(result["coeffs"], dtype=float).reshape(-1, 3)
+            set_coeff_prop(probe, coeff_matrix_to_mapping(matrix))
+            if not result["converged"]:
+                unconverged.append(probe.name)
+
+    return errors, unconverged
+
+
+def get_probe_mesh(mesh):
+    """ reads a probe mesh's tessfaces into the core ProbeMesh shared by every
+    probe with the same geometry """
+    num_faces = len(mesh.tessfaces)
+
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+
+    faces = np.empty(num_faces * 4, dtype=np.int32)
+    mesh.tessfaces.foreach_get("vertices_raw", faces)
+
+    uvs = np.empty(num_faces * 8, dtype=np.float32)
+    mesh.tessface_uv_textures[0].data.foreach_get("uv_raw", uvs)
+
+    # our probes are triangulated, so we only need the first 3 corners
+    return shared_probe_mesh(co.reshape(-1, 3), faces.reshape(-1, 4)[:, :3],
+            uvs.reshape(-1, 4, 2)[:, :3])
 
-def get_glsl_coefficients(coeffs):
-    """ a convenience function for testing SH coefficients in the shader
-    provided by the opengl orange book, second edition """
-    
-    tmpl = "const vec3 L%d%s%d = vec3(%f, %f, %f);"
-    lines = []
-    
-    for l, mdata in coeffs.items():
-        for m, color in mdata.items():
-            
-            sign = ""
-            if m < 0:
-                sign = "m"
-                
-            line = tmpl % (l, sign, abs(m), color[0], color[1], color[2])
-            lines.append(line)
-        
-    return "\n".join(lines)
-    
 
 def get_all_coefficients(ob, lightmap, theta_res, phi_res):
     """ returns all SH coefficients.  theta_res and phi_res are the
     sampling resolutions for theta (zenith) and phi (azimuth) respectively.
-    theta ranges from 0-pi, while phi ranges from 0-2pi """
-    mapping = {}
-    for l, m in spherical_harmonics.keys():
-        color = get_coefficients(ob, lightmap, l, m, theta_res, phi_res)
-        mapping.setdefault(l, {})[m] = color
-    return mapping
+    theta ranges from 0-pi, while phi ranges from 0-2pi.  with adaptive
+    sampling on, they are ignored, and the lightmap is sampled until the
+    coefficients converge to the scene's sh_tolerance instead.  returns the
+    coefficients and whether they converged, which they always have without
+    adaptive sampling """
+    settings = bpy.context.scene.lightprobe
+    probe_mesh = get_probe_mesh(ob.data)
+
+    if settings.adaptive_sampling:
+        coeffs, _, converged = project_probe_adaptive(probe_mesh, lightmap,
+                settings.sh_tolerance, settings.sh_bands)
+    else:
+        coeffs = project_probe(probe_mesh, lightmap, theta_res, phi_res,
+                settings.sh_bands)
+        converged = True
+    return coeff_matrix_to_mapping(coeffs), converged
+
+
+def get_all_coefficients_scalar(ob, lightmap, theta_res, phi_res):
+    """ the scalar reference version of get_all_coefficients """
+    return project_probe_scalar(get_probe_mesh(ob.data), lightmap, theta_res,
+            phi_res)
 
 
 def get_coefficients(ob, lightmap, l, m, theta_res, phi_res):
     """ returns the RGB spherical harmonic coefficients for a given
     l and m """
-    c = mathutils.Color((0, 0, 0))
-    harmonic = spherical_harmonics[(l, m)]
-    
-    for theta in (pi * y / float(theta_res) for y in range(theta_res)):
-        for phi in (pi * 2 * x / float(phi_res) for x in range(phi_res)):
-            color = sample_icosphere_color(ob, lightmap, theta, phi)
-            c += (color * harmonic(theta, phi) * sin(theta)
-                / (theta_res * phi_res))
+    mapping = project_probe_scalar(get_probe_mesh(ob.data), lightmap,
+            theta_res, phi_res, keys=[(l, m)])
+    return mapping[l][m]
             
-    return c.r, c.g, c.b
-            
-def sample_icosphere_color(ob, lightmap, theta, phi):
+
+def sample_icosphere_color(ob, lightmap, theta, phi, probe_mesh=None):
     """ takes a theta and phi and casts a ray out from the center of an
     icosphere, bilinearly sampling the surface where the ray intersects """
+    if probe_mesh is None:
+        probe_mesh = get_probe_mesh(ob.data)
     ray = angle_to_ray(theta, phi)
-    
-    # we extend the ray arbitrarily so it's guaranteed to intersect with the
-    # icosphere, instead of falling short
-    ray *= 100
-    
-    face, location = find_intersecting_face(ob, ray)
-    
-    # it is possible that we couldn't find an intersecting face if the ray
-    # we shot aligns perfectly with a vertex.  in this case, we'll offset the
-    # ray slightly and try again.  this should not fail a second time.
-    if face is None:
-        ray.x += FAILSAFE_OFFSET
-        ray.y += FAILSAFE_OFFSET
-        ray.z += FAILSAFE_OFFSET
-        
-        face, location = find_intersecting_face(ob, ray)
-        assert(face is not None)
-    
-    color = sample_lightmap(ob, lightmap, face, location)
-    return color
-
-    
-def angle_to_ray(theta, phi):
-    """ converts a spherical coordinate to cartesian coordinate """
-    x = sin(theta) * cos(phi)
-    y = sin(theta) * sin(phi)
-    z = cos(theta)
-    ray = mathutils.Vector((x, y, z)).normalized()
-    return ray
+    return mathutils.Color(sample_probe_color(probe_mesh, lightmap, ray))
 
 
-def find_intersecting_face(ob, ray):
+def find_intersecting_face(ob, ray, probe_mesh=None):
     """ finds the face where a ray from the center of an icosphere
     intersects """
-    mesh = ob.data
-    origin = mathutils.Vector()
+    if probe_mesh is None:
+        probe_mesh = get_probe_mesh(ob.data)
     
-    # we'll use scale to ensure that our transform applies to our vertices.
-    # assume scale is uniform and just use x scale
-    scale = ob.scale[0]
+    face_index, intersection = probe_mesh.index.intersect(ray)
+    if face_index is None:
+        # we should never get here, but we may in the case of a ray aligning
+        # perfectly with a vertex.  in this case, we'll catch this error up at
+        # the caller
+        return None, None
     
-    for face in mesh.tessfaces:
-        v = face.vertices
-        v1 = mesh.vertices[v[0]].co * scale
-        v2 = mesh.vertices[v[1]].co * scale
-        v3 = mesh.vertices[v[2]].co * scale
-        
-        intersection = triangle_intersection(v1, v2, v3, ray, origin)
-        if intersection:
-            return face, intersection
-        
-    # we should never get here, but we may in the case of a ray aligning
-    # perfectly with a vertex.  in this case, we'll catch this error up at
-    # the caller
-    return None, None
+    return ob.data.tessfaces[face_index], mathutils.Vector(intersection)
     
         
 def sample_lightmap(ob, lightmap, face, loc):
@@ -705,7 +976,7 @@ def sample_lightmap(ob, lightmap, face, loc):
     uvs = mesh.tessface_uv_textures[0].data[face.index]
     location_uv = loc[0] * uvs.uv1 + loc[1] * uvs.uv2 + loc[2] * uvs.uv3
     
-    return bilinear_interpolate(lightmap, location_uv)
+    return mathutils.Color(bilinear_interpolate(lightmap, location_uv))
     
     
     
@@ -736,12 +1007,27 @@ class LightProbeConfigPanel(bpy.types.Panel):
         row.prop(scene.lightprobe, "post_bake_hook")
         
         layout.prop(scene.lightprobe, "cubemap_dir")
+        layout.prop(scene.lightprobe, "export_path")
+        layout.prop(scene.lightprobe, "binary_path")
+        layout.prop(scene.lightprobe, "keep_text_block")
         
-        row = layout.row()
-        row.prop(scene.lightprobe, "theta_res")
-        row.prop(scene.lightprobe, "phi_res")
+        layout.prop(scene.lightprobe, "bake_mode")
+        if scene.lightprobe.bake_mode == "CUBEMAP":
+            layout.prop(scene.lightprobe, "cubemap_bake_size")
+            layout.prop(scene.lightprobe, "panoramic_bake")
+
+        layout.prop(scene.lightprobe, "sh_bands")
+        layout.prop(scene.lightprobe, "adaptive_sampling")
+        if scene.lightprobe.adaptive_sampling:
+            layout.prop(scene.lightprobe, "sh_tolerance")
+        else:
+            row = layout.row()
+            row.prop(scene.lightprobe, "theta_res")
+            row.prop(scene.lightprobe, "phi_res")
         
         layout.prop(scene.lightprobe, "samples")
+        layout.prop(scene.lightprobe, "bake_workers")
+        layout.prop(scene.lightprobe, "bake_atlas")
 
         layout.operator(BakeAllOperator.bl_idname)
         layout.operator(ResizeAllOperator.bl_idname)
@@ -766,6 +1052,12 @@ class CubemapProbePanel(bpy.types.Panel):
         layout.prop(c, "name")
         layout.prop(c, "sky_only")
         layout.prop(c, "size")
+        layout.prop(c, "panoramic")
+        layout.prop(c, "resume")
+        layout.prop(c, "render_workers")
+        layout.prop(c, "skip_static")
+        if c.skip_static:
+            layout.prop(c, "influence_radius")
 
         can_set_range = not c.single_frame and not c.whole_range
 
@@ -831,9 +1123,17 @@ class BakeCubemapOperator(bpy.types.Operator):
         ret = {"PASS_THROUGH"}
 
         if event.type == "TIMER":
+            # every running timer sends TIMER events, so only step when it was
+            # ours that fired
+            tick = self._timer.time_duration
+            if tick == self._last_tick:
+                return ret
+            self._last_tick = tick
+
             try:
                 next(self.next_chunk)
             except StopIteration:
+                self.finish(ctx)
                 ret = {"FINISHED"}
 
         elif event.type in {"ESC", "RIGHTMOUSE"}:
@@ -843,8 +1143,17 @@ class BakeCubemapOperator(bpy.types.Operator):
         return ret
 
     def cancel(self, ctx):
+        # closing the generator restores the scene.  the frames finished so far
+        # stay checkpointed, for the next bake to pick up from
+        self.next_chunk.close()
+        self.finish(ctx)
+
+    def finish(self, ctx):
         wm = ctx.window_manager
         wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        if ctx.area:
+            ctx.area.header_text_set()
     
     def execute(self, ctx):
         probe = ctx.object
@@ -875,27 +1184,10 @@ class BakeCubemapOperator(bpy.types.Operator):
 
 
         fps = scene.render.fps
-        target_fps = cube.fps
-        frame_advance = fps / target_fps
-
 
         # figure out all the frames we actually need to render, given our custom
         # fps
-        all_frames = [start]
-
-        cur_frame = start
-        last_frame = None
-        while cur_frame < end:
-            cur_frame = cur_frame + frame_advance
-            if int(cur_frame) == last_frame:
-                continue
-
-            all_frames.append(int(cur_frame))
-            last_frame = int(cur_frame)
-
-
-        awesome = update_gen(len(all_frames))
-        update_fn = lambda: next(awesome)
+        all_frames = sequence_frames(start, end, fps, cube.fps)
 
 
         gamma = 1.0
@@ -903,40 +1195,127 @@ class BakeCubemapOperator(bpy.types.Operator):
         cubemap_out_name = "%s.%s" % (cube.name, CUBEMAP_EXTENSION)
         cubemap_filename = join(cubemap_dir, cubemap_out_name)
 
-        out_handle = open(cubemap_filename, "wb")
-        out_handle.write(struct.pack("<ffI", fps, gamma, len(all_frames)))
+        # everything that changes what the frames look like.  a checkpoint left
+        # by a bake with different settings is thrown away
+        manifest = {
+            "frames": all_frames,
+            "fps": fps,
+            "gamma": gamma,
+            "size": size,
+            "panoramic": cube.panoramic,
+            "sky_only": cube.sky_only,
+            "transforms": probe_transforms(scene, probe, all_frames),
+        }
+        if cube.skip_static:
+            manifest["sources"] = plan_static_frames(scene, probe, all_frames,
+                    cube.influence_radius)
+        checkpoint_path = checkpoint_dir(cubemap_filename)
+        if not cube.resume and exists(checkpoint_path):
+            shutil.rmtree(checkpoint_path)
+        checkpoint = CubeCheckpoint(checkpoint_path, manifest, CUBEMAP_FORMAT)
+        pending_frames = checkpoint.pending_frames()
+
+        awesome = update_gen(max(1, len(pending_frames)))
+        update_fn = lambda: next(awesome)
+
+        clock = ProgressClock(len(pending_frames))
+
+        def report_progress(num_done):
+            clock.update(num_done)
+            status = "Baking %s: %s" % (cube.name, clock.status())
+            if ctx.area:
+                ctx.area.header_text_set(status)
 
         def fn():
-            with no_interfere_ctx():
-                restores = {
-                    probe: hide_object(probe),
+            with no_interfere_ctx(), cubemap_visibility(scene, probe):
+                # for each frame that this cubemap is set to render for, and
+                # that an earlier bake didn't already finish, render all six
+                # sides of the cube map
+                for i, frame in enumerate(pending_frames):
+                    scene.frame_set(frame)
+                    render_cubemap(ctx, checkpoint.begin_frame(frame), probe,
+                            size, update_fn)
+                    checkpoint.finish_frame(frame)
+                    report_progress(i + 1)
+                    yield
+
+            checkpoint.finalize(cubemap_filename)
+
+        def fn_workers(num_workers):
+            # the workers render straight into our checkpoint, so if we're
+            # cancelled, whatever frames they finished are kept
+            wm = ctx.window_manager
+            wm.progress_begin(0, len(pending_frames))
+
+            work_dir = tempfile.mkdtemp(prefix="lightprobe-cubemap-")
+            try:
+                make_command = worker_command(work_dir, num_workers)
+                task = {
+                    "kind": "cubemap",
+                    "probe": probe.name,
+                    "checkpoint": checkpoint_path,
+                    "manifest": checkpoint.manifest,
                 }
-                if cube.sky_only:
-                    restores = hide_all(scene)
-                restores[probe]()
+                pool = WorkerPool(split_jobs(pending_frames, num_workers),
+                        work_dir, make_command, task)
 
-                # for each frame that this cubemap is set to render for, render all
-                # six sides of the cube map
                 try:
-                    for frame in all_frames:
-                        scene.frame_set(frame)
-                        render_cubemap(ctx, out_handle, probe, size, update_fn)
+                    last_done = None
+                    while True:
+                        num_done, running = pool.poll()
+                        if num_done != last_done:
+                            wm.progress_update(num_done)
+                            report_progress(num_done)
+                            last_done = num_done
+                        if not running:
+                            break
                         yield
-
                 finally:
-                    for restore in restores.values():
-                        restore()
+                    pool.kill()
+
+                _, errors = pool.collect()
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+            if errors:
+                for frame, message in sorted(errors.items()):
+                    print("failed to render frame %s: %s" % (frame, message))
+                self.report({"ERROR"}, "%d frames failed to render, see the "
+                        "console for details.  Baking again will resume from "
+                        "the frames that finished" % len(errors))
+                return
 
+            checkpoint.finalize(cubemap_filename)
 
-        self.next_chunk = fn()
+
+        num_workers = min(cube.render_workers, len(pending_frames))
+        if num_workers > 1:
+            # rendering happens in the workers, so we only need to check on
+            # them now and then
+            self.next_chunk = fn_workers(num_workers)
+            interval = WORKER_POLL_INTERVAL
+        else:
+            self.next_chunk = fn()
+            interval = CUBEMAP_TICK_INTERVAL
                     
         wm = ctx.window_manager
-        self._timer = wm.event_timer_add(0.5, ctx.window)
+        self._timer = wm.event_timer_add(interval, ctx.window)
+        self._last_tick = None
         wm.modal_handler_add(self)
 
         return {"RUNNING_MODAL"}
     
         
+def report_unconverged(op, names):
+    """ warns once, for a whole bake, that adaptive sampling ran out of samples
+    before the coefficients of the named probes converged """
+    for name in names:
+        print("%s: adaptive sampling stopped before converging" % name)
+    op.report({"WARNING"}, "%d light probes stopped sampling before "
+            "converging to the SH tolerance, see the console for details"
+            % len(names))
+
+
 class BakeOperator(bpy.types.Operator):
     bl_idname = "object.bake_lightprobe"
     bl_label = "Bake Light Probe"
@@ -951,9 +1330,11 @@ class BakeOperator(bpy.types.Operator):
         scene = context.scene
         
         settings = scene.lightprobe
-        coeffs = get_lightprobe_coefficients(probe, settings.theta_res,
-                settings.phi_res)
+        coeffs, converged = get_lightprobe_coefficients(probe,
+                settings.theta_res, settings.phi_res)
         set_coeff_prop(probe, coeffs)
+        if not converged:
+            report_unconverged(self, [probe.name])
         
         return {"FINISHED"}
     
@@ -965,15 +1346,49 @@ class BakeAllOperator(bpy.types.Operator):
     def execute(self, context):
         scene_settings = context.scene.lightprobe
 
-        all_probes = all_active_lightprobes()
+        all_probes = list(all_active_lightprobes())
         ret = pre_bake_hook(scene_settings.pre_bake_hook, context, all_probes)
         
-        for probe in all_probes:
-            with active_and_selected(probe):
-                bpy.ops.object.bake_lightprobe()
+        num_workers = min(scene_settings.bake_workers, len(all_probes))
+        unconverged = []
+        if num_workers > 1:
+            errors, unconverged = bake_in_workers(context, all_probes,
+                    num_workers)
+            if errors:
+                for name, message in sorted(errors.items()):
+                    print("failed to bake %s: %s" % (name, message))
+                self.report({"ERROR"}, "%d light probes failed to bake, see "
+                        "the console for details" % len(errors))
+                return {"CANCELLED"}
+        elif scene_settings.bake_atlas:
+            try:
+                for probe, coeffs, converged in \
+                        get_lightprobe_coefficients_atlas(all_probes,
+                            scene_settings.theta_res, scene_settings.phi_res):
+                    set_coeff_prop(probe, coeffs)
+                    if not converged:
+                        unconverged.append(probe.name)
+            except ValueError as e:
+                self.report({"ERROR"}, str(e))
+                return {"CANCELLED"}
+        else:
+            for probe in all_probes:
+                with active_and_selected(probe):
+                    coeffs, converged = get_lightprobe_coefficients(probe,
+                            scene_settings.theta_res, scene_settings.phi_res)
+                set_coeff_prop(probe, coeffs)
+                if not converged:
+                    unconverged.append(probe.name)
+
+        if unconverged:
+            report_unconverged(self, unconverged)
         
         lp_data = get_all_lightprobe_data()
-        write_lightprobe_data(lp_data)
+        export_lightprobe_data(scene_settings, lp_data)
+        if not (scene_settings.keep_text_block or scene_settings.export_path
+                or scene_settings.binary_path):
+            self.report({"WARNING"}, "Light probes were baked, but there is "
+                    "nowhere set to export them to")
         post_bake_hook(scene_settings.post_bake_hook, context, lp_data, ret)
 
 
@@ -1059,9 +1474,50 @@ class SceneProperties(bpy.types.PropertyGroup):
     post_bake_hook = p.StringProperty(name="Post-bake hook", description="""Call \
 this function with lightprobe data.  Used for integrating with other plugins.""")
     cubemap_dir = p.StringProperty(name="Cubemap Directory", default="", subtype="DIR_PATH")
+    export_path = p.StringProperty(name="JSON Export", default="",
+            subtype="FILE_PATH", description="""Write the light probe json \
+straight to this file""")
+    keep_text_block = p.BoolProperty(name="Keep text block", default=True,
+            description="""Also store the light probe json in the %s text \
+block""" % JSON_FILE_NAME)
+    binary_path = p.StringProperty(name="Binary Export", default="",
+            subtype="FILE_PATH", description="""Also export the light probes \
+to this file, in a compact binary format""")
+    bake_mode = p.EnumProperty(name="Bake mode", default="LIGHTMAP", items=(
+        ("LIGHTMAP", "Lightmap", "Bake the lighting onto the probe mesh, and "
+            "sample it by casting rays out from its center"),
+        ("CUBEMAP", "Cubemap", "Render a small cubemap from the center of the "
+            "probe, and project it straight onto the SH basis"),
+    ))
+    cubemap_bake_size = p.IntProperty(name="Cubemap bake size", default=16,
+            min=1, description="""The size of each face of the cubemap \
+rendered for each probe in cubemap bake mode""")
+    panoramic_bake = p.BoolProperty(name="Panoramic", default=False,
+            description="""In cubemap bake mode, render one panorama per \
+probe and resample it into the cube faces, instead of rendering each face""")
+    sh_bands = p.IntProperty(name="SH bands", default=SH_BANDS, min=1,
+            max=SH_MAX_BANDS, description="""How many bands of spherical \
+harmonics to bake and export.  3 bands (L0-L2) is 9 coefficients, 4 is 16 and \
+5 is 25.  More bands give sharper lighting, at the cost of more storage and \
+shading""")
     theta_res = p.IntProperty(name="Theta Samples", default=10)
     phi_res = p.IntProperty(name="Phi Samples", default=20)
+    adaptive_sampling = p.BoolProperty(name="Adaptive sampling", default=False,
+            description="""Sample each probe's lightmap more densely where \
+the lighting has detail, until its coefficients converge, instead of on a \
+fixed theta/phi grid""")
+    sh_tolerance = p.FloatProperty(name="Tolerance", default=0.02, min=0.0001,
+            max=1.0, precision=4, description="""With adaptive sampling, how \
+much the coefficients may still be off by, relative to the brightest DC \
+coefficient""")
     samples = p.IntProperty(name="Bake samples", default=50)
+    bake_workers = p.IntProperty(name="Bake workers", default=1, min=1,
+            description="""Bake all light probes across this many background \
+Blender processes, splitting the render threads between them.  The probes' \
+lightmap images are only updated when baking with a single worker""")
+    bake_atlas = p.BoolProperty(name="Bake in one pass", default=False,
+            description="""Bake all light probes at once, into a shared atlas \
+image, instead of one at a time.  The probes' lightmap images are not updated""")
     
 class ProbeProperties(bpy.types.PropertyGroup):
     name = p.StringProperty(name="Probe Name", default="")
@@ -1070,6 +1526,9 @@ class CubemapProperties(bpy.types.PropertyGroup):
     name = p.StringProperty(name="Probe Name", default="")
     size = p.IntProperty(name="Size", default=256)
     sky_only = p.BoolProperty(name="Sky only", default=False)
+    panoramic = p.BoolProperty(name="Panoramic", default=False,
+            description="""Render one panorama per frame and resample it into \
+the cube faces, instead of rendering each face""")
 
     start_frame = p.IntProperty(name="Start Frame", subtype="UNSIGNED",
             set=make_validator(validate_min_frame, "start_frame"),
@@ -1080,6 +1539,19 @@ class CubemapProperties(bpy.types.PropertyGroup):
     single_frame = p.BoolProperty(name="Just this frame")
     whole_range = p.BoolProperty(name="Entire range")
     fps = p.FloatProperty(name="Framerate", default=30.0)
+    skip_static = p.BoolProperty(name="Skip static frames", default=False,
+            description="""Don't render frames where nothing the probe can see \
+has changed since the frame before, and store them as copies of it""")
+    influence_radius = p.FloatProperty(name="Influence radius", default=0.0,
+            min=0.0, subtype="DISTANCE", description="""When skipping static \
+frames, only watch objects within this distance of the probe.  Lamps and the \
+world are always watched.  0 watches the whole scene""")
+    render_workers = p.IntProperty(name="Render workers", default=1, min=1,
+            description="""Render the frames across this many background \
+Blender processes, splitting the render threads between them""")
+    resume = p.BoolProperty(name="Resume", default=True,
+            description="""Pick up an interrupted bake from the frames it \
+already finished, instead of starting over""")
     
     
 def register():
@@ -1087,6 +1559,7 @@ def register():
     bpy.types.Object.cubemap = p.PointerProperty(type=CubemapProperties)
     bpy.types.Object.lightprobe = p.PointerProperty(type=ProbeProperties)
     bpy.types.Scene.lightprobe = p.PointerProperty(type=SceneProperties)
+    bpy.app.handlers.load_post.append(clear_caches)
 
 
 
@@ -1094,6 +1567,8 @@ def unregister():
     unregister_module(__name__)
     del bpy.types.Object.lightprobe
     del bpy.types.Scene.lightprobe
+    if clear_caches in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(clear_caches)
     
 try:
     unregister()
@@ -0,0 +1,93 @@
+""" bakes a chunk of work inside of a background blender.  BakeAllOperator and
+BakeCubemapOperator launch one of these per worker, on a saved copy of the
+scene:
+
+    blender -b scene.blend -t 4 --python bake_worker.py -- job.json
+
+the job's kind is either "lightprobes", a list of light probes to bake, or
+"cubemap", a list of frames of a cubemap sequence to render into its
+checkpoint.  see lightprobe_core.workers for the job and results formats """
+
+import os
+import sys
+import importlib
+import traceback
+import bpy
+
+
+def import_addon():
+    """ imports the add-on this script lives in.  the worker's blender might not
+    have it enabled, so we import it by path """
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(addon_dir))
+    return importlib.import_module(os.path.basename(addon_dir))
+
+
+def bake_lightprobes(addon, workers, job, results):
+    scene = bpy.context.scene
+    settings = scene.lightprobe
+
+    def add_result(probe, coeffs, converged):
+        matrix = addon.mapping_to_coeff_matrix(coeffs)
+        results["results"][probe.name] = {
+            "coeffs": [float(c) for c in matrix.ravel()],
+            "converged": converged,
+        }
+        workers.write_results(job["results"], results)
+
+    if settings.bake_atlas:
+        probes = [scene.objects[name] for name in job["items"]]
+        for probe, coeffs, converged in \
+                addon.get_lightprobe_coefficients_atlas(probes,
+                    settings.theta_res, settings.phi_res):
+            add_result(probe, coeffs, converged)
+        return
+
+    for name in job["items"]:
+        try:
+            probe = scene.objects[name]
+            add_result(probe, *addon.get_lightprobe_coefficients(probe,
+                settings.theta_res, settings.phi_res))
+        except Exception:
+            results["errors"][name] = traceback.format_exc()
+            workers.write_results(job["results"], results)
+
+
+def render_cubemap_frames(addon, workers, job, results):
+    ctx = bpy.context
+    scene = ctx.scene
+    probe = scene.objects[job["probe"]]
+
+    checkpoint = addon.CubeCheckpoint(job["checkpoint"], job["manifest"],
+            addon.CUBEMAP_FORMAT)
+
+    with addon.cubemap_visibility(scene, probe):
+        for frame in job["items"]:
+            try:
+                scene.frame_set(frame)
+                addon.render_cubemap(ctx, checkpoint.begin_frame(frame), probe,
+                        job["manifest"]["size"])
+                checkpoint.finish_frame(frame)
+                results["results"][str(frame)] = True
+            except Exception:
+                results["errors"][str(frame)] = traceback.format_exc()
+            workers.write_results(job["results"], results)
+
+
+def main():
+    job_path = sys.argv[sys.argv.index("--") + 1]
+
+    addon = import_addon()
+    workers = importlib.import_module(addon.__name__ + ".lightprobe_core.workers")
+
+    job = workers.read_job(job_path)
+    results = {"results": {}, "errors": {}}
+
+    if job["kind"] == "cubemap":
+        render_cubemap_frames(addon, workers, job, results)
+    else:
+        bake_lightprobes(addon, workers, job, results)
+
+
+if __name__ == "__main__":
+    main()
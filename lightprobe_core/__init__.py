@@ -0,0 +1,9 @@
+""" the parts of the light probe add-on that don't need blender: SH math,
+lightmap sampling, probe mesh ray casting, tetrahedralization, our file formats
+and looking up the lighting in an exported probe volume.  everything here works
+on plain python sequences and numpy arrays, so it can be run, profiled and
+tested outside of blender, on ci machines and render nodes.
+
+inside blender, the add-on imports this package relatively.  outside of it,
+put the add-on's directory on sys.path and import lightprobe_core directly,
+which avoids importing the add-on itself (and bpy) """
@@ -0,0 +1,70 @@
+""" turning a probe's baked lightmap, or a cubemap rendered from its center,
+into SH coefficients """
+
+import numpy as np
+
+from .sh import (SH_BANDS, sh_sample_grid, project_sh, project_sh_scalar,
+        angle_to_ray)
+from .lightmap import (bilinear_interpolate, bilinear_interpolate_many,
+        gather_texels, lightmap_rgb)
+from .cubemap import cubemap_sample_grid, diffuse_band_scale
+from .quadrature import project_sh_adaptive
+
+
+# the most samples adaptive sampling takes, for each texel of the lightmap
+ADAPTIVE_SAMPLES_PER_TEXEL = 4
+
+
+def project_probe(probe_mesh, lightmap, theta_res, phi_res, bands=SH_BANDS):
+    """ returns the (bands^2 x 3) SH coefficient matrix of a baked probe.  the
+    whole theta/phi sample grid is gathered from the lightmap through the probe
+    mesh's direction lookup table, and projected in a single matrix multiply """
+    dirs, basis, weights = sh_sample_grid(theta_res, phi_res, bands)
+    lut = probe_mesh.direction_lut(lightmap.width, lightmap.height, theta_res,
+            phi_res)
+    radiance = gather_texels(lightmap, lut.texels, lut.texel_weights)
+    return project_sh(radiance, basis, weights)
+
+
+def project_probe_adaptive(probe_mesh, lightmap, tolerance, bands=SH_BANDS):
+    """ the adaptive version of project_probe.  instead of a fixed grid, the
+    lightmap is sampled where it has detail, until the coefficients converge to
+    within tolerance.  the lightmap has no detail finer than its texels, so we
+    never take more than a few samples per texel.  where the ray through each
+    cell lands is cached on the probe mesh, like its direction lookup table.
+    returns the (bands^2 x 3) coefficient matrix, the number of samples taken
+    and whether the coefficients converged before running out of samples """
+    def sample_fn(depth, indices):
+        uvs = probe_mesh.quadrature_uvs(depth, indices)
+        return bilinear_interpolate_many(lightmap, uvs)
+
+    max_samples = ADAPTIVE_SAMPLES_PER_TEXEL * lightmap.width * lightmap.height
+    return project_sh_adaptive(sample_fn, tolerance, max_samples, bands)
+
+
+def project_cubemap(faces, bands=SH_BANDS):
+    """ returns the (bands^2 x 3) SH coefficient matrix of a cubemap rendered
+    from the center of a probe.  faces are the six rendered faces as Lightmaps,
+    in CUBEMAP_FACES order.  every texel is weighted by its solid angle, and the
+    result is convolved to match what project_probe gets from a baked probe """
+    dirs, basis, weights = cubemap_sample_grid(faces[0].width, bands)
+    radiance = np.concatenate([lightmap_rgb(face) for face in faces])
+    coeffs = project_sh(radiance, basis, weights)
+    return coeffs * diffuse_band_scale(bands)[:, np.newaxis]
+
+
+def project_probe_scalar(probe_mesh, lightmap, theta_res, phi_res, keys=None):
+    """ the scalar reference version of project_probe, casting one ray and
+    taking one bilinear sample at a time.  returns our coefficient mapping """
+    def sample_fn(theta, phi):
+        return sample_probe_color(probe_mesh, lightmap, angle_to_ray(theta, phi))
+    return project_sh_scalar(sample_fn, theta_res, phi_res, keys)
+
+
+def sample_probe_color(probe_mesh, lightmap, ray):
+    """ casts a ray out from the center of the probe, bilinearly sampling the
+    lightmap where it hits """
+    tri_idx, loc = probe_mesh.index.cast(ray)
+    uv1, uv2, uv3 = probe_mesh.face_uvs[tri_idx]
+    uv = loc[0] * uv1 + loc[1] * uv2 + loc[2] * uv3
+    return bilinear_interpolate(lightmap, uv)
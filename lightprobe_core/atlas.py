@@ -0,0 +1,69 @@
+""" packing the lightmaps of many probes into shared atlas images, so that they
+can all be baked in a single pass.  each probe gets a square tile, surrounded by
+ATLAS_PADDING pixels of padding.  the bake margin spreads the edges of a tile
+out into its padding, so an atlas is baked with a margin of at most the
+padding, instead of blender's default of 16 pixels, which would reach well into
+the neighboring tiles """
+
+from math import ceil, sqrt
+from collections import namedtuple
+import numpy as np
+
+from .lightmap import make_lightmap
+
+
+# the pixels around each tile, which is also the largest bake margin an atlas
+# is baked with
+ATLAS_PADDING = 2
+
+# the largest atlas image we'll bake into.  probes that don't fit get another
+# atlas
+ATLAS_MAX_SIZE = 4096
+
+# a tile is the pixel offset of its lower left corner in the atlas (rows start
+# at the bottom, like blender images) and its size, not including the padding
+Atlas = namedtuple("Atlas", ["width", "height", "tiles"])
+AtlasTile = namedtuple("AtlasTile", ["x", "y", "size"])
+
+
+def atlas_layout(num_tiles, tile_size, padding=ATLAS_PADDING,
+        max_size=ATLAS_MAX_SIZE):
+    """ returns the list of Atlases needed to hold num_tiles tiles.  each atlas
+    is as close to square as it can be """
+    cell = tile_size + 2 * padding
+    per_side = max(1, max_size // cell)
+
+    atlases = []
+    remaining = num_tiles
+    while remaining > 0:
+        num = min(remaining, per_side * per_side)
+        cols = int(ceil(sqrt(num)))
+        rows = int(ceil(num / float(cols)))
+
+        tiles = [AtlasTile((i % cols) * cell + padding,
+            (i // cols) * cell + padding, tile_size) for i in range(num)]
+        atlases.append(Atlas(cols * cell, rows * cell, tiles))
+        remaining -= num
+
+    return atlases
+
+
+def atlas_uvs(uvs, atlas, tile):
+    """ maps an (N x 2) array of uvs in a probe's own lightmap to the same
+    places in its tile of the atlas """
+    uvs = np.asarray(uvs, dtype=np.float64).reshape(-1, 2)
+    scale = np.array([tile.size / float(atlas.width),
+        tile.size / float(atlas.height)])
+    offset = np.array([tile.x / float(atlas.width),
+        tile.y / float(atlas.height)])
+    return uvs * scale + offset
+
+
+def atlas_tile_lightmap(lightmap, tile):
+    """ copies one tile of a baked atlas Lightmap out into a Lightmap of its
+    own, which can be analysed with the probe's own uvs """
+    pixels = np.frombuffer(lightmap.pixels, dtype=np.float32)
+    pixels = pixels.reshape(lightmap.height, lightmap.width, lightmap.channels)
+    tile_pixels = pixels[tile.y:tile.y + tile.size, tile.x:tile.x + tile.size]
+    return make_lightmap(tile.size, tile.size, lightmap.channels,
+            tile_pixels.ravel())
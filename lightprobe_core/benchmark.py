@@ -0,0 +1,528 @@
+""" a headless benchmark of the bake analysis and export hot paths, on synthetic
+data: a lightmap-packed probe mesh like the one add_lightprobe makes, random
+lightmaps, and random probe clouds.  run it from the add-on's directory with:
+
+    python -m lightprobe_core.benchmark --output results.json
+
+results are written as json, so that they can be compared between versions.
+every timing is the wall clock time of one call, in seconds, over a number of
+repeats.  the benchmarks map to the add-on like so:
+
+    sh_projection       get_all_coefficients
+    ray_casting         find_intersecting_face
+    bilinear_sampling   sample_lightmap
+    tetrahedralize      get_all_lightprobe_data
+    json_export         write_lightprobe_data
+    binary_export       the binary probe volume export
+    cube_packing        BakeCubemapOperator
+    probe_query         a runtime's probe lookups (lightprobe_core.query) """
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+from math import sqrt
+import numpy as np
+
+from .sh import SH_COEFF_ORDER, sh_sample_grid, coeff_matrix_to_mapping
+from .lightmap import (make_lightmap, bilinear_interpolate,
+        bilinear_interpolate_many)
+from .geometry import ProbeMesh, ProbeMeshIndex
+from .analysis import project_probe, project_probe_scalar, project_probe_adaptive
+from .tetra import (Tetrahedralization, build_neighbors, tetrahedralize,
+        clear_tetrahedralization_cache)
+from .query import ProbeVolume
+from .formats import (write_lightprobe_json, write_lightprobe_binary,
+        write_cube_header, write_cube_face, read_cube, CubeWriter,
+        read_cube_frame, CUBEMAP_FACES)
+
+
+BENCHMARK_FORMAT_VERSION = 1
+
+# the defaults match the add-on: a subdivided cube (4 levels of subsurf), a
+# 32px lightmap and the default theta/phi resolution
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+DEFAULT_RESOLUTIONS = [(10, 20), (20, 40), (40, 80)]
+DEFAULT_TOLERANCES = [0.05, 0.02]
+DEFAULT_PROBE_SUBDIVISIONS = 16
+DEFAULT_LIGHTMAP_SIZE = 32
+
+# the scalar versions are orders of magnitude slower, so they are only timed
+# up to these sizes
+MAX_SCALAR_SAMPLES = 80 * 160
+MAX_SCALAR_RAYS = 10000
+
+# the fraction of probes moved when timing an incremental tetrahedralization
+INCREMENTAL_FRACTION = 0.01
+
+# how many points are looked up in a probe volume, and how many of them one at
+# a time
+NUM_QUERIES = 10000
+MAX_SCALAR_QUERIES = 2000
+
+
+def make_probe_mesh(subdivisions=DEFAULT_PROBE_SUBDIVISIONS, margin=0.05):
+    """ returns the (verts, triangles, face_uvs) of a synthetic probe mesh: a
+    cube with each face split into a grid of triangulated quads, pushed out onto
+    the unit sphere.  like lightmap_pack, each face of the cube gets its own
+    tile of the lightmap, in a 3x2 layout, with a margin around it """
+    verts = []
+    triangles = []
+    face_uvs = []
+    n = subdivisions
+
+    for face in range(6):
+        axis, sign = face // 2, 1 - 2 * (face % 2)
+        u_axis, v_axis = (axis + 1) % 3, (axis + 2) % 3
+        tile_x, tile_y = face % 3, face // 3
+        first = len(verts)
+
+        for i in range(n + 1):
+            for j in range(n + 1):
+                vert = [0.0, 0.0, 0.0]
+                vert[axis] = float(sign)
+                vert[u_axis] = -1.0 + 2.0 * i / n
+                vert[v_axis] = -1.0 + 2.0 * j / n
+                length = sqrt(sum(c * c for c in vert))
+                verts.append([c / length for c in vert])
+
+        def vert_idx(i, j):
+            return first + i * (n + 1) + j
+
+        def uv(i, j):
+            u = margin + (1 - 2 * margin) * i / float(n)
+            v = margin + (1 - 2 * margin) * j / float(n)
+            return (tile_x + u) / 3.0, (tile_y + v) / 2.0
+
+        for i in range(n):
+            for j in range(n):
+                quad = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)]
+                for tri in ((0, 1, 2), (0, 2, 3)):
+                    corners = [quad[c] for c in tri]
+                    triangles.append([vert_idx(*c) for c in corners])
+                    face_uvs.append([uv(*c) for c in corners])
+
+    return verts, triangles, face_uvs
+
+
+def make_synthetic_lightmap(size=DEFAULT_LIGHTMAP_SIZE, seed=0):
+    """ returns a square rgba Lightmap of random colors """
+    rng = np.random.RandomState(seed)
+    pixels = rng.random_sample(size * size * 4).astype(np.float32)
+    return make_lightmap(size, size, 4, pixels)
+
+
+def make_probe_cloud(num_probes, seed=0, extent=10.0):
+    """ returns num_probes random probe locations inside of a box """
+    rng = random.Random(seed)
+    return [[rng.uniform(0, extent) for _ in range(3)]
+            for _ in range(num_probes)]
+
+
+def make_lightprobe_data(points, seed=0):
+    """ returns light probe data, in the structure of get_all_lightprobe_data,
+    for a probe cloud with random coefficients """
+    rng = np.random.RandomState(seed)
+    keys = ["lightprobe-%d" % i for i in range(len(points))]
+    simplices, neighbors = Tetrahedralization(keys, points).export(keys)
+
+    probes = []
+    for key, point in zip(keys, points):
+        coeffs = rng.random_sample((len(SH_COEFF_ORDER), 3))
+        probes.append({
+            "loc": list(point),
+            "name": key,
+            "coeffs": coeff_matrix_to_mapping(coeffs),
+        })
+
+    return {
+        "probes": probes,
+        "simplices": simplices,
+        "neighbors": neighbors,
+    }
+
+
+def random_directions(num, seed=0):
+    rng = np.random.RandomState(seed)
+    dirs = rng.normal(size=(num, 3))
+    return dirs / np.linalg.norm(dirs, axis=1)[:, np.newaxis]
+
+
+def time_call(fn, repeat, setup=None):
+    """ calls fn repeat times, returning the time of each call.  setup is
+    called before each call, outside of the timing, and its return value is
+    passed to fn """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        if setup:
+            fn(arg)
+        else:
+            fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class Benchmark(object):
+    """ collects timings into a list of results """
+
+    def __init__(self, repeat, verbose=False):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = []
+
+    def run(self, name, params, fn, setup=None, items=None, repeat=None):
+        """ times fn, recording it under name and params.  items is the number
+        of things (rays, samples, probes) processed by one call, used to report
+        the time per item """
+        times = time_call(fn, repeat or self.repeat, setup)
+        times.sort()
+
+        result = {
+            "name": name,
+            "params": params,
+            "runs": len(times),
+            "min": times[0],
+            "median": times[len(times) // 2],
+            "max": times[-1],
+        }
+        if items:
+            result["items"] = items
+            result["min_per_item"] = times[0] / items
+
+        self.results.append(result)
+        if self.verbose:
+            sys.stderr.write("%-20s %-50s %.6fs\n" % (name,
+                json.dumps(params, sort_keys=True), times[0]))
+        return result
+
+
+def bench_sh_projection(bench, resolutions, lightmap, mesh_data):
+    for theta_res, phi_res in resolutions:
+        num_samples = theta_res * phi_res
+        params = {"theta_res": theta_res, "phi_res": phi_res,
+                "lightmap_size": lightmap.width, "triangles": len(mesh_data[1])}
+
+        # the first probe we analyse pays for the ray casting index and the
+        # direction lookup table, every probe after it shares them
+        def cold_setup():
+            sh_sample_grid(theta_res, phi_res)
+            return ProbeMesh(*mesh_data)
+
+        bench.run("sh_projection", dict(params, variant="cold"),
+                lambda probe_mesh: project_probe(probe_mesh, lightmap,
+                    theta_res, phi_res), setup=cold_setup, items=num_samples)
+
+        probe_mesh = ProbeMesh(*mesh_data)
+        project_probe(probe_mesh, lightmap, theta_res, phi_res)
+        bench.run("sh_projection", dict(params, variant="warm"),
+                lambda: project_probe(probe_mesh, lightmap, theta_res,
+                    phi_res), items=num_samples)
+
+        if num_samples <= MAX_SCALAR_SAMPLES:
+            bench.run("sh_projection", dict(params, variant="scalar"),
+                    lambda: project_probe_scalar(probe_mesh, lightmap,
+                        theta_res, phi_res), items=num_samples, repeat=1)
+
+    # adaptive sampling takes as many samples as the lightmap needs, so we
+    # count them once up front, which also caches where the rays of its cells
+    # land, like the direction lookup table of the warm variant
+    probe_mesh = ProbeMesh(*mesh_data)
+    for tolerance in DEFAULT_TOLERANCES:
+        _, num_samples, _ = project_probe_adaptive(probe_mesh, lightmap,
+                tolerance)
+        params = {"tolerance": tolerance, "lightmap_size": lightmap.width,
+                "triangles": len(mesh_data[1])}
+        bench.run("sh_projection", dict(params, variant="adaptive"),
+                lambda: project_probe_adaptive(probe_mesh, lightmap,
+                    tolerance), items=num_samples)
+
+
+def bench_ray_casting(bench, sizes, mesh_data):
+    verts, triangles, _ = mesh_data
+    params = {"triangles": len(triangles)}
+
+    bench.run("ray_casting", dict(params, variant="build_index"),
+            lambda: ProbeMeshIndex(verts, triangles))
+
+    probe_mesh = ProbeMesh(*mesh_data)
+    index = probe_mesh.index
+
+    for num_rays in sizes:
+        if num_rays > MAX_SCALAR_RAYS:
+            continue
+        dirs = random_directions(num_rays)
+        rays = [tuple(direction) for direction in dirs]
+
+        def cast_each():
+            for ray in rays:
+                index.cast(ray)
+
+        bench.run("ray_casting", dict(params, variant="cast", rays=num_rays),
+                cast_each, items=num_rays)
+        bench.run("ray_casting", dict(params, variant="cast_rays",
+            rays=num_rays), lambda: probe_mesh.cast_rays(dirs), items=num_rays)
+
+
+def bench_bilinear_sampling(bench, sizes, lightmap):
+    params = {"lightmap_size": lightmap.width}
+    rng = np.random.RandomState(0)
+
+    for num_samples in sizes:
+        uvs = rng.random_sample((num_samples, 2))
+
+        if num_samples <= MAX_SCALAR_RAYS:
+            uv_list = [tuple(uv) for uv in uvs]
+
+            def sample_each():
+                for uv in uv_list:
+                    bilinear_interpolate(lightmap, uv)
+
+            bench.run("bilinear_sampling", dict(params, variant="scalar",
+                samples=num_samples), sample_each, items=num_samples)
+
+        bench.run("bilinear_sampling", dict(params, variant="batched",
+            samples=num_samples), lambda: bilinear_interpolate_many(lightmap,
+                uvs), items=num_samples)
+
+
+def bench_tetrahedralize(bench, sizes):
+    for num_probes in sizes:
+        points = make_probe_cloud(num_probes)
+        keys = ["lightprobe-%d" % i for i in range(num_probes)]
+        params = {"probes": num_probes}
+
+        tetra = Tetrahedralization(keys, points)
+        simplices = [list(simp) for simp in tetra.simplices]
+        params["simplices"] = len(simplices)
+
+        bench.run("tetrahedralize", dict(params, variant="full"),
+                lambda: Tetrahedralization(keys, points).export(keys),
+                items=num_probes)
+        bench.run("tetrahedralize", dict(params, variant="neighbors"),
+                lambda: build_neighbors(simplices), items=len(simplices))
+
+        # move a few probes, the way someone nudging probes around in the
+        # viewport between exports would
+        rng = random.Random(1)
+        num_moved = max(1, int(num_probes * INCREMENTAL_FRACTION))
+        moved_idxs = rng.sample(range(num_probes), num_moved)
+
+        def incremental_setup():
+            clear_tetrahedralization_cache()
+            tetrahedralize("benchmark", keys, points)
+            moved = [list(point) for point in points]
+            for idx in moved_idxs:
+                moved[idx] = [c + rng.uniform(-0.01, 0.01) for c in moved[idx]]
+            return moved
+
+        bench.run("tetrahedralize", dict(params, variant="incremental",
+            moved=num_moved), lambda moved: tetrahedralize("benchmark", keys,
+                moved), setup=incremental_setup, items=num_moved)
+        clear_tetrahedralization_cache()
+
+
+def bench_export(bench, sizes, tmp_dir):
+    for num_probes in sizes:
+        data = make_lightprobe_data(make_probe_cloud(num_probes))
+        params = {"probes": num_probes, "simplices": len(data["simplices"])}
+
+        json_path = os.path.join(tmp_dir, "lightprobes.json")
+        result = bench.run("json_export", params,
+                lambda: write_lightprobe_json(json_path, data),
+                items=num_probes)
+        result["bytes"] = os.path.getsize(json_path)
+
+        binary_path = os.path.join(tmp_dir, "lightprobes.lprb")
+        result = bench.run("binary_export", params,
+                lambda: write_lightprobe_binary(binary_path, data),
+                items=num_probes)
+        result["bytes"] = os.path.getsize(binary_path)
+
+
+def bench_probe_query(bench, sizes, extent=10.0):
+    rng = np.random.RandomState(0)
+    scattered = rng.uniform(0, extent, size=(NUM_QUERIES, 3))
+    outside = rng.uniform(-extent, extent * 2, size=(NUM_QUERIES, 3))
+
+    # something moving through the volume, which each lookup starts from where
+    # the last one ended
+    steps = rng.normal(scale=extent * 0.001, size=(MAX_SCALAR_QUERIES, 3))
+    path = np.clip(extent * 0.5 + np.cumsum(steps, axis=0), 0, extent)
+
+    for num_probes in sizes:
+        data = make_lightprobe_data(make_probe_cloud(num_probes, extent=extent))
+        volume = ProbeVolume.from_data(data)
+        params = {"probes": num_probes, "simplices": len(data["simplices"])}
+
+        bench.run("probe_query", dict(params, variant="batched"),
+                lambda: volume.query_many(scattered), items=NUM_QUERIES)
+        bench.run("probe_query", dict(params, variant="batched_outside"),
+                lambda: volume.query_many(outside), items=NUM_QUERIES)
+
+        def query_each(points):
+            for point in points:
+                volume.query(point)
+
+        bench.run("probe_query", dict(params, variant="scattered"),
+                lambda: query_each(scattered[:MAX_SCALAR_QUERIES]),
+                items=MAX_SCALAR_QUERIES)
+        bench.run("probe_query", dict(params, variant="coherent"),
+                lambda: query_each(path), items=MAX_SCALAR_QUERIES)
+
+
+def bench_cube_packing(bench, tmp_dir, face_size=128, num_frames=24):
+    # an uncompressed rgba float image is the worst case for an exr face
+    face = os.urandom(face_size * face_size * 4 * 4)
+    cube_path = os.path.join(tmp_dir, "probe.cube")
+    params = {"face_size": face_size, "frames": num_frames,
+            "face_bytes": len(face)}
+
+    def pack():
+        with open(cube_path, "wb") as h:
+            write_cube_header(h, 24.0, 2.2, num_frames)
+            for _ in range(num_frames):
+                for _ in CUBEMAP_FACES:
+                    write_cube_face(h, face)
+
+    def unpack():
+        with open(cube_path, "rb") as h:
+            read_cube(h)
+
+    def pack_indexed():
+        with open(cube_path, "wb") as h:
+            writer = CubeWriter(h, 24.0, 2.2, num_frames)
+            for _ in range(num_frames * len(CUBEMAP_FACES)):
+                writer.write_face(face)
+            writer.close()
+
+    def seek_indexed():
+        with open(cube_path, "rb") as h:
+            read_cube_frame(h, num_frames - 1)
+
+    num_faces = num_frames * len(CUBEMAP_FACES)
+    bench.run("cube_packing", dict(params, variant="write"), pack,
+            items=num_faces)
+    bench.run("cube_packing", dict(params, variant="read"), unpack,
+            items=num_faces)
+
+    bench.run("cube_packing", dict(params, variant="write_indexed"),
+            pack_indexed, items=num_faces)
+    bench.run("cube_packing", dict(params, variant="seek_indexed"),
+            seek_indexed, items=len(CUBEMAP_FACES))
+
+
+BENCHMARKS = ["sh_projection", "ray_casting", "bilinear_sampling",
+    "tetrahedralize", "json_export", "binary_export", "cube_packing",
+    "probe_query"]
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, resolutions=DEFAULT_RESOLUTIONS,
+        repeat=3, only=None, subdivisions=DEFAULT_PROBE_SUBDIVISIONS,
+        lightmap_size=DEFAULT_LIGHTMAP_SIZE, verbose=False):
+    """ runs the benchmarks named in only (all of them, by default), returning
+    the results as a json-serializable dict """
+    only = set(only or BENCHMARKS)
+    bench = Benchmark(repeat, verbose)
+
+    mesh_data = make_probe_mesh(subdivisions)
+    lightmap = make_synthetic_lightmap(lightmap_size)
+
+    if "sh_projection" in only:
+        bench_sh_projection(bench, resolutions, lightmap, mesh_data)
+    if "ray_casting" in only:
+        bench_ray_casting(bench, sizes, mesh_data)
+    if "bilinear_sampling" in only:
+        bench_bilinear_sampling(bench, sizes, lightmap)
+    if "tetrahedralize" in only:
+        bench_tetrahedralize(bench, sizes)
+    if "probe_query" in only:
+        bench_probe_query(bench, sizes)
+
+    tmp_dir = tempfile.mkdtemp(prefix="lightprobe-benchmark-")
+    try:
+        if only & set(["json_export", "binary_export"]):
+            bench_export(bench, sizes, tmp_dir)
+        if "cube_packing" in only:
+            bench_cube_packing(bench, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = [result for result in bench.results if result["name"] in only]
+
+    return {
+        "format_version": BENCHMARK_FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        },
+        "config": {
+            "sizes": list(sizes),
+            "resolutions": [list(res) for res in resolutions],
+            "repeat": repeat,
+            "probe_subdivisions": subdivisions,
+            "lightmap_size": lightmap_size,
+        },
+        "results": results,
+    }
+
+
+def parse_resolution(value):
+    theta_res, phi_res = value.lower().split("x")
+    return int(theta_res), int(phi_res)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m lightprobe_core.benchmark",
+            description="benchmarks the light probe bake analysis and export")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+            help="probe counts, ray counts and sample counts to time")
+    parser.add_argument("--resolutions", type=parse_resolution, nargs="+",
+            default=DEFAULT_RESOLUTIONS, metavar="THETAxPHI",
+            help="theta/phi sampling resolutions to time, like 10x20")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="how many times to time each call")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS,
+            help="only run these benchmarks")
+    parser.add_argument("--subdivisions", type=int,
+            default=DEFAULT_PROBE_SUBDIVISIONS,
+            help="grid size of each face of the probe mesh")
+    parser.add_argument("--lightmap-size", type=int,
+            default=DEFAULT_LIGHTMAP_SIZE)
+    parser.add_argument("--quick", action="store_true",
+            help="a fast smoke run, with small sizes and a single repeat")
+    parser.add_argument("--output", help="write the json here, instead of "
+            "to stdout")
+    parser.add_argument("--verbose", action="store_true",
+            help="print each timing to stderr as it is taken")
+    args = parser.parse_args(argv)
+
+    sizes, resolutions, repeat = args.sizes, args.resolutions, args.repeat
+    if args.quick:
+        sizes = [size for size in sizes if size <= 1000]
+        resolutions = resolutions[:1]
+        repeat = 1
+
+    results = run_benchmarks(sizes, resolutions, repeat, args.only,
+            args.subdivisions, args.lightmap_size, args.verbose)
+
+    if args.output:
+        with open(args.output, "w") as h:
+            json.dump(results, h, indent=4, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+""" resumable cubemap sequence bakes.  every rendered frame is checkpointed into
+a directory next to the .cube file, and the container is only assembled once
+every frame is there:
+
+    <name>.cube.partial/
+        manifest.json           the settings the frames were rendered with
+        frame-000001/
+            posx.exr ... negz.exr
+            done                written last, once all six faces are in
+
+a bake that is cancelled or killed part way through leaves its finished frames
+behind, and re-running it only renders the frames without a done marker.  if
+the settings in the manifest no longer match, the old frames are thrown away.
+
+frames that reuse an earlier frame's faces (see frames.plan_frame_sources) are
+never rendered, and become references to that frame in the container """
+
+import os
+import json
+import shutil
+
+from .formats import atomic_write, CubeWriter, CUBEMAP_FACES
+
+
+CHECKPOINT_SUFFIX = ".partial"
+CHECKPOINT_MANIFEST = "manifest.json"
+CHECKPOINT_DONE = "done"
+CHECKPOINT_VERSION = 1
+
+
+def checkpoint_dir(cube_path):
+    return cube_path + CHECKPOINT_SUFFIX
+
+
+class CubeCheckpoint(object):
+    """ the checkpoint directory of one cubemap sequence bake.  manifest is a
+    json-serializable dict of everything that affects the rendered frames,
+    including "frames", the list of frame numbers in the sequence, and "fps" and
+    "gamma" for the container header.  it may also have "sources", the frame
+    that each frame takes its faces from """
+
+    def __init__(self, directory, manifest, extension="exr"):
+        self.directory = directory
+        self.manifest = dict(manifest, version=CHECKPOINT_VERSION)
+        self.extension = extension
+
+        manifest_path = os.path.join(directory, CHECKPOINT_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as h:
+                old_manifest = json.load(h)
+
+            # round trip our manifest through json, so that tuples and lists
+            # compare equal
+            if old_manifest != json.loads(json.dumps(self.manifest)):
+                shutil.rmtree(directory)
+
+        if not os.path.exists(manifest_path):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            with atomic_write(manifest_path) as h:
+                json.dump(self.manifest, h, indent=4, sort_keys=True)
+
+    @property
+    def frames(self):
+        return self.manifest["frames"]
+
+    @property
+    def sources(self):
+        return self.manifest.get("sources", None) or self.frames
+
+    def frame_dir(self, frame):
+        return os.path.join(self.directory, "frame-%06d" % frame)
+
+    def face_path(self, frame, face):
+        return os.path.join(self.frame_dir(frame), face + "." + self.extension)
+
+    def is_done(self, frame):
+        return os.path.exists(os.path.join(self.frame_dir(frame),
+            CHECKPOINT_DONE))
+
+    def pending_frames(self):
+        """ the frames that still need rendering, in order """
+        return [frame for frame, source in zip(self.frames, self.sources)
+                if frame == source and not self.is_done(frame)]
+
+    def begin_frame(self, frame):
+        """ returns an empty directory to render a frame's faces into,
+        clearing out anything an interrupted render left behind """
+        frame_dir = self.frame_dir(frame)
+        if os.path.exists(frame_dir):
+            shutil.rmtree(frame_dir)
+        os.makedirs(frame_dir)
+        return frame_dir
+
+    def finish_frame(self, frame):
+        """ marks a frame as done, once all of its faces have been rendered """
+        for face in CUBEMAP_FACES:
+            if not os.path.exists(self.face_path(frame, face)):
+                raise ValueError("frame %d is missing its %s face" % (frame,
+                    face))
+
+        with atomic_write(os.path.join(self.frame_dir(frame),
+                CHECKPOINT_DONE)) as h:
+            h.write("")
+
+    def finalize(self, cube_path):
+        """ assembles the indexed .cube container from the finished frames, and
+        removes the checkpoint.  the container only replaces cube_path once it
+        has been completely written """
+        pending = self.pending_frames()
+        if pending:
+            raise ValueError("%d frames haven't been rendered yet"
+                    % len(pending))
+
+        with atomic_write(cube_path, "wb") as h:
+            writer = CubeWriter(h, self.manifest["fps"], self.manifest["gamma"],
+                    len(self.frames))
+            frame_idxs = dict((frame, idx) for idx, frame
+                    in enumerate(self.frames))
+
+            for frame, source in zip(self.frames, self.sources):
+                if source != frame:
+                    writer.repeat_frame(frame_idxs[source])
+                    continue
+
+                for face in CUBEMAP_FACES:
+                    with open(self.face_path(frame, face), "rb") as face_h:
+                        writer.write_face_file(face_h)
+            writer.close()
+
+        shutil.rmtree(self.directory, ignore_errors=True)
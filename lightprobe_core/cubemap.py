@@ -0,0 +1,159 @@
+""" the geometry of the cubemaps we render: the direction that each texel of each
+face looks in, how much of the sphere it covers, and resampling panoramas into
+cube faces """
+
+from collections import OrderedDict
+from math import pi, factorial
+import numpy as np
+
+from .sh import SH_BANDS, sh_coeff_order, sh_basis
+from .formats import CUBEMAP_FACES
+from .lightmap import make_lightmap
+
+
+# the rotations (as w, x, y, z quaternions) of the camera that renders each
+# face.  the camera is also mirrored horizontally, by an x scale of -1.  the
+# faces are named in y-up (opengl) space, so posy looks up blender's z axis, and
+# posz looks down blender's -y axis
+CUBEMAP_FACE_ROTATIONS = OrderedDict((
+    ("posx", (0.5, 0.5, -0.5, -0.5)),
+    ("negx", (0.5, 0.5, 0.5, 0.5)),
+    ("posy", (0, 0.0, -1.0, 0.0)),
+    ("negy", (0.0, 0.0, 0.0, -1.0)),
+    ("posz", (0, 0, -0.7071067690849304, -0.70710688829422)),
+    ("negz", (-0.70710688829422, -0.7071067690849304, 0, 0.0)),
+))
+
+# project_probe's sample weights integrate over the sphere scaled by 1/(2pi^2),
+# so we scale our solid angles by the same amount to get the same coefficients
+SOLID_ANGLE_SCALE = 1.0 / (2 * pi * pi)
+
+
+def quaternion_to_matrix(q):
+    w, x, y, z = q
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+        [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+        [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+    ])
+
+
+def face_texel_coords(size):
+    """ returns the (size*size) s and t coordinates, from -1 to 1, of the
+    centers of a face's texels, in the order of a blender image: rows from the
+    bottom up, and left to right within a row """
+    coords = (np.arange(size) + 0.5) * 2.0 / size - 1
+    t, s = np.meshgrid(coords, coords, indexing="ij")
+    return s.ravel(), t.ravel()
+
+
+def cube_face_directions(face, size):
+    """ returns the (size*size x 3) unit directions that the texels of a
+    rendered face look in.  a texel at (s, t) is a ray of (s, t, -1) in camera
+    space, with s negated by the camera's mirroring """
+    s, t = face_texel_coords(size)
+    local = np.column_stack((-s, t, -np.ones_like(s)))
+    dirs = local.dot(quaternion_to_matrix(CUBEMAP_FACE_ROTATIONS[face]).T)
+    return dirs / np.linalg.norm(dirs, axis=1)[:, np.newaxis]
+
+
+def cube_texel_solid_angles(size):
+    """ returns the (size*size) solid angles of a face's texels, which are the
+    same for every face.  the six faces add up to 4pi """
+    def area(x, y):
+        return np.arctan2(x * y, np.sqrt(x * x + y * y + 1))
+
+    edges = np.arange(size + 1) * 2.0 / size - 1
+    y0, x0 = np.meshgrid(edges[:-1], edges[:-1], indexing="ij")
+    y1, x1 = np.meshgrid(edges[1:], edges[1:], indexing="ij")
+
+    return (area(x0, y0) - area(x0, y1) - area(x1, y0)
+            + area(x1, y1)).ravel()
+
+
+_cubemap_grid_cache = {}
+
+def cubemap_sample_grid(size, bands=SH_BANDS):
+    """ like sh_sample_grid, but for the texels of a cubemap with faces of
+    size x size, in CUBEMAP_FACES order.  returns the (6*size*size x 3)
+    directions, the SH basis at those directions and the texel weights """
+    key = (size, bands)
+    grid = _cubemap_grid_cache.get(key, None)
+    if grid is None:
+        dirs = np.concatenate([cube_face_directions(face, size)
+            for face in CUBEMAP_FACES])
+        weights = np.tile(cube_texel_solid_angles(size), len(CUBEMAP_FACES))
+        weights *= SOLID_ANGLE_SCALE
+
+        grid = (dirs, sh_basis(dirs, bands), weights)
+        _cubemap_grid_cache[key] = grid
+    return grid
+
+
+def clamped_cosine_band(l):
+    """ projecting radiance gives the SH of the light arriving at the probe,
+    but the lightmap bake gives the light leaving its white diffuse surface.
+    that is the incoming light convolved with a clamped cosine, which scales
+    band l by A_l / pi.  (ramamoorthi and hanrahan's A_0 = pi, A_1 = 2pi/3,
+    A_2 = pi/4, and the odd bands above 1 are zero) """
+    if l == 0:
+        return 1.0
+    if l == 1:
+        return 2.0 / 3.0
+    if l % 2:
+        return 0.0
+
+    half = l // 2
+    sign = -1.0 if half % 2 == 0 else 1.0
+    return (2.0 * sign / ((l + 2) * (l - 1)) * factorial(l)
+            / (2 ** l * factorial(half) ** 2))
+
+
+def diffuse_band_scale(bands=SH_BANDS):
+    """ returns clamped_cosine_band for each coefficient, in sh_coeff_order """
+    return np.array([clamped_cosine_band(l) for l, m in sh_coeff_order(bands)])
+
+
+def equirect_uvs(dirs):
+    """ returns the (N x 2) uvs of an equirectangular panorama that (N x 3) unit
+    directions look at.  this is the mapping of blender's environment textures,
+    which a cycles panoramic camera pointing down +x renders: +x is in the
+    middle, +y a quarter of the way in from the left, and +z along the top """
+    x, y, z = dirs[:, 0], dirs[:, 1], dirs[:, 2]
+    u = (pi - np.arctan2(y, x)) / (2 * pi)
+    v = 1 - np.arccos(np.clip(z, -1, 1)) / pi
+    return np.column_stack((u, v))
+
+
+def equirect_to_cube_faces(pano, size):
+    """ resamples an equirectangular panorama Lightmap into the six size x size
+    faces that render_cubemap would have rendered, in CUBEMAP_FACES order.  the
+    panorama wraps around horizontally, and extends its edges vertically """
+    width, height, channels = pano.width, pano.height, pano.channels
+    pixels = np.frombuffer(pano.pixels, dtype=np.float32)
+    pixels = pixels.reshape(height, width, channels)
+
+    faces = []
+    for face in CUBEMAP_FACES:
+        uvs = equirect_uvs(cube_face_directions(face, size))
+
+        x = uvs[:, 0] * width - 0.5
+        y = uvs[:, 1] * height - 0.5
+        left = np.floor(x).astype(np.int64)
+        bottom = np.floor(y).astype(np.int64)
+        lerp_x = (x - left)[:, np.newaxis]
+        lerp_y = (y - bottom)[:, np.newaxis]
+
+        right = (left + 1) % width
+        left = left % width
+        top = np.clip(bottom + 1, 0, height - 1)
+        bottom = np.clip(bottom, 0, height - 1)
+
+        lower = pixels[bottom, left] * (1 - lerp_x) + pixels[bottom, right] * lerp_x
+        upper = pixels[top, left] * (1 - lerp_x) + pixels[top, right] * lerp_x
+        face_pixels = lower * (1 - lerp_y) + upper * lerp_y
+
+        faces.append(make_lightmap(size, size, channels,
+            face_pixels.astype(np.float32).ravel()))
+
+    return faces
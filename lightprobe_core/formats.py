@@ -0,0 +1,395 @@
+""" our export file formats: the light probe json, the binary probe volume, and
+the .cube container that cubemap probes are baked into """
+
+import os
+import json
+import stat
+import struct
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+from .sh import SH_COEFF_ORDER, mapping_to_coeff_matrix, coeff_matrix_to_mapping
+
+
+# the binary probe volume format.  a fixed header of magic, version, counts and
+# section offsets, followed by 16-byte aligned sections of little-endian
+# arrays, so that a runtime can map the file and use them in place:
+#
+#   locations   float32[num_probes][3]
+#   coeffs      float32[num_probes][num_coeffs][3], in sh_coeff_order.  every
+#               probe has the same number of bands, num_coeffs = bands^2
+#   simplices   uint32[num_simplices][4]
+#   neighbors   uint32[num_simplices][4], BINARY_NO_NEIGHBOR on the hull
+#   names       num_probes * (uint32 byte length, utf-8 bytes), 0 for no name
+BINARY_MAGIC = b"LPRB"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4s9I")
+BINARY_ALIGNMENT = 16
+BINARY_NO_NEIGHBOR = 0xffffffff
+
+
+@contextmanager
+def atomic_write(filepath, mode="w"):
+    """ yields a file handle to a temporary file next to filepath, which
+    replaces filepath only once everything has been written.  a failed export
+    never leaves a half-written file behind.  the file ends up with the mode
+    of the one it replaces, or the umask's for a new one """
+    dirname = os.path.dirname(filepath) or "."
+    h = tempfile.NamedTemporaryFile(mode=mode, dir=dirname, delete=False,
+            prefix="." + os.path.basename(filepath) + ".")
+    try:
+        with h:
+            yield h
+        os.chmod(h.name, replaced_file_mode(filepath))
+        os.replace(h.name, filepath)
+    except:
+        os.remove(h.name)
+        raise
+
+
+def replaced_file_mode(filepath):
+    """ the permissions a file written to filepath should have.  temporary
+    files are only readable by us, which would keep runtimes and other users
+    from reading the export """
+    try:
+        return stat.S_IMODE(os.stat(filepath).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def write_lightprobe_json(filepath, data):
+    """ streams the json straight to a file, without building the whole string
+    in memory or storing it in the .blend """
+    with atomic_write(filepath) as h:
+        json.dump(data, h, indent=4, sort_keys=True)
+
+
+def write_lightprobe_binary(filepath, data):
+    """ writes the light probe data in our binary probe volume format (see
+    BINARY_MAGIC) """
+    with atomic_write(filepath, "wb") as h:
+        h.write(pack_lightprobe_binary(data))
+
+
+def pack_lightprobe_binary(data):
+    probes = data["probes"]
+
+    locations = np.array([probe["loc"] for probe in probes], dtype="<f4")
+    coeffs = np.array([mapping_to_coeff_matrix(probe["coeffs"])
+        for probe in probes], dtype="<f4")
+    num_coeffs = coeffs.shape[1] if len(probes) else len(SH_COEFF_ORDER)
+    simplices = np.array(data["simplices"], dtype="<u4")
+    neighbors = np.array([[BINARY_NO_NEIGHBOR if nb is None else nb
+        for nb in cur_neighbors] for cur_neighbors in data["neighbors"]],
+        dtype="<u4")
+
+    names = []
+    for probe in probes:
+        name = (probe["name"] or "").encode("utf-8")
+        names.append(struct.pack("<I", len(name)) + name)
+    names = b"".join(names)
+
+    sections = [locations.tobytes(), coeffs.tobytes(), simplices.tobytes(),
+            neighbors.tobytes(), names]
+
+    offsets = []
+    offset = BINARY_HEADER.size
+    for section in sections:
+        offset = align(offset, BINARY_ALIGNMENT)
+        offsets.append(offset)
+        offset += len(section)
+
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(probes),
+            num_coeffs, len(simplices), *offsets)
+
+    out = bytearray(header)
+    for offset, section in zip(offsets, sections):
+        out.extend(b"\0" * (offset - len(out)))
+        out.extend(section)
+    return bytes(out)
+
+
+def read_lightprobe_arrays(buf):
+    """ reads our binary probe volume format from a bytes-like object (for
+    example, an mmap of the file) and returns its sections as numpy arrays.  the
+    arrays are views into buf, nothing is copied """
+    (magic, version, num_probes, num_coeffs, num_simplices, locations_offset,
+        coeffs_offset, simplices_offset, neighbors_offset,
+        names_offset) = BINARY_HEADER.unpack_from(buf, 0)
+
+    if magic != BINARY_MAGIC:
+        raise ValueError("not a lightprobe binary file")
+    if version != BINARY_VERSION:
+        raise ValueError("unsupported lightprobe binary version %d" % version)
+
+    def section(dtype, offset, shape):
+        count = int(np.prod(shape))
+        arr = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        return arr.reshape(shape)
+
+    arrays = {
+        "locations": section("<f4", locations_offset, (num_probes, 3)),
+        "coeffs": section("<f4", coeffs_offset, (num_probes, num_coeffs, 3)),
+        "simplices": section("<u4", simplices_offset, (num_simplices, 4)),
+        "neighbors": section("<u4", neighbors_offset, (num_simplices, 4)),
+    }
+
+    names = []
+    offset = names_offset
+    for _ in range(num_probes):
+        length, = struct.unpack_from("<I", buf, offset)
+        offset += 4
+        name = bytes(buf[offset:offset+length]).decode("utf-8")
+        offset += length
+        names.append(name or None)
+    arrays["names"] = names
+
+    return arrays
+
+
+def read_lightprobe_binary(buf):
+    """ the inverse of pack_lightprobe_binary, returning the same structure as
+    the light probe json """
+    arrays = read_lightprobe_arrays(buf)
+
+    probes = []
+    for loc, coeffs, name in zip(arrays["locations"], arrays["coeffs"],
+            arrays["names"]):
+        probes.append({
+            "loc": [float(c) for c in loc],
+            "name": name,
+            "coeffs": coeff_matrix_to_mapping(coeffs),
+        })
+
+    simplices = [[int(vert) for vert in simp] for simp in arrays["simplices"]]
+    neighbors = [[None if nb == BINARY_NO_NEIGHBOR else int(nb)
+        for nb in cur_neighbors] for cur_neighbors in arrays["neighbors"]]
+
+    return {
+        "probes": probes,
+        "simplices": simplices,
+        "neighbors": neighbors,
+    }
+
+
+def align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+# the legacy .cube container is a header of (fps, gamma, number of frames),
+# followed by six faces for every frame, in the order of CUBEMAP_FACES.  each
+# face is a complete image file, prefixed by its byte length
+CUBE_HEADER = struct.Struct("<ffI")
+CUBE_FACE_LENGTH = struct.Struct("<I")
+CUBEMAP_FACES = ["posx", "negx", "posy", "negy", "posz", "negz"]
+
+# faces are streamed into the container in chunks of this many bytes
+CUBE_COPY_BUFFER = 1024 * 1024
+
+# the indexed .cube container.  a header of magic, version, fps, gamma and
+# counts is followed by a table with the (offset, length) of every face of every
+# frame, so that a reader can map the file and jump straight to any frame:
+#
+#   header      CUBE_INDEXED_HEADER
+#   table       uint64[num_frames][num_faces][2], (offset, length)
+#   faces       the image files, each 16-byte aligned
+#
+# frames that are identical to an earlier frame point their table entries at
+# its faces, instead of storing them again
+#
+# the legacy container starts with its fps and gamma as floats.  the magic
+# read as a float is a plausible fps (about 48.83), so the version is checked
+# as well: it is where a legacy file has its gamma, and any gamma that isn't 0
+# or denormal has exponent bits that read as a version of at least 1 << 23
+CUBE_MAGIC = b"LPCB"
+CUBE_VERSION = 2
+CUBE_VERSION_LIMIT = 1 << 23
+CUBE_INDEXED_HEADER = struct.Struct("<4sIffII")
+CUBE_TABLE_ENTRY = struct.Struct("<QQ")
+CUBE_SIGNATURE = struct.Struct("<4sI")
+CUBE_ALIGNMENT = 16
+
+
+def write_cube_header(h, fps, gamma, num_frames):
+    h.write(CUBE_HEADER.pack(fps, gamma, num_frames))
+
+
+def write_cube_face(h, face):
+    """ appends one face's image file (as bytes) to a legacy .cube container """
+    h.write(CUBE_FACE_LENGTH.pack(len(face)))
+    h.write(face)
+
+
+class CubeWriter(object):
+    """ writes an indexed .cube container to a seekable file handle.  the table
+    is reserved up front and filled in by close, so faces can be streamed in as
+    they are rendered.  faces are added in order, frame by frame, in the order
+    of CUBEMAP_FACES """
+
+    def __init__(self, h, fps, gamma, num_frames, num_faces=len(CUBEMAP_FACES)):
+        self.h = h
+        self.num_frames = num_frames
+        self.num_faces = num_faces
+        self.table = [(0, 0)] * (num_frames * num_faces)
+        self.next_face = 0
+
+        self.start = h.tell()
+        h.write(CUBE_INDEXED_HEADER.pack(CUBE_MAGIC, CUBE_VERSION, fps, gamma,
+            num_frames, num_faces))
+        h.write(b"\0" * (CUBE_TABLE_ENTRY.size * len(self.table)))
+
+    def _begin_face(self):
+        if self.next_face >= len(self.table):
+            raise ValueError("the cube only has %d frames" % self.num_frames)
+
+        offset = self.h.tell() - self.start
+        padding = align(offset, CUBE_ALIGNMENT) - offset
+        self.h.write(b"\0" * padding)
+        return offset + padding
+
+    def write_face(self, face):
+        """ appends the next face's image file, as bytes """
+        offset = self._begin_face()
+        self.h.write(face)
+        self.table[self.next_face] = (offset, len(face))
+        self.next_face += 1
+
+    def write_face_file(self, face_h):
+        """ streams the next face's image file in from an open file """
+        offset = self._begin_face()
+        shutil.copyfileobj(face_h, self.h, CUBE_COPY_BUFFER)
+        self.table[self.next_face] = (offset, self.h.tell() - self.start - offset)
+        self.next_face += 1
+
+    def repeat_frame(self, frame):
+        """ adds the next frame as a copy of an earlier one.  its table entries
+        point at the earlier frame's faces, so nothing is written twice """
+        if self.next_face % self.num_faces:
+            raise ValueError("the current frame isn't finished")
+        if frame * self.num_faces >= self.next_face:
+            raise ValueError("frame %d hasn't been written yet" % frame)
+
+        first = frame * self.num_faces
+        for face in range(self.num_faces):
+            self.table[self.next_face] = self.table[first + face]
+            self.next_face += 1
+
+    def close(self):
+        """ writes the table.  faces that were never written are left empty """
+        end = self.h.tell()
+        self.h.seek(self.start + CUBE_INDEXED_HEADER.size)
+        for offset, length in self.table:
+            self.h.write(CUBE_TABLE_ENTRY.pack(offset, length))
+        self.h.seek(end)
+
+
+class CubeFile(object):
+    """ reads an indexed .cube container from a bytes-like object, like an mmap
+    of the file.  faces are returned as memoryviews into it, without copying """
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        (magic, version, self.fps, self.gamma, self.num_frames,
+            self.num_faces) = CUBE_INDEXED_HEADER.unpack_from(self.buf, 0)
+
+        if magic != CUBE_MAGIC:
+            raise ValueError("not an indexed cube file")
+        if version != CUBE_VERSION:
+            raise ValueError("unsupported cube version %d" % version)
+
+        self.table = np.frombuffer(self.buf, dtype="<u8",
+                count=self.num_frames * self.num_faces * 2,
+                offset=CUBE_INDEXED_HEADER.size)
+        self.table = self.table.reshape(self.num_frames, self.num_faces, 2)
+
+    def face(self, frame, face):
+        """ returns one face's image file.  face is an index into
+        CUBEMAP_FACES """
+        offset, length = self.table[frame, face]
+        return self.buf[int(offset):int(offset + length)]
+
+    def frame(self, frame):
+        return [self.face(frame, face) for face in range(self.num_faces)]
+
+
+def read_cube_frame(h, frame):
+    """ reads one frame of an indexed .cube container from a seekable file
+    handle, returning its faces as bytes.  only the header, the frame's row of
+    the table and its faces are read """
+    start = h.tell()
+    (magic, version, fps, gamma, num_frames,
+        num_faces) = CUBE_INDEXED_HEADER.unpack(h.read(CUBE_INDEXED_HEADER.size))
+
+    if magic != CUBE_MAGIC:
+        raise ValueError("not an indexed cube file")
+    if version != CUBE_VERSION:
+        raise ValueError("unsupported cube version %d" % version)
+    if not 0 <= frame < num_frames:
+        raise IndexError("the cube only has %d frames" % num_frames)
+
+    h.seek(start + CUBE_INDEXED_HEADER.size
+            + frame * num_faces * CUBE_TABLE_ENTRY.size)
+    entries = [CUBE_TABLE_ENTRY.unpack(h.read(CUBE_TABLE_ENTRY.size))
+            for _ in range(num_faces)]
+
+    faces = []
+    for offset, length in entries:
+        h.seek(start + offset)
+        faces.append(h.read(length))
+    return faces
+
+
+def is_indexed_cube(h):
+    """ checks whether an open .cube file is indexed, without moving it """
+    pos = h.tell()
+    signature = h.read(CUBE_SIGNATURE.size)
+    h.seek(pos)
+
+    if len(signature) < CUBE_SIGNATURE.size:
+        return False
+    magic, version = CUBE_SIGNATURE.unpack(signature)
+    return magic == CUBE_MAGIC and 0 < version < CUBE_VERSION_LIMIT
+
+
+def read_cube(h):
+    """ reads a .cube container of either layout from a file handle, returning
+    (fps, gamma, frames), where each frame is a list of six face image files as
+    bytes """
+    if is_indexed_cube(h):
+        cube = CubeFile(h.read())
+        frames = [[bytes(face) for face in cube.frame(frame)]
+                for frame in range(cube.num_frames)]
+        return cube.fps, cube.gamma, frames
+
+    fps, gamma, num_frames = CUBE_HEADER.unpack(h.read(CUBE_HEADER.size))
+
+    frames = []
+    for _ in range(num_frames):
+        faces = []
+        for _ in CUBEMAP_FACES:
+            length, = CUBE_FACE_LENGTH.unpack(h.read(CUBE_FACE_LENGTH.size))
+            faces.append(h.read(length))
+        frames.append(faces)
+
+    return fps, gamma, frames
+
+
+def convert_legacy_cube(src_path, dst_path):
+    """ rewrites a legacy .cube container as an indexed one, streaming one face
+    at a time """
+    with open(src_path, "rb") as src:
+        if is_indexed_cube(src):
+            raise ValueError("%s is already indexed" % src_path)
+
+        fps, gamma, num_frames = CUBE_HEADER.unpack(src.read(CUBE_HEADER.size))
+
+        with atomic_write(dst_path, "wb") as dst:
+            writer = CubeWriter(dst, fps, gamma, num_frames)
+            for _ in range(num_frames * len(CUBEMAP_FACES)):
+                length, = CUBE_FACE_LENGTH.unpack(src.read(CUBE_FACE_LENGTH.size))
+                writer.write_face(src.read(length))
+            writer.close()
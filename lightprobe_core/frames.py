@@ -0,0 +1,122 @@
+""" planning which frames of a cubemap sequence need rendering.  a frame whose
+scene signature is the same as the frame before it looks exactly the same from
+the probe, so it can reuse that frame's faces instead of being rendered """
+
+import time
+import hashlib
+import numpy as np
+
+
+# floats in signatures are rounded to this many places, so that float noise in
+# evaluated transforms doesn't count as a change
+SIGNATURE_PRECISION = 6
+
+
+def sequence_frames(start, end, fps, target_fps):
+    """ returns the scene frames to render for a sequence from start to end,
+    played back at target_fps in a scene running at fps """
+    frame_advance = fps / target_fps
+
+    all_frames = [start]
+
+    cur_frame = start
+    last_frame = None
+    while cur_frame < end:
+        cur_frame = cur_frame + frame_advance
+        if int(cur_frame) == last_frame:
+            continue
+
+        all_frames.append(int(cur_frame))
+        last_frame = int(cur_frame)
+
+    return all_frames
+
+
+def signature_digest(values):
+    """ hashes a nested structure of lists, tuples, strings and numbers into a
+    short digest """
+    digest = hashlib.sha1()
+
+    def update(value):
+        if isinstance(value, (list, tuple)):
+            digest.update(b"[")
+            for item in value:
+                update(item)
+            digest.update(b"]")
+        elif isinstance(value, float):
+            digest.update(repr(round(value, SIGNATURE_PRECISION) + 0.0).encode())
+        else:
+            digest.update(repr(value).encode("utf-8"))
+        digest.update(b",")
+
+    update(values)
+    return digest.hexdigest()
+
+
+def vertex_digest(co):
+    """ hashes a flat array of vertex coordinates into a short digest, rounded
+    like the floats of signature_digest.  this catches deformation that keeps
+    an object inside of its bounding box """
+    co = np.round(np.asarray(co, dtype=np.float64), SIGNATURE_PRECISION) + 0.0
+    return hashlib.sha1(co.tobytes()).hexdigest()
+
+
+def plan_frame_sources(frames, signatures):
+    """ returns, for each frame, the frame whose rendered faces it uses: itself
+    if it needs rendering, or the last rendered frame if nothing changed since """
+    sources = []
+    last_signature = None
+
+    for frame, signature in zip(frames, signatures):
+        if sources and signature == last_signature:
+            sources.append(sources[-1])
+        else:
+            sources.append(frame)
+        last_signature = signature
+
+    return sources
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+class ProgressClock(object):
+    """ times a sequence of total items, to report how long each one took and
+    estimate how long the rest will take """
+
+    def __init__(self, total, clock=time.monotonic):
+        self.total = total
+        self.clock = clock
+        self.start = self.last = clock()
+        self.done = 0
+        self.last_duration = None
+
+    def update(self, done):
+        """ records that done items have now finished """
+        now = self.clock()
+        if done > self.done:
+            self.last_duration = (now - self.last) / (done - self.done)
+            self.last = now
+            self.done = done
+
+    def remaining(self):
+        """ the estimated seconds left, from the average time per item so far """
+        if not self.done:
+            return None
+        per_item = (self.last - self.start) / self.done
+        return per_item * (self.total - self.done)
+
+    def status(self, noun="frames"):
+        text = "%d/%d %s" % (self.done, self.total, noun)
+        if self.last_duration is not None:
+            text += ", last took %.1fs" % self.last_duration
+        remaining = self.remaining()
+        if remaining is not None:
+            text += ", %s left" % format_duration(remaining)
+        return text
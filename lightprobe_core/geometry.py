@@ -0,0 +1,339 @@
+""" casting rays out from the center of a probe mesh, and the lookup tables
+built from them """
+
+from collections import namedtuple, OrderedDict
+import hashlib
+import numpy as np
+
+from .sh import sh_sample_grid
+from .lightmap import bilinear_texel_weights
+from .quadrature import quadrature_shape, quadrature_directions
+
+
+FAILSAFE_OFFSET = 0.00001
+
+# how far outside of a triangle, in barycentric coordinates, a ray can pass and
+# still hit it.  rays along a seam of the mesh, like the ones in the x = y
+# plane through the edges of a cube sphere, would otherwise round to just
+# outside of both triangles on either side of it
+EDGE_EPSILON = 1e-9
+
+
+def vec_sub(a, b):
+    return a[0] - b[0], a[1] - b[1], a[2] - b[2]
+
+def vec_dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+def vec_cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2],
+            a[0] * b[1] - a[1] * b[0])
+
+
+# http://en.wikipedia.org/wiki/M%C3%B6ller%E2%80%93Trumbore_intersection_algorithm
+def triangle_intersection(v1, v2, v3, ray, origin):
+    """ performs moller-trumbore ray-triangle intersection and returns
+    barycentric coordinates if an intersection exists, None otherwise """
+
+    epsilon = 0.000001
+    edge1 = vec_sub(v2, v1)
+    edge2 = vec_sub(v3, v1)
+
+    P = vec_cross(ray, edge2)
+    det = vec_dot(edge1, P)
+
+    if det > -epsilon and det < epsilon:
+        return None
+
+    inv_det = 1.0 / det
+    T = vec_sub(origin, v1)
+
+    u = vec_dot(T, P) * inv_det
+
+    if u < -EDGE_EPSILON or u > 1 + EDGE_EPSILON:
+        return None
+
+    Q = vec_cross(T, edge1)
+    v = vec_dot(ray, Q) * inv_det
+
+    if v < -EDGE_EPSILON or u + v > 1 + EDGE_EPSILON:
+        return None
+
+    t = vec_dot(edge2, Q) * inv_det
+
+    if t > epsilon:
+        w = 1 - u - v
+        return u, v, w
+
+    return None
+
+
+class ProbeMeshIndex(object):
+    """ a bounding volume hierarchy over the triangles of a probe mesh, used to
+    cast rays out from the probe's center.  walking every triangle made each ray
+    O(n) in the number of triangles, this makes it O(log n).  the index is in
+    mesh space: our rays all start at the center, so a uniform object scale
+    doesn't change which triangle they hit, or where """
+
+    leaf_size = 4
+
+    def __init__(self, verts, triangles):
+        verts = [tuple(float(c) for c in v) for v in verts]
+
+        # (triangle index, v1, v2, v3).  these get reordered as the tree is
+        # built, so that every node owns a contiguous run of them
+        self.triangles = []
+        for tri_idx, tri in enumerate(triangles):
+            self.triangles.append((tri_idx, verts[tri[0]], verts[tri[1]],
+                verts[tri[2]]))
+
+        # each node is [bbox_min, bbox_max, first, last, left, right].  leaf
+        # nodes have no children, and own triangles[first:last]
+        self.nodes = []
+        if self.triangles:
+            self._build(0, len(self.triangles))
+
+    def _build(self, first, last):
+        tris = self.triangles[first:last]
+        points = [v for tri in tris for v in tri[1:]]
+
+        # pad the boxes slightly, so that rays grazing a box's edge still
+        # reach the triangles inside of it
+        bbox_min = [min(p[axis] for p in points) - FAILSAFE_OFFSET
+                for axis in range(3)]
+        bbox_max = [max(p[axis] for p in points) + FAILSAFE_OFFSET
+                for axis in range(3)]
+
+        node = [bbox_min, bbox_max, first, last, None, None]
+        node_idx = len(self.nodes)
+        self.nodes.append(node)
+
+        if last - first > self.leaf_size:
+            # split at the median triangle along the longest axis
+            axis = max(range(3), key=lambda a: bbox_max[a] - bbox_min[a])
+            tris.sort(key=lambda tri: tri[1][axis] + tri[2][axis] + tri[3][axis])
+            self.triangles[first:last] = tris
+
+            mid = (first + last) // 2
+            node[4] = self._build(first, mid)
+            node[5] = self._build(mid, last)
+
+        return node_idx
+
+    def intersect(self, ray):
+        """ returns the triangle index and barycentric coordinates where a ray
+        from the origin hits the mesh, or (None, None) if it doesn't.  probe
+        meshes are star-shaped around their center, so there is only one hit """
+        origin = (0.0, 0.0, 0.0)
+        stack = [0] if self.nodes else []
+
+        while stack:
+            bbox_min, bbox_max, first, last, left, right = self.nodes[stack.pop()]
+            if not ray_hits_box(ray, bbox_min, bbox_max):
+                continue
+
+            if left is None:
+                for tri_idx, v1, v2, v3 in self.triangles[first:last]:
+                    hit = triangle_intersection(v1, v2, v3, ray, origin)
+                    if hit is not None:
+                        return tri_idx, hit
+            else:
+                stack.append(right)
+                stack.append(left)
+
+        return None, None
+
+    def cast(self, ray):
+        """ like intersect, but never misses """
+        # we extend the ray arbitrarily so it's guaranteed to intersect with
+        # the icosphere, instead of falling short
+        ray = tuple(c * 100 for c in ray)
+        tri_idx, location = self.intersect(ray)
+
+        # a ray through a vertex or along an edge can still round to just
+        # outside of every triangle around it, or a mesh can have a hole.
+        # either way, we take the triangle that the ray passes closest to
+        if tri_idx is None:
+            tri_idx, location = self.closest(ray)
+
+        return tri_idx, location
+
+    def closest(self, ray):
+        """ returns the triangle index and barycentric coordinates of the
+        triangle in front of the origin that a ray passes the least far outside
+        of, clamped onto it.  this walks every triangle, so it is only for rays
+        that intersect missed """
+        origin = (0.0, 0.0, 0.0)
+        best, best_inside, best_loc = None, None, None
+
+        for tri_idx, v1, v2, v3 in self.triangles:
+            edge1 = vec_sub(v2, v1)
+            edge2 = vec_sub(v3, v1)
+            P = vec_cross(ray, edge2)
+            det = vec_dot(edge1, P)
+            if det == 0:
+                continue
+
+            T = vec_sub(origin, v1)
+            Q = vec_cross(T, edge1)
+            if vec_dot(edge2, Q) / det <= 0:
+                continue
+
+            u = vec_dot(T, P) / det
+            v = vec_dot(ray, Q) / det
+            w = 1 - u - v
+            inside = min(u, v, w)
+            if best is None or inside > best_inside:
+                u, v, w = max(u, 0.0), max(v, 0.0), max(w, 0.0)
+                total = u + v + w
+                best, best_inside = tri_idx, inside
+                best_loc = (u / total, v / total, w / total)
+
+        return best, best_loc
+
+
+def ray_hits_box(ray, bbox_min, bbox_max):
+    """ slab test of a ray starting at the origin against an axis-aligned
+    bounding box """
+    t_near, t_far = 0.0, float("inf")
+
+    for axis in range(3):
+        d = ray[axis]
+        if d == 0:
+            if bbox_min[axis] > 0 or bbox_max[axis] < 0:
+                return False
+            continue
+
+        t1 = bbox_min[axis] / d
+        t2 = bbox_max[axis] / d
+        if t1 > t2:
+            t1, t2 = t2, t1
+
+        t_near = max(t_near, t1)
+        t_far = min(t_far, t2)
+        if t_near > t_far:
+            return False
+
+    return True
+
+
+DirectionLUT = namedtuple("DirectionLUT", ["faces", "barycentric", "texels",
+    "texel_weights"])
+
+
+class ProbeMesh(object):
+    """ everything about a probe mesh that determines where a ray from its
+    center lands in its lightmap: (V x 3) vertices, (T x 3) triangle vertex
+    indices and (T x 3 x 2) lightmap uvs for each triangle corner.  the ray
+    casting index and lookup tables are built on first use """
+
+    def __init__(self, verts, triangles, face_uvs):
+        self.verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+        self.triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+        self.face_uvs = np.asarray(face_uvs, dtype=np.float64).reshape(-1, 3, 2)
+        self.key = topology_key(self.verts, self.triangles, self.face_uvs)
+
+        self._index = None
+        self._luts = {}
+        self._quadrature_uvs = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = ProbeMeshIndex(self.verts, self.triangles)
+        return self._index
+
+    def cast_rays(self, dirs):
+        """ casts a ray from the center of the probe along each of the (N x 3)
+        directions, returning the (N) indices of the triangles hit, the (N x 3)
+        barycentric coordinates of the hits and their (N x 2) lightmap uvs """
+        index = self.index
+        faces = np.empty(len(dirs), dtype=np.int64)
+        barycentric = np.empty((len(dirs), 3))
+
+        for i, direction in enumerate(dirs):
+            faces[i], barycentric[i] = index.cast(direction)
+
+        uvs = np.einsum("nk,nkc->nc", barycentric, self.face_uvs[faces])
+        return faces, barycentric, uvs
+
+    def direction_lut(self, width, height, theta_res, phi_res):
+        """ returns the DirectionLUT mapping every direction of a theta/phi
+        sample grid to the triangle it hits, the barycentric coordinates of the
+        hit, and the lightmap texels (and their weights) that are blended for
+        it.  analysing a baked probe is then just a weighted gather """
+        key = (width, height, theta_res, phi_res)
+        lut = self._luts.get(key, None)
+
+        if lut is None:
+            dirs, _, _ = sh_sample_grid(theta_res, phi_res)
+            faces, barycentric, uvs = self.cast_rays(dirs)
+            texels, texel_weights = bilinear_texel_weights(width, height, uvs)
+
+            lut = DirectionLUT(faces, barycentric, texels, texel_weights)
+            self._luts[key] = lut
+
+        return lut
+
+
+    def quadrature_uvs(self, depth, indices):
+        """ returns the (N x 2) lightmap uvs seen through the centers of the
+        adaptive quadrature cells at depth with the given flat indices (see
+        quadrature.quadrature_directions).  adaptive sampling asks for
+        different cells for every probe, so rays are only cast for the cells
+        we haven't seen before, and what they hit is remembered """
+        uvs = self._quadrature_uvs.get(depth, None)
+        if uvs is None:
+            z_res, phi_res = quadrature_shape(depth)
+            uvs = np.full((z_res * phi_res, 2), np.nan)
+            self._quadrature_uvs[depth] = uvs
+
+        indices = np.asarray(indices)
+        missing = np.unique(indices[np.isnan(uvs[indices, 0])])
+        if len(missing):
+            _, _, uvs[missing] = self.cast_rays(quadrature_directions(depth,
+                missing))
+
+        return uvs[indices]
+
+
+def topology_key(verts, triangles, face_uvs):
+    """ returns a hashable key identifying a probe mesh.  since our rays start
+    at the center, a uniform scale doesn't change what they hit, so the vertices
+    are normalized to unit size before hashing """
+    verts = np.asarray(verts, dtype=np.float32)
+    extent = np.abs(verts).max() if len(verts) else 1.0
+
+    # adding zero folds -0.0 into 0.0, so that they hash the same
+    verts = np.round(verts / extent, 5) + 0.0
+
+    digest = hashlib.sha1()
+    digest.update(verts.tobytes())
+    digest.update(np.asarray(triangles, dtype=np.int32).tobytes())
+    digest.update(np.asarray(face_uvs, dtype=np.float32).tobytes())
+
+    return len(verts), len(triangles), digest.hexdigest()
+
+
+# the probe meshes used most recently, by topology_key.  every probe made by
+# the add-on has the same mesh, so only a few are ever in use at once, and the
+# ones left behind by edited meshes fall out instead of holding on to their
+# index and lookup tables for the rest of the session
+_probe_mesh_cache = OrderedDict()
+PROBE_MESH_CACHE_SIZE = 4
+
+def shared_probe_mesh(verts, triangles, face_uvs):
+    """ returns a ProbeMesh for the given geometry, shared with every other
+    probe with the same geometry, so that its index and lookup tables are only
+    built once """
+    mesh = ProbeMesh(verts, triangles, face_uvs)
+    mesh = _probe_mesh_cache.pop(mesh.key, mesh)
+    _probe_mesh_cache[mesh.key] = mesh
+
+    while len(_probe_mesh_cache) > PROBE_MESH_CACHE_SIZE:
+        _probe_mesh_cache.popitem(last=False)
+    return mesh
+
+
+def clear_probe_mesh_cache():
+    _probe_mesh_cache.clear()
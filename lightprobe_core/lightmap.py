@@ -0,0 +1,139 @@
+""" sampling baked lightmaps.  a Lightmap is a flat float buffer of pixels, laid
+out the way blender stores them: rgba rows, starting at the bottom """
+
+from math import ceil
+from collections import namedtuple
+from array import array
+import numpy as np
+
+
+Lightmap = namedtuple("Lightmap", ["width", "height", "channels", "pixels"])
+
+def make_lightmap(width, height, channels, pixels):
+    """ copies any flat sequence of pixels into a Lightmap """
+    return Lightmap(width, height, channels, array("f", pixels))
+
+
+def lightmap_rgb(lightmap):
+    """ returns a (width*height x 3) array view of the lightmap's rgb channels,
+    indexed by y*width + x """
+    pixels = np.frombuffer(lightmap.pixels, dtype=np.float32)
+    pixels = pixels.reshape(-1, lightmap.channels)
+    return pixels[:, :3]
+
+
+def sample_image(channels, width, height, pixel_data, loc):
+    """ samples a blender location at a particular xy integer location """
+    x, y = loc[0], loc[1]
+
+    pix_loc = int((y * width * channels) + x * channels)
+    r = pixel_data[pix_loc + 0]
+    g = pixel_data[pix_loc + 1]
+    b = pixel_data[pix_loc + 2]
+
+    return r, g, b
+
+
+def lerp(a, b, t):
+    return tuple(a_c + (b_c - a_c) * t for a_c, b_c in zip(a, b))
+
+
+def bilinear_interpolate(lightmap, uv):
+    """ performs bilinear interpolation of a lightmap buffer using texture-space
+    uv coordinates.  the boundary conditions are to extend the edges """
+
+    width, height = lightmap.width, lightmap.height
+
+    px_x, px_y = 1.0/width, 1.0/height
+    half_px_x, half_px_y = 1.0/(2*width), 1.0/(2*height)
+
+    left_coord = ceil(width * (uv[0] - half_px_x) - 1)
+    right_coord = ceil(width * (uv[0] + half_px_x) - 1)
+    bottom_coord = ceil(height * (uv[1] - half_px_y) - 1)
+    top_coord = ceil(height * (uv[1] + half_px_y) - 1)
+
+
+    # these are asking how much of 1-pixel (in uv space) has our uv coordinate
+    # traversed, starting at the left/bottom pixel boundary
+    lerp_x = (uv[0] - (left_coord + 0.5) / width) / px_x
+    lerp_y = (uv[1] - (bottom_coord + 0.5) / height) / px_y
+
+
+    # boundary conditions
+    if right_coord + 1 > width:
+        right_coord = left_coord
+
+    if left_coord < 0:
+        left_coord = right_coord
+
+    if top_coord + 1 > height:
+        top_coord = bottom_coord
+
+    if bottom_coord < 0:
+        bottom_coord = top_coord
+
+
+    pixel_data = lightmap.pixels
+    chan = lightmap.channels
+
+    lower_left = sample_image(chan, width, height, pixel_data, (left_coord, bottom_coord))
+    lower_right = sample_image(chan, width, height, pixel_data, (right_coord, bottom_coord))
+    upper_right = sample_image(chan, width, height, pixel_data, (right_coord, top_coord))
+    upper_left = sample_image(chan, width, height, pixel_data, (left_coord, top_coord))
+
+    top = lerp(upper_left, upper_right, lerp_x)
+    bottom = lerp(lower_left, lower_right, lerp_x)
+    return lerp(bottom, top, lerp_y)
+
+
+def bilinear_interpolate_many(lightmap, uvs):
+    """ the batched version of bilinear_interpolate.  takes an (N x 2) array of
+    uv coordinates and returns an (N x 3) array of colors, using the same edge
+    extension """
+    texels, weights = bilinear_texel_weights(lightmap.width, lightmap.height,
+            uvs)
+    return gather_texels(lightmap, texels, weights)
+
+
+def bilinear_texel_weights(width, height, uvs):
+    """ for an (N x 2) array of uv coordinates, returns the (N x 4) indices of
+    the texels that bilinear_interpolate would blend, and their (N x 4)
+    weights.  the texels are ordered lower left, lower right, upper right,
+    upper left """
+    u = uvs[:, 0] * width
+    v = uvs[:, 1] * height
+
+    left = np.ceil(u - 1.5).astype(np.int64)
+    right = np.ceil(u - 0.5).astype(np.int64)
+    bottom = np.ceil(v - 1.5).astype(np.int64)
+    top = np.ceil(v - 0.5).astype(np.int64)
+
+    lerp_x = u - (left + 0.5)
+    lerp_y = v - (bottom + 0.5)
+
+    # boundary conditions, in the same order as bilinear_interpolate
+    right = np.where(right + 1 > width, left, right)
+    left = np.where(left < 0, right, left)
+    top = np.where(top + 1 > height, bottom, top)
+    bottom = np.where(bottom < 0, top, bottom)
+
+    texels = np.column_stack((
+        bottom * width + left,
+        bottom * width + right,
+        top * width + right,
+        top * width + left,
+    ))
+    weights = np.column_stack((
+        (1 - lerp_x) * (1 - lerp_y),
+        lerp_x * (1 - lerp_y),
+        lerp_x * lerp_y,
+        (1 - lerp_x) * lerp_y,
+    ))
+    return texels, weights
+
+
+def gather_texels(lightmap, texels, weights):
+    """ blends the (N x K) texels of a lightmap by their (N x K) weights,
+    returning an (N x 3) array of colors """
+    rgb = lightmap_rgb(lightmap)
+    return np.einsum("nk,nkc->nc", weights, rgb[texels])
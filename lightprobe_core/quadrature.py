@@ -0,0 +1,214 @@
+""" adaptive quadrature for projecting a probe's radiance onto the SH basis.
+
+the sphere is split into cells that are rectangles in (z, phi), where z is
+cos(theta).  that mapping is area preserving, so every cell's solid angle is
+just its area in (z, phi), and a uniform split gives equal area cells, without
+the theta/phi grid's crowding at the poles.  each cell is sampled at its center.
+
+we start from a coarse grid, and only the cells whose estimates are expected to
+be further off than their share of the tolerance are split into four, so the
+samples end up where the lighting has detail.  a base cell is expected to be
+off by as much as its sample differs from its neighbours', since an edge
+between two samples runs through one of their cells.  a split cell is expected
+to be off by what splitting it changed.  neither sees detail that falls
+entirely between samples, so like any sampling, QUADRATURE_BASE_Z and
+QUADRATURE_BASE_PHI set the smallest feature that is reliably found.
+
+every split halves a cell in z and phi, so the cells at each depth are cells of
+a uniform (z, phi) grid, and a cell is an integer (depth, z index, phi index).
+that lets whatever is sampled cache what it finds at each cell's center, the
+same way a probe mesh caches its direction lookup table """
+
+from math import pi
+import numpy as np
+
+from .sh import SH_BANDS, sh_basis
+from .cubemap import SOLID_ANGLE_SCALE
+
+
+# the cells we start with, in z and phi.  each is about a tenth of a
+# steradian, so lighting without much detail only needs a few hundred samples
+QUADRATURE_BASE_Z = 8
+QUADRATURE_BASE_PHI = 16
+
+# how many times a cell can be split.  the finest cells are a 512 x 1024 grid
+QUADRATURE_MAX_DEPTH = 6
+
+# the most of the cells split in each round.  a split can find its cells were
+# less far off than expected, so splitting them a few at a time keeps us from
+# splitting cells that were already good enough
+QUADRATURE_SPLIT_FRACTION = 0.25
+
+
+def quadrature_shape(depth):
+    """ the (z, phi) resolution of the grid of the cells at a depth """
+    return QUADRATURE_BASE_Z << depth, QUADRATURE_BASE_PHI << depth
+
+
+def quadrature_directions(depth, indices):
+    """ returns the (N x 3) unit directions through the centers of the cells
+    at depth with the given flat indices (z index * phi resolution + phi
+    index) """
+    z_res, phi_res = quadrature_shape(depth)
+    z_idx, phi_idx = np.divmod(np.asarray(indices), phi_res)
+    z = (z_idx + 0.5) * (2.0 / z_res) - 1.0
+    phi = (phi_idx + 0.5) * (2 * pi / phi_res)
+    r = np.sqrt(np.maximum(0.0, 1.0 - z * z))
+    return np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+
+
+def cell_indices(cells):
+    """ the flat indices of an (N x 3) array of (depth, z index, phi index)
+    cells, within the grids of their depths """
+    return cells[:, 1] * (QUADRATURE_BASE_PHI << cells[:, 0]) + cells[:, 2]
+
+
+def cell_centers(cells):
+    """ returns the (N x 3) unit directions through the centers of the cells """
+    dirs = np.empty((len(cells), 3))
+    for depth in np.unique(cells[:, 0]):
+        at_depth = cells[:, 0] == depth
+        dirs[at_depth] = quadrature_directions(depth,
+                cell_indices(cells[at_depth]))
+    return dirs
+
+
+def cell_areas(cells):
+    """ the solid angle of each cell """
+    base_area = 4 * pi / (QUADRATURE_BASE_Z * QUADRATURE_BASE_PHI)
+    return base_area / 4.0 ** cells[:, 0]
+
+
+def base_cells():
+    z_idx, phi_idx = np.meshgrid(np.arange(QUADRATURE_BASE_Z),
+            np.arange(QUADRATURE_BASE_PHI), indexing="ij")
+    return np.column_stack((np.zeros(z_idx.size, dtype=np.int64),
+        z_idx.ravel(), phi_idx.ravel()))
+
+
+def base_errors(cells, radiance, bands=SH_BANDS):
+    """ how far off the (N x bands^2 x 3) contributions of the base cells are
+    expected to be, from the (N x 3) radiance at their centers.  an edge in the
+    lighting between a sample and its neighbour's cuts through one of their
+    cells, on average halfway, so each cell is taken to be off by half of its
+    largest difference from its four neighbours.  the neighbour across a pole
+    is the cell half way around it """
+    grid = radiance.reshape(QUADRATURE_BASE_Z, QUADRATURE_BASE_PHI, 3)
+    across_pole = np.roll(grid, QUADRATURE_BASE_PHI // 2, axis=1)
+    neighbours = np.stack((
+        np.concatenate((across_pole[:1], grid[:-1])),
+        np.concatenate((grid[1:], across_pole[-1:])),
+        np.roll(grid, 1, axis=1),
+        np.roll(grid, -1, axis=1))) - grid
+
+    largest = np.abs(neighbours).argmax(axis=0)[np.newaxis]
+    diffs = np.take_along_axis(neighbours, largest, axis=0)[0]
+    return cell_contributions(cells, 0.5 * diffs.reshape(-1, 3), bands)
+
+
+def split_cells(cells):
+    """ splits each of the (N x 3) cells into four, returning (N x 4 x 3)
+    children, so that children[i] are the children of cells[i] """
+    depth, z_idx, phi_idx = cells.T
+    return np.stack([np.column_stack((depth + 1, z_idx * 2 + dz,
+        phi_idx * 2 + dphi)) for dz in (0, 1) for dphi in (0, 1)], axis=1)
+
+
+def sample_cells(sample_fn, cells):
+    """ the (N x 3) radiance at the centers of the cells, asking sample_fn
+    for the cells of each depth at once """
+    radiance = np.empty((len(cells), 3))
+    for depth in np.unique(cells[:, 0]):
+        at_depth = cells[:, 0] == depth
+        radiance[at_depth] = sample_fn(depth, cell_indices(cells[at_depth]))
+    return radiance
+
+
+def cell_contributions(cells, radiance, bands=SH_BANDS):
+    """ returns the (N x bands^2 x 3) contribution of each cell to the
+    coefficients, for the (N x 3) radiance sampled at its center """
+    basis = sh_basis(cell_centers(cells), bands) \
+            * cell_areas(cells)[:, np.newaxis]
+    return basis[:, :, np.newaxis] * radiance[:, np.newaxis, :]
+
+
+def project_sh_adaptive(sample_fn, tolerance, max_samples=None,
+        bands=SH_BANDS, max_depth=QUADRATURE_MAX_DEPTH):
+    """ projects the radiance around a probe onto the SH basis, refining the
+    cells until the coefficients have converged to within tolerance, relative to
+    the largest DC coefficient.  sample_fn(depth, indices) returns the (N x 3)
+    radiance seen through the centers of the cells at depth with those flat
+    indices (see quadrature_directions).  refinement also stops once
+    max_samples have been taken, or every cell is at max_depth.  returns the
+    (bands^2 x 3) coefficient matrix, scaled the same as project_probe's, the
+    number of samples taken, and whether the coefficients converged """
+    cells = base_cells()
+    radiance = sample_cells(sample_fn, cells)
+    contribs = cell_contributions(cells, radiance, bands)
+    errors = base_errors(cells, radiance, bands)
+    num_samples = len(cells)
+
+    while True:
+        coeffs = contribs.sum(axis=0)
+        allowed = tolerance * max(np.abs(coeffs[0]).max(), 1e-12)
+        if expected_error(errors) < allowed:
+            return coeffs * SOLID_ANGLE_SCALE, num_samples, True
+
+        # split the cells expected to be off by more than their share of the
+        # tolerance, furthest off first, and a few at a time, since a split can
+        # find its cells were less far off than expected
+        splittable = np.flatnonzero(cells[:, 0] < max_depth)
+        sizes = error_sizes(errors[splittable])
+        order = splittable[np.argsort(-sizes, kind="stable")]
+        shares = allowed * cell_areas(cells[splittable]) / (4 * pi)
+        num_split = min(max(1, np.count_nonzero(sizes > shares)),
+                max(1, int(QUADRATURE_SPLIT_FRACTION * len(cells))),
+                len(order))
+        if max_samples is not None:
+            num_split = min(num_split, (max_samples - num_samples) // 4)
+        if num_split <= 0:
+            return coeffs * SOLID_ANGLE_SCALE, num_samples, False
+
+        split = np.zeros(len(cells), dtype=bool)
+        split[order[:num_split]] = True
+        children = split_cells(cells[split]).reshape(-1, 3)
+        child_contribs = cell_contributions(children,
+                sample_cells(sample_fn, children), bands)
+        num_samples += len(children)
+
+        # halving smooth lighting's cells quarters their error, so what's left
+        # of it is a third of how much the split changed them.  across an edge
+        # it only halves, but those errors are as likely to be over as under,
+        # and mostly cancel (see expected_error).  a split can also step over
+        # the detail that made a cell look off, so its children keep at least
+        # a quarter of its error
+        num_coeffs = contribs.shape[1]
+        child_sums = child_contribs.reshape(-1, 4, num_coeffs, 3).sum(axis=1)
+        child_errors = (child_sums - contribs[split]) / 3.0
+        inherited = errors[split] / 4.0
+        keep_inherited = error_sizes(inherited) > error_sizes(child_errors)
+        child_errors[keep_inherited] = inherited[keep_inherited]
+
+        keep = ~split
+        cells = np.concatenate((cells[keep], children))
+        contribs = np.concatenate((contribs[keep], child_contribs))
+        errors = np.concatenate((errors[keep],
+            np.repeat(child_errors / 4.0, 4, axis=0)))
+
+
+def error_sizes(errors):
+    """ the largest of each (N x num_coeffs x 3) error's coefficients """
+    return np.abs(errors).max(axis=(1, 2))
+
+
+def expected_error(errors):
+    """ how far off the coefficients are expected to be, given the (N x
+    num_coeffs x 3) signed errors expected of each cell.
+
+    the errors of smooth lighting are alike from cell to cell, and add up,
+    while the errors along an edge in the lighting are as likely to be over
+    as under, and mostly cancel.  so the expected error is the size of their
+    sum, plus their root sum of squares """
+    systematic = np.abs(errors.sum(axis=0)).max()
+    random = np.sqrt((error_sizes(errors) ** 2).sum())
+    return systematic + random
@@ -0,0 +1,557 @@
+""" looking up the lighting anywhere in an exported probe volume, the way a
+runtime does it.  the point is located in the tetrahedralization by walking
+from simplex to simplex through the neighbors, and the SH coefficients of the
+four probes around it are blended by its barycentric coordinates.
+
+a walk starts from the simplex the last query ended in, so queries that move
+smoothly (a character walking through a level) only take a step or two each.
+points outside of the hull are clamped to the closest point on it, and take
+the blend of the probes of that hull facet.  probes on a grid tetrahedralize
+with flat simplices, which only contain the points on their plane, and which
+walks step across to the side of the plane the point is on.  a walk that
+leaves the hull for a point that isn't outside of it falls back to searching
+every simplex.
+
+    volume = load_probe_volume("lightprobes.bin")
+    coeffs = volume.query((1.0, 2.0, 0.5))
+    many_coeffs = volume.query_many(points) """
+
+import json
+from collections import namedtuple
+import numpy as np
+
+from .sh import mapping_to_coeff_matrix
+from .formats import read_lightprobe_arrays, BINARY_MAGIC, BINARY_NO_NEIGHBOR
+
+
+# how far outside of a simplex (in barycentric coordinates) a point can be and
+# still count as inside of it, so that points on a shared facet don't bounce
+# between its simplices
+QUERY_EPSILON = 1e-9
+
+# how small a simplex's volume can be, relative to the cube of its longest
+# edge, before it counts as flat.  delaunay tetrahedralizations of probe grids
+# have flat simplices, spanning 4 probes on a circle of a plane, and probe
+# locations are rounded to float32 when exported
+QUERY_FLATNESS = 1e-6
+
+# how far a probe can be from the plane of a flat simplex, relative to the size
+# of the whole volume, and still count as on it.  this is shared by every flat
+# simplex, since the probes of a grid plane are only coplanar up to float32
+# rounding of their locations, which doesn't shrink with the simplex
+QUERY_PLANE_TOLERANCE = 1e-5
+
+# the neighbor of a hull facet
+NO_NEIGHBOR = -1
+
+# the corners of each edge of a triangle
+TRIANGLE_EDGES = ((0, 1), (1, 2), (2, 0))
+
+# roughly how many point and hull facet pairs are tested at once, when clamping
+# points to the hull
+QUERY_CHUNK_SIZE = 1 << 18
+
+
+def load_probe_volume(filepath):
+    """ loads a ProbeVolume from the light probe json or our binary probe
+    volume format """
+    with open(filepath, "rb") as h:
+        buf = h.read()
+
+    if buf[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return ProbeVolume.from_arrays(read_lightprobe_arrays(buf))
+    return ProbeVolume.from_data(json.loads(buf.decode("utf-8")))
+
+
+class ProbeVolume(object):
+    """ the probes of an exported volume, and their tetrahedralization.
+    locations is (N x 3), coeffs is (N x num_coeffs x 3), simplices is (S x 4)
+    probe indices and neighbors is (S x 4), where neighbors[s][i] is the
+    simplex across the facet of s opposite its ith vertex, or NO_NEIGHBOR """
+
+    def __init__(self, locations, coeffs, simplices, neighbors, names=None):
+        self.locations = np.asarray(locations, dtype=float).reshape(-1, 3)
+        self.coeffs = np.asarray(coeffs, dtype=float)
+        self.simplices = np.asarray(simplices, dtype=np.int64).reshape(-1, 4)
+        self.neighbors = np.asarray(neighbors, dtype=np.int64).reshape(-1, 4)
+        self.names = names
+
+        if not len(self.locations):
+            raise ValueError("the probe volume has no probes")
+
+        corners = self.locations[self.simplices]
+        self.origins, self.inverses = barycentric_transforms(corners)
+        self.flat = flat_simplices(corners, self.simplices, self.neighbors,
+                self.locations)
+        self.flat_index = np.full(len(self.simplices), -1, dtype=np.int64)
+        self.flat_index[self.flat.simplices] = np.arange(
+                len(self.flat.simplices))
+        self.hull = hull_facets(self.simplices, self.neighbors)
+        self.hull_index = np.full(self.neighbors.shape, -1, dtype=np.int64)
+        self.hull_index[self.neighbors == NO_NEIGHBOR] = np.arange(
+                len(self.hull))
+        self.hull_origins, self.hull_normals = hull_planes(self.locations,
+                self.hull)
+
+        # where the next walk starts
+        self.last_simplex = 0
+
+    @classmethod
+    def from_data(cls, data):
+        """ from the structure of the light probe json """
+        probes = data["probes"]
+        neighbors = [[NO_NEIGHBOR if nb is None else nb for nb in cur]
+                for cur in data["neighbors"]]
+        return cls([probe["loc"] for probe in probes],
+                [mapping_to_coeff_matrix(probe["coeffs"]) for probe in probes],
+                data["simplices"], neighbors,
+                [probe["name"] for probe in probes])
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ from read_lightprobe_arrays """
+        neighbors = arrays["neighbors"].astype(np.int64)
+        neighbors[arrays["neighbors"] == BINARY_NO_NEIGHBOR] = NO_NEIGHBOR
+        return cls(arrays["locations"], arrays["coeffs"], arrays["simplices"],
+                neighbors, arrays["names"])
+
+    def barycentric(self, simp_idx, point):
+        """ the 4 barycentric coordinates of a point in a simplex """
+        rest = self.inverses[simp_idx].dot(np.asarray(point) -
+                self.origins[simp_idx])
+        return np.concatenate(([1.0 - rest.sum()], rest))
+
+    def locate(self, point, start=None):
+        """ walks to the simplex containing point, starting from start, or from
+        the simplex of the last query.  returns (probes, weights), the indices
+        of the 4 probes to blend and their weights.  the weights of a point
+        outside of the hull are those of the closest point on the hull """
+        point = np.asarray(point, dtype=float)
+        if not len(self.simplices):
+            probes, weights = self._nearest_probe(point[np.newaxis])
+            return probes[0], weights[0]
+
+        simp_idx = self.last_simplex if start is None else start
+
+        for _ in range(len(self.simplices)):
+            weights = self.barycentric(simp_idx, point)
+            if self.flat_index[simp_idx] >= 0:
+                found, crossing = self._flat_steps(np.array([simp_idx]),
+                        point[np.newaxis], weights[np.newaxis])
+                found, crossing = found[0], crossing[0]
+            else:
+                crossing = weights.argmin()
+                found = weights[crossing] >= -QUERY_EPSILON
+            if found:
+                self.last_simplex = simp_idx
+                return self.simplices[simp_idx], weights
+
+            # step across the facet that the point is furthest behind
+            next_idx = self.neighbors[simp_idx, crossing]
+            if next_idx == NO_NEIGHBOR:
+                self.last_simplex = simp_idx
+                if self._beyond_hull(np.array([simp_idx]),
+                        np.array([crossing]), point[np.newaxis])[0]:
+                    probes, weights = self._clamp_to_hull(point[np.newaxis])
+                else:
+                    probes, weights = self._search(point[np.newaxis])
+                return probes[0], weights[0]
+            simp_idx = next_idx
+
+        probes, weights = self._search(point[np.newaxis])
+        return probes[0], weights[0]
+
+    def query(self, point, start=None):
+        """ returns the (num_coeffs x 3) SH coefficients at point """
+        probes, weights = self.locate(point, start)
+        return np.tensordot(weights, self.coeffs[probes], axes=1)
+
+    def locate_many(self, points, starts=None):
+        """ the batched version of locate, for an (M x 3) array of points.
+        every point walks at once, one step per pass.  starts are the simplices
+        to start each walk from, by default the simplex of the last query.
+        returns (M x 4) probe indices and (M x 4) weights """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if not len(self.simplices):
+            return self._nearest_probe(points)
+
+        if starts is None:
+            starts = np.full(len(points), self.last_simplex, dtype=np.int64)
+        current = np.array(starts, dtype=np.int64)
+
+        probes = np.empty((len(points), 4), dtype=np.int64)
+        weights = np.empty((len(points), 4))
+
+        # the points that are still walking, the ones that left the hull, and
+        # the ones that walked out of it without being outside of it
+        active = np.arange(len(points))
+        outside = []
+        lost = []
+
+        for _ in range(len(self.simplices)):
+            if not len(active):
+                break
+
+            simps = current[active]
+            rest = np.einsum("nij,nj->ni", self.inverses[simps],
+                    points[active] - self.origins[simps])
+            cur_weights = np.column_stack((1.0 - rest.sum(axis=1), rest))
+
+            crossing = cur_weights.argmin(axis=1)
+            found = cur_weights[np.arange(len(active)), crossing] \
+                    >= -QUERY_EPSILON
+
+            flat = self.flat_index[simps] >= 0
+            if flat.any():
+                found[flat], crossing[flat] = self._flat_steps(simps[flat],
+                        points[active[flat]], cur_weights[flat])
+
+            done = active[found]
+            probes[done] = self.simplices[simps[found]]
+            weights[done] = cur_weights[found]
+
+            next_simps = self.neighbors[simps, crossing]
+            exited = ~found & (next_simps == NO_NEIGHBOR)
+            beyond = self._beyond_hull(simps[exited], crossing[exited],
+                    points[active[exited]])
+            outside.append(active[exited][beyond])
+            lost.append(active[exited][~beyond])
+
+            walking = ~found & ~exited
+            current[active[walking]] = next_simps[walking]
+            active = active[walking]
+
+        # walks that went on for too long, or left the hull through a facet
+        # that the point isn't outside of, which can only happen on badly
+        # shaped simplices, fall back to searching all of them
+        lost = np.concatenate(lost + [active])
+        if len(lost):
+            probes[lost], weights[lost] = self._search(points[lost])
+
+        outside = np.concatenate(outside) if outside else np.zeros(0, np.int64)
+        if len(outside):
+            probes[outside], weights[outside] = \
+                    self._clamp_to_hull(points[outside])
+
+        self.last_simplex = int(current[-1]) if len(current) else \
+                self.last_simplex
+        return probes, weights
+
+    def query_many(self, points, starts=None):
+        """ returns the (M x num_coeffs x 3) SH coefficients at each of the
+        (M x 3) points """
+        probes, weights = self.locate_many(points, starts)
+        return np.einsum("mk,mkcr->mcr", weights, self.coeffs[probes])
+
+    def _search(self, points):
+        """ finds the simplex containing each point by testing all of them,
+        clamping the points outside of the hull to it.  a point inside of the
+        hull that no simplex contains to within QUERY_EPSILON, which rounding
+        can leave on the facets between nearly flat simplices, takes the
+        simplex it is the least outside of """
+        probes = np.empty((len(points), 4), dtype=np.int64)
+        weights = np.empty((len(points), 4))
+
+        # flat simplices only contain the points on their plane
+        flat = self.flat
+        flat_idxs = np.arange(len(flat.simplices))
+
+        missing = []
+        for idx, point in enumerate(points):
+            rest = np.einsum("nij,nj->ni", self.inverses,
+                    point - self.origins)
+            all_weights = np.column_stack((1.0 - rest.sum(axis=1), rest))
+            closest = all_weights.min(axis=1)
+            on_plane = self._on_plane(flat_idxs,
+                    np.tile(point, (len(flat_idxs), 1)))[0]
+            closest[flat.simplices[~on_plane]] = -np.inf
+
+            best = closest.argmax()
+            if closest[best] >= -QUERY_EPSILON or \
+                    not self._outside_hull(point):
+                probes[idx] = self.simplices[best]
+                weights[idx] = all_weights[best]
+            else:
+                missing.append(idx)
+
+        if missing:
+            probes[missing], weights[missing] = \
+                    self._clamp_to_hull(points[missing])
+        return probes, weights
+
+    def _on_plane(self, flat_idxs, points):
+        """ whether each of the points is on the plane of its flat simplex """
+        flat = self.flat
+        heights = np.einsum("ni,ni->n", flat.normals[flat_idxs],
+                points - flat.centers[flat_idxs])
+        return np.abs(heights) <= flat.thickness[flat_idxs], heights
+
+    def _flat_steps(self, simps, points, weights):
+        """ the walk through flat simplices, given the (N) simplices, the
+        (N x 3) points walking through them and their (N x 4) weights in them.
+        a flat simplex only contains the points on its plane, where the weights
+        are those of the point's projection onto it.  any other point steps
+        across the plane, through the facet on its side whose triangle it is
+        over.  returns whether each point was found, and the facet to cross """
+        flat = self.flat
+        flat_idxs = self.flat_index[simps]
+        on_plane, heights = self._on_plane(flat_idxs, points)
+        found = on_plane & (weights.min(axis=1) >= -QUERY_EPSILON)
+
+        # every facet of a flat simplex is on its plane, so its weights are
+        # taken over the facet's triangle alone
+        rest = np.einsum("nfij,nfj->nfi", flat.facet_inverses[flat_idxs],
+                points[:, np.newaxis] - flat.facet_origins[flat_idxs])
+        facet_weights = np.minimum(1.0 - rest[:, :, 0] - rest[:, :, 1],
+                np.minimum(rest[:, :, 0], rest[:, :, 1]))
+
+        sides = np.where(on_plane, 0, np.sign(heights)).astype(np.int64)
+        sides = sides[:, np.newaxis]
+        facet_sides = flat.facet_sides[flat_idxs]
+        # a walk only leaves the hull through a flat simplex when the point is
+        # on the outside of its plane
+        on_hull = self.neighbors[simps] == NO_NEIGHBOR
+        facing = (facet_sides == sides) | (~on_hull & ((facet_sides == 0)
+            | (sides == 0)))
+        crossing = np.where(facing, facet_weights, -np.inf).argmax(axis=1)
+        return found, crossing
+
+    def _beyond_hull(self, simps, crossings, points):
+        """ whether each of the points is outside of the plane of the hull
+        facet it is leaving through, the one of the simplex opposite its
+        crossing vertex.  the hull is convex, so those points are outside of
+        it, and any others are still inside """
+        facets = self.hull_index[simps, crossings]
+        heights = np.einsum("ni,ni->n", self.hull_normals[facets],
+                points - self.hull_origins[facets])
+        return heights > 0
+
+    def _outside_hull(self, point):
+        """ whether the point is outside of the plane of any hull facet """
+        heights = np.einsum("ni,ni->n", self.hull_normals,
+                point - self.hull_origins)
+        return len(heights) > 0 and heights.max() > 0
+
+    def _clamp_to_hull(self, points):
+        """ the probes and weights of the closest point on the hull to each of
+        the points, which blends the 3 probes of a hull facet.  the 4th probe
+        is given a weight of 0 """
+        probes = np.empty((len(points), 4), dtype=np.int64)
+        weights = np.zeros((len(points), 4))
+
+        # every point is tested against every facet, a chunk of points at a
+        # time to keep the temporary arrays small
+        corners = self.locations[self.hull]
+        chunk = max(1, QUERY_CHUNK_SIZE // max(1, len(corners)))
+        for start in range(0, len(points), chunk):
+            end = start + chunk
+            facets, facet_weights = closest_hull_points(points[start:end],
+                    corners)
+            probes[start:end, :3] = self.hull[facets]
+            probes[start:end, 3] = self.hull[facets, 0]
+            weights[start:end, :3] = facet_weights
+
+        return probes, weights
+
+    def _nearest_probe(self, points):
+        """ with fewer than 4 probes there's nothing to blend between, so every
+        point takes the probe closest to it """
+        dists = ((points[:, np.newaxis] - self.locations) ** 2).sum(axis=2)
+        nearest = dists.argmin(axis=1)
+
+        probes = np.repeat(nearest[:, np.newaxis], 4, axis=1)
+        weights = np.zeros((len(points), 4))
+        weights[:, 0] = 1.0
+        return probes, weights
+
+
+FlatSimplices = namedtuple("FlatSimplices", ["simplices", "centers",
+    "normals", "thickness", "facet_origins", "facet_inverses", "facet_sides"])
+
+
+def barycentric_transforms(corners):
+    """ for an (S x 4 x 3) array of simplex corners, returns the first corner
+    of each and the (S x 3 x 3) matrices taking a point's offset from it to
+    the barycentric coordinates of the other three corners.  flat simplices
+    have no such matrix, and get the one that takes a point to the
+    coordinates of its projection onto their plane instead.  those only mean
+    anything for points on the plane, which is all that flat simplices contain
+    (see flat_simplices) """
+    origins = corners[:, 0]
+    edges = np.transpose(corners[:, 1:] - origins[:, np.newaxis], (0, 2, 1))
+
+    inverses = np.empty_like(edges)
+    flat = is_flat(corners)
+    if (~flat).any():
+        inverses[~flat] = np.linalg.inv(edges[~flat])
+    if flat.any():
+        # the pseudo-inverse, leaving out the direction the simplex is flat in
+        u, sigma, vt = np.linalg.svd(edges[flat])
+        inverses[flat] = np.einsum("nki,nk,njk->nij", vt[:, :2],
+                1.0 / sigma[:, :2], u[:, :, :2])
+    return origins, inverses
+
+
+def longest_edges(corners):
+    """ the length of the longest edge of each of the (S x 4 x 3) simplices """
+    return np.sqrt(((corners[:, :, np.newaxis] - corners[:, np.newaxis])
+        ** 2).sum(axis=3)).max(axis=(1, 2))
+
+
+def is_flat(corners):
+    """ whether each of the (S x 4 x 3) simplices is too flat to invert """
+    edges = corners[:, 1:] - corners[:, 0, np.newaxis]
+    return np.abs(np.linalg.det(edges)) \
+            <= QUERY_FLATNESS * longest_edges(corners) ** 3
+
+
+def flat_simplices(corners, simplices, neighbors, locations):
+    """ returns the FlatSimplices of the (S x 4 x 3) simplex corners: their
+    simplex indices, the center, normal and thickness of their plane, and for
+    each of their facets, the transform taking a point's offset from the
+    facet's first corner to its weights over the facet's triangle (and its
+    height above the plane), and which side of the plane the simplex across
+    the facet is on.  a flat simplex is between the simplices on either side
+    of its plane that triangulate the same probes two different ways, and
+    hull facets are on the other side from the simplices behind them """
+    simp_idxs = np.flatnonzero(is_flat(corners))
+    flat_corners = corners[simp_idxs]
+    centers = flat_corners.mean(axis=1)
+
+    # the plane closest to the corners, which are at most thickness from it
+    offsets = flat_corners - centers[:, np.newaxis]
+    normals = np.linalg.svd(offsets)[2][:, 2]
+    thickness = np.abs(np.einsum("nki,ni->nk", offsets, normals)).max(axis=1) \
+            + QUERY_EPSILON * longest_edges(flat_corners)
+
+    # probes closer than this to a plane are on it.  this is measured against
+    # the whole volume, not the simplex's own corners, which can be coplanar to
+    # far better than the probes of the flat simplices next to them
+    tolerance = QUERY_PLANE_TOLERANCE * volume_size(locations)
+
+    facet_origins = np.empty((len(simp_idxs), 4, 3))
+    facet_inverses = np.empty((len(simp_idxs), 4, 3, 3))
+    facet_sides = np.zeros((len(simp_idxs), 4), dtype=np.int64)
+
+    for idx, simp_idx in enumerate(simp_idxs):
+        simp = simplices[simp_idx]
+        for vert_idx in range(4):
+            facet = np.delete(flat_corners[idx], vert_idx, axis=0)
+            facet_origins[idx, vert_idx] = facet[0]
+            facet_inverses[idx, vert_idx] = np.linalg.pinv(np.column_stack(
+                (facet[1] - facet[0], facet[2] - facet[0], normals[idx])))
+
+            nb = neighbors[simp_idx, vert_idx]
+            if nb != NO_NEIGHBOR:
+                apex = [vert for vert in simplices[nb] if vert not in simp]
+                height = normals[idx].dot(locations[apex[0]] - centers[idx])
+                if abs(height) > max(thickness[idx], tolerance):
+                    facet_sides[idx, vert_idx] = np.sign(height)
+
+        # a flat simplex with a facet on the hull lies in a plane of the hull,
+        # which has every probe on its inside
+        on_hull = neighbors[simp_idx] == NO_NEIGHBOR
+        if on_hull.any():
+            heights = (locations - centers[idx]).dot(normals[idx])
+            furthest = heights[np.abs(heights).argmax()]
+            if abs(furthest) > tolerance:
+                facet_sides[idx, on_hull] = -np.sign(furthest)
+
+    return FlatSimplices(simp_idxs, centers, normals, thickness,
+            facet_origins, facet_inverses, facet_sides)
+
+
+def volume_size(locations):
+    """ the size of the probe volume, for tolerances that have to cover the
+    rounding of its probe locations.  that rounding grows with how far the
+    probes are from the origin, as well as with how far apart they are """
+    return np.abs(locations).max() + np.ptp(locations, axis=0).max()
+
+
+def hull_facets(simplices, neighbors):
+    """ returns the (F x 3) probe indices of every facet on the hull """
+    simp_idxs, vert_idxs = np.nonzero(neighbors == NO_NEIGHBOR)
+    facets = np.empty((len(simp_idxs), 3), dtype=np.int64)
+    for idx, (simp_idx, vert_idx) in enumerate(zip(simp_idxs, vert_idxs)):
+        facets[idx] = np.delete(simplices[simp_idx], vert_idx)
+    return facets
+
+
+def hull_planes(locations, hull):
+    """ returns a corner of each of the (F x 3) hull facets and the normal of
+    its plane, pointing out of the hull.  the hull is convex, so the middle of
+    all of the probes is on the inside of every facet.  facets with no area
+    get a normal of 0, which no point is outside of """
+    corners = locations[hull]
+    normals = np.cross(corners[:, 1] - corners[:, 0],
+            corners[:, 2] - corners[:, 0])
+    lengths = np.sqrt((normals * normals).sum(axis=1))
+    edges = corners - np.roll(corners, 1, axis=1)
+    has_area = lengths > QUERY_EPSILON * (edges * edges).sum(axis=2).max(axis=1)
+    normals[has_area] /= lengths[has_area, np.newaxis]
+    normals[~has_area] = 0.0
+
+    inward = locations.mean(axis=0) - corners[:, 0]
+    normals[np.einsum("ni,ni->n", normals, inward) > 0] *= -1
+    return corners[:, 0], normals
+
+
+def closest_hull_points(points, triangles):
+    """ finds the closest point to each of the (M x 3) points on any of the
+    (F x 3 x 3) triangles.  returns the (M) indices of the triangles they are
+    on and their (M x 3) barycentric weights on them.  on each triangle, the
+    closest point is the projection onto its plane if that lands inside of it,
+    otherwise the closest point on one of its edges """
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    ab, ac = b - a, c - a
+    ap = points[:, np.newaxis] - a
+
+    # the projection onto the plane, by solving for its weights of b and c.
+    # its squared distance falls out of the same dot products
+    d00 = (ab * ab).sum(axis=1)
+    d01 = (ab * ac).sum(axis=1)
+    d11 = (ac * ac).sum(axis=1)
+    d20 = (ap * ab).sum(axis=2)
+    d21 = (ap * ac).sum(axis=2)
+    denom = d00 * d11 - d01 * d01
+    degenerate = denom <= QUERY_EPSILON * (d00 * d11)
+    denom[degenerate] = 1.0
+    v = (d11 * d20 - d01 * d21) / denom
+    w = (d00 * d21 - d01 * d20) / denom
+
+    # triangles with no area, of 3 probes on a line, only have their edges
+    inside = (v >= 0) & (w >= 0) & (v + w <= 1) & ~degenerate
+    dists = [np.where(inside, (ap * ap).sum(axis=2) - v * d20 - w * d21,
+        np.inf)]
+    edge_ts = []
+
+    # otherwise the closest point on one of the edges
+    for i, j in TRIANGLE_EDGES:
+        edge = triangles[:, j] - triangles[:, i]
+        length2 = (edge * edge).sum(axis=1)
+        length2[length2 == 0] = 1.0
+        offset = points[:, np.newaxis] - triangles[:, i]
+        along = (offset * edge).sum(axis=2)
+        t = np.clip(along / length2, 0.0, 1.0)
+        edge_ts.append(t)
+        dists.append((offset * offset).sum(axis=2) - 2 * t * along
+                + t * t * length2)
+
+    # the closest candidate on each triangle, then the closest triangle
+    dists = np.stack(dists, axis=2)
+    rows = np.arange(len(points))
+    facets = dists.min(axis=2).argmin(axis=1)
+    choice = dists[rows, facets].argmin(axis=1)
+
+    weights = np.zeros((len(points), 3))
+    on_plane = choice == 0
+    v, w = v[rows, facets][on_plane], w[rows, facets][on_plane]
+    weights[on_plane] = np.column_stack((1.0 - v - w, v, w))
+
+    for edge_idx, (i, j) in enumerate(TRIANGLE_EDGES):
+        on_edge = choice == edge_idx + 1
+        t = edge_ts[edge_idx][rows, facets][on_edge]
+        weights[on_edge, i] = 1.0 - t
+        weights[on_edge, j] = t
+
+    return facets, weights
@@ -0,0 +1,228 @@
+""" spherical harmonics: the basis functions, projecting radiance onto them, and
+converting between our coefficient representations """
+
+from math import sin, cos, sqrt, pi, factorial
+import numpy as np
+
+
+# the default number of bands: L0 through L2, 9 coefficients
+SH_BANDS = 3
+
+# the most bands the add-on offers.  the basis works for any number of them
+SH_MAX_BANDS = 5
+
+
+def sh_coeff_order(bands=SH_BANDS):
+    """ the (l, m) of each coefficient, in the order of the columns of our
+    batched SH basis matrix.  the coefficient of (l, m) is at l*l + l + m """
+    return [(l, m) for l in range(bands) for m in range(-l, l + 1)]
+
+
+# the order of the default bands
+SH_COEFF_ORDER = sh_coeff_order()
+
+
+def sh_num_bands(num_coeffs):
+    """ the number of bands of num_coeffs coefficients """
+    bands = int(round(sqrt(num_coeffs)))
+    if bands * bands != num_coeffs:
+        raise ValueError("%d isn't a whole number of SH bands" % num_coeffs)
+    return bands
+
+
+def double_factorial(n):
+    result = 1
+    while n > 1:
+        result *= n
+        n -= 2
+    return result
+
+
+def sh_normalization(l, m):
+    """ the normalization constant of the real SH function (l, m), including
+    the sqrt(2) of the m != 0 functions """
+    m = abs(m)
+    k = sqrt((2 * l + 1) / (4 * pi) * factorial(l - m) / float(factorial(l + m)))
+    return k * sqrt(2) if m else k
+
+
+def spherical_harmonic(l, m, theta, phi):
+    """ evaluates the real SH function (l, m) at a spherical coordinate.  the
+    scalar reference version of sh_basis, and like it, without the
+    condon-shortley phase, so that (1, 1) is positive along +x """
+    am = abs(m)
+    z = cos(theta)
+
+    # the associated legendre polynomial P_l^|m|(z), by recurrence in l
+    p_prev = 0.0
+    p = double_factorial(2 * am - 1) * sin(theta) ** am
+    for cur_l in range(am + 1, l + 1):
+        p, p_prev = ((2 * cur_l - 1) * z * p - (cur_l + am - 1) * p_prev) \
+                / (cur_l - am), p
+
+    if m > 0:
+        p *= cos(m * phi)
+    elif m < 0:
+        p *= sin(am * phi)
+    return sh_normalization(l, m) * p
+
+
+def angle_to_ray(theta, phi):
+    """ converts a spherical coordinate to cartesian coordinate """
+    x = sin(theta) * cos(phi)
+    y = sin(theta) * sin(phi)
+    z = cos(theta)
+    length = sqrt(x*x + y*y + z*z)
+    return x / length, y / length, z / length
+
+
+_sh_grid_cache = {}
+
+def sh_sample_grid(theta_res, phi_res, bands=SH_BANDS):
+    """ returns the (N x 3) sample directions, the (N x bands^2) SH basis
+    evaluated at those directions, and the (N) sample weights of a theta/phi
+    grid.  the grid only depends on the resolutions, so it is built once and
+    cached """
+    key = (theta_res, phi_res, bands)
+    grid = _sh_grid_cache.get(key, None)
+    if grid is None:
+        theta = pi * np.arange(theta_res) / float(theta_res)
+        phi = pi * 2 * np.arange(phi_res) / float(phi_res)
+        theta, phi = np.meshgrid(theta, phi, indexing="ij")
+        theta, phi = theta.ravel(), phi.ravel()
+
+        dirs = np.column_stack((np.sin(theta) * np.cos(phi),
+            np.sin(theta) * np.sin(phi), np.cos(theta)))
+        weights = np.sin(theta) / float(theta_res * phi_res)
+
+        grid = (dirs, sh_basis(dirs, bands), weights)
+        _sh_grid_cache[key] = grid
+    return grid
+
+
+def sh_basis(dirs, bands=SH_BANDS):
+    """ evaluates every SH function of the first bands bands for an (N x 3)
+    array of unit directions, returning an (N x bands^2) matrix in
+    sh_coeff_order.  the functions are built up by recurrence, in cartesian
+    form, so each coefficient costs a couple of multiplies per direction:
+
+        Y(l, m) = K(l, m) * Q(l, |m|)(z) * (re or im of (x + iy)^|m|)
+
+    where Q(l, m) is the associated legendre polynomial P_l^m with its factor
+    of sin(theta)^m taken out, since that is folded into (x + iy)^m """
+    x, y, z = dirs[:, 0], dirs[:, 1], dirs[:, 2]
+    basis = np.empty((len(dirs), bands * bands))
+
+    # the real and imaginary parts of (x + iy)^m
+    re = np.ones_like(x)
+    im = np.zeros_like(x)
+
+    for m in range(bands):
+        if m:
+            re, im = x * re - y * im, x * im + y * re
+
+        q_prev = None
+        q = np.full_like(z, double_factorial(2 * m - 1))
+        for l in range(m, bands):
+            if l == m + 1:
+                q, q_prev = (2 * m + 1) * z * q, q
+            elif l > m + 1:
+                q, q_prev = ((2 * l - 1) * z * q - (l + m - 1) * q_prev) \
+                        / (l - m), q
+
+            k = sh_normalization(l, m)
+            if m:
+                basis[:, l * l + l + m] = k * q * re
+                basis[:, l * l + l - m] = k * q * im
+            else:
+                basis[:, l * l + l] = k * q
+
+    return basis
+
+
+def project_sh(radiance, basis, weights):
+    """ projects an (N x 3) radiance array onto the SH basis, returning a
+    (bands^2 x 3) coefficient matrix ordered by sh_coeff_order """
+    return basis.T.dot(radiance * weights[:, np.newaxis])
+
+
+def project_sh_scalar(sample_fn, theta_res, phi_res, keys=None):
+    """ the scalar reference version of sh_sample_grid and project_sh.
+    sample_fn(theta, phi) returns the rgb radiance seen in that direction.
+    theta_res and phi_res are the sampling resolutions for theta (zenith) and
+    phi (azimuth) respectively.  theta ranges from 0-pi, while phi ranges from
+    0-2pi.  each direction is only sampled once, and its color is accumulated
+    into every coefficient in keys (the default bands, by default) """
+    if keys is None:
+        keys = SH_COEFF_ORDER
+
+    accum = dict((key, [0.0, 0.0, 0.0]) for key in keys)
+    num_samples = float(theta_res * phi_res)
+
+    for theta in (pi * y / float(theta_res) for y in range(theta_res)):
+        weight = sin(theta) / num_samples
+        for phi in (pi * 2 * x / float(phi_res) for x in range(phi_res)):
+            color = sample_fn(theta, phi)
+            for (l, m) in keys:
+                h = spherical_harmonic(l, m, theta, phi) * weight
+                c = accum[(l, m)]
+                c[0] += color[0] * h
+                c[1] += color[1] * h
+                c[2] += color[2] * h
+
+    mapping = {}
+    for (l, m), c in accum.items():
+        mapping.setdefault(l, {})[m] = tuple(c)
+    return mapping
+
+
+def mapping_to_coeff_matrix(mapping):
+    """ the inverse of coeff_matrix_to_mapping.  mappings that have been
+    through json have string keys, so we accept those as well """
+    coeffs = []
+    for l, m in sh_coeff_order(len(mapping)):
+        mdata = mapping[l] if l in mapping else mapping[str(l)]
+        coeffs.append(mdata[m] if m in mdata else mdata[str(m)])
+    return np.array(coeffs, dtype=float)
+
+
+def coeff_matrix_to_mapping(coeffs):
+    """ converts a (bands^2 x 3) coefficient matrix to our {l: {m: (r, g, b)}}
+    mapping """
+    mapping = {}
+    for (l, m), color in zip(sh_coeff_order(sh_num_bands(len(coeffs))),
+            coeffs):
+        mapping.setdefault(l, {})[m] = tuple(float(c) for c in color)
+    return mapping
+
+
+def resize_coeff_matrix(coeffs, bands):
+    """ returns a coefficient matrix with bands bands.  dropping bands leaves
+    the ones below them as they were, and missing bands are zero, so probes
+    baked with different numbers of bands can be exported together """
+    num_coeffs = bands * bands
+    resized = np.zeros((num_coeffs, 3))
+    resized[:min(num_coeffs, len(coeffs))] = coeffs[:num_coeffs]
+    return resized
+
+
+def get_glsl_coefficients(coeffs):
+    """ a convenience function for testing SH coefficients in the shader
+    provided by the opengl orange book, second edition.  the constants are
+    declared in sh_coeff_order, for as many bands as coeffs has """
+
+    tmpl = "const vec3 L%d%s%d = vec3(%f, %f, %f);"
+    lines = []
+
+    for l, m in sh_coeff_order(len(coeffs)):
+        mdata = coeffs[l] if l in coeffs else coeffs[str(l)]
+        color = mdata[m] if m in mdata else mdata[str(m)]
+
+        sign = ""
+        if m < 0:
+            sign = "m"
+
+        line = tmpl % (l, sign, abs(m), color[0], color[1], color[2])
+        lines.append(line)
+
+    return "\n".join(lines)
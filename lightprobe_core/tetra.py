@@ -0,0 +1,588 @@
+""" delaunay tetrahedralization of probe locations, and the neighbor structure
+that a runtime uses to walk between simplices """
+
+import itertools
+from pyhull.delaunay import DelaunayTri as Delaunay
+
+
+def simplex_facet(simp, vert_idx_idx):
+    """ the hashable facet of a simplex opposite one of its vertices """
+    facet = list(simp)
+    facet.pop(vert_idx_idx)
+    return tuple(sorted(facet))
+
+
+def facet_owners(simplices):
+    """ maps the hashable facets of simplices to the indices of the simplices
+    that have them """
+    owners = {}
+    for simp_idx, simp in enumerate(simplices):
+        for vert_idx_idx in range(len(simp)):
+            owners.setdefault(simplex_facet(simp, vert_idx_idx), []).append(
+                    simp_idx)
+    return owners
+
+
+def build_neighbors(simplices):
+    """ builds our neighbor structure, where neighbors[i][j] is the index of the
+    simplex sharing the facet of simplex i that is opposite its jth vertex, or
+    None if that facet is on the hull.  every facet is hashed to the simplices
+    that own it, so this is linear in the number of simplices, instead of
+    comparing every facet against every other simplex """
+    owners = facet_owners(simplices)
+
+    neighbors = []
+    for simp_idx, simp in enumerate(simplices):
+        cur_neighbors = []
+        neighbors.append(cur_neighbors)
+
+        for vert_idx_idx in range(len(simp)):
+            facet = simplex_facet(simp, vert_idx_idx)
+
+            # owners are in ascending order, so if a facet is somehow shared
+            # by more than two simplices, we pick the lowest index, the same
+            # as a linear search would
+            neighbor = None
+            for owner in owners[facet]:
+                if owner != simp_idx:
+                    neighbor = owner
+                    break
+
+            cur_neighbors.append(neighbor)
+
+    return neighbors
+
+
+# the last tetrahedralization of each scene, so that the next export only has
+# to update the probes that changed
+_tetrahedralization_cache = {}
+
+# past this fraction of the probes being added, removed or moved, a full
+# rebuild is cheaper than updating the tetrahedralization one probe at a time
+MAX_INCREMENTAL_CHANGES = 0.1
+
+# how many times the hole left by a removed point can grow across the ties of
+# cospherical points before we give up and rebuild
+MAX_HOLE_GROWTH = 4
+
+
+def tetrahedralize(cache_key, keys, points):
+    """ returns the delaunay simplices and our neighbor structure for a list of
+    points, each identified by a stable key (the probe's object name).  the
+    previous tetrahedralization under cache_key is updated incrementally if only
+    a few points were added, removed or moved, otherwise it is rebuilt """
+    tetra = _tetrahedralization_cache.pop(cache_key, None)
+
+    if tetra is not None:
+        try:
+            tetra.update(keys, points)
+        except IncrementalUpdateError:
+            tetra = None
+
+    if tetra is None:
+        tetra = Tetrahedralization(keys, points)
+
+    _tetrahedralization_cache[cache_key] = tetra
+    return tetra.export(keys)
+
+
+def clear_tetrahedralization_cache():
+    _tetrahedralization_cache.clear()
+
+
+class IncrementalUpdateError(Exception):
+    """ raised when a tetrahedralization can't be updated in place, and needs a
+    full rebuild """
+
+
+class Tetrahedralization(object):
+    """ a delaunay tetrahedralization that can be updated in place.  points are
+    addressed by a stable key, and stored in slots that never move, so that
+    simplices don't need renumbering as points come and go.  removed points
+    leave their slot empty, and export compacts everything back down.
+
+    points are inserted with bowyer-watson, and removed by re-triangulating the
+    hole they leave behind from its boundary vertices.  every update is checked
+    to exactly fill the region it replaced, and raises IncrementalUpdateError
+    when it doesn't (or when it can't be done locally, like points on or outside
+    of the hull), so the caller can fall back to a full rebuild.
+
+    probes are usually laid out in regular grids, which are full of cospherical
+    points.  those have no unique delaunay tetrahedralization, and qhull splits
+    them up into simplices that include flat ones, with all four points on a
+    plane.  we keep those as they are, so a full rebuild is exactly qhull's
+    tetrahedralization of the points.  flat simplices have no circumsphere and
+    contain nothing, so they join the region an insert replaces whenever they
+    touch it, and a walk steps across them to the side the point is on.  the
+    hole a removed point leaves can split its ties differently than qhull did,
+    which flat simplices join back up, or the hole grows until they're inside
+    of it """
+
+    # how small a simplex can be, relative to the extent of the points, before
+    # it counts as flat
+    flatness = 1e-10
+
+    def __init__(self, keys, points):
+        extent = 0
+        if points:
+            extent = max(max(point[axis] for point in points)
+                    - min(point[axis] for point in points) for axis in range(3))
+        extent = extent or 1.0
+        self.flat_orient = self.flatness * extent ** 3
+        self.flat_offset = self.flatness ** 0.5 * extent
+
+        self.slots = {}
+        self.points = []
+        for key, point in zip(keys, points):
+            self._add_point(key, point)
+
+        self.simplices = [list(simp) for simp in Delaunay(self.points).vertices]
+        self.neighbors = build_neighbors(self.simplices)
+
+        # some simplex touching each slot, and the last simplex created, for
+        # starting searches
+        self.last_simplex = None
+        self.vertex_simplex = {}
+        for simp_idx, simp in enumerate(self.simplices):
+            for slot in simp:
+                self.vertex_simplex[slot] = simp_idx
+
+    def update(self, keys, points):
+        """ brings the tetrahedralization up to date with a new set of keyed
+        points """
+        points = dict((key, tuple(point)) for key, point in zip(keys, points))
+
+        removed = [key for key in self.slots if key not in points]
+        added = [key for key in points if key not in self.slots]
+        moved = [key for key, slot in self.slots.items()
+                if key in points and points[key] != self.points[slot]]
+
+        num_changes = len(removed) + len(added) + len(moved)
+        if num_changes > MAX_INCREMENTAL_CHANGES * len(points):
+            raise IncrementalUpdateError("too many changes")
+
+        # points on the hull can't be removed in place, and points outside of
+        # it can't be inserted, so we look for those before changing anything.
+        # the points that are removed are all inside, so the hull we check
+        # against stays the same
+        for key in removed + moved:
+            if self._on_hull(self.slots[key]):
+                raise IncrementalUpdateError("point is on the hull")
+        for key in moved + added:
+            self._locate(points[key])
+
+        for key in removed + moved:
+            self.remove(key)
+        for key in moved + added:
+            self.insert(key, points[key])
+
+    def export(self, keys):
+        """ returns (simplices, neighbors), with simplices indexing into the
+        points in the order of keys, and the dead simplices compacted away """
+        slot_to_idx = dict((self.slots[key], idx) for idx, key in enumerate(keys))
+
+        live = [simp_idx for simp_idx, simp in enumerate(self.simplices)
+                if simp is not None]
+        renumber = dict((simp_idx, idx) for idx, simp_idx in enumerate(live))
+
+        simplices = [[slot_to_idx[slot] for slot in self.simplices[simp_idx]]
+                for simp_idx in live]
+        neighbors = [[None if nb is None else renumber[nb]
+            for nb in self.neighbors[simp_idx]] for simp_idx in live]
+        return simplices, neighbors
+
+    def insert(self, key, point):
+        slot = self._add_point(key, point)
+        point = self.points[slot]
+        containing = self._locate(point)
+
+        # the cavity is every simplex whose circumsphere contains the new point,
+        # which is connected, and includes the simplex containing it.  flat
+        # simplices touching it are swallowed too
+        cavity = set([containing])
+        to_visit = [containing]
+        while to_visit:
+            simp_idx = to_visit.pop()
+            for nb in self.neighbors[simp_idx]:
+                if nb is None or nb in cavity:
+                    continue
+                if self._is_flat(nb) or self._in_circumsphere(nb, point):
+                    cavity.add(nb)
+                    to_visit.append(nb)
+
+        new_simplices = []
+        for simp_idx in cavity:
+            simp = self.simplices[simp_idx]
+            for vert_idx_idx, nb in enumerate(self.neighbors[simp_idx]):
+                if nb is None or nb not in cavity:
+                    facet = list(simp)
+                    facet.pop(vert_idx_idx)
+                    new_simplices.append(facet + [slot])
+
+        self._replace(cavity, new_simplices)
+
+    def remove(self, key):
+        slot = self.slots[key]
+        if self._on_hull(slot):
+            raise IncrementalUpdateError("point is on the hull")
+        ball = self._incident_simplices(slot)
+
+        # the delaunay tetrahedralization of the hole's boundary vertices
+        # contains a tetrahedralization of the hole itself, and we keep the
+        # simplices that fall inside of it.  around cospherical points though,
+        # the hole's boundary can split them up differently than the new
+        # simplices do, and then the hole grows across those facets, until the
+        # ties are all on the inside
+        hole = set(ball)
+        for _ in range(MAX_HOLE_GROWTH + 1):
+            new_simplices = self._fill_hole(hole, slot)
+            outside = self._boundary_facets(hole)
+            new_simplices.extend(self._flat_patches(outside, new_simplices))
+
+            owners = facet_owners(new_simplices)
+            mismatched = set(outside).symmetric_difference(facet
+                    for facet, own in owners.items() if len(own) == 1)
+            if not mismatched:
+                break
+
+            grow = set(outside[facet] for facet in mismatched
+                    if facet in outside)
+            if not grow or None in grow:
+                raise IncrementalUpdateError("the hole can't be filled")
+            hole.update(grow)
+        else:
+            raise IncrementalUpdateError("the hole can't be filled")
+
+        self._replace(hole, new_simplices)
+        del self.slots[key]
+        self.vertex_simplex.pop(slot, None)
+
+    def _fill_hole(self, hole, slot):
+        """ the simplices of the delaunay tetrahedralization of every vertex of
+        the hole but slot, that are inside of the hole """
+        link = set()
+        for simp_idx in hole:
+            link.update(self.simplices[simp_idx])
+        link.discard(slot)
+
+        link = sorted(link)
+        link_points = [self.points[vert] for vert in link]
+        try:
+            candidates = Delaunay(link_points).vertices
+        except Exception:
+            raise IncrementalUpdateError("couldn't triangulate the hole")
+
+        new_simplices = []
+        for candidate in candidates:
+            simp = [link[vert_idx] for vert_idx in candidate]
+            if all(any(self._contains(simp_idx, point) for simp_idx in hole)
+                    for point in self._inner_points(simp)):
+                new_simplices.append(simp)
+        return new_simplices
+
+    def _add_point(self, key, point):
+        slot = len(self.points)
+        self.slots[key] = slot
+        self.points.append(tuple(point))
+        return slot
+
+    def _replace(self, old, new_simplices):
+        """ swaps out the simplices in old for new_simplices, which must fill
+        exactly the same region, and stitches the neighbors back together """
+        if not new_simplices:
+            raise IncrementalUpdateError("nothing to fill the hole with")
+
+        old = sorted(old)
+        outside = self._boundary_facets(old)
+        owners = facet_owners(new_simplices)
+
+        boundary = set(facet for facet, own in owners.items() if len(own) == 1)
+        if boundary != set(outside) or any(len(own) > 2 for own in owners.values()):
+            raise IncrementalUpdateError("the new simplices don't fit the hole")
+
+        # a flat simplex can fit the boundary while repeating one just outside
+        # of it
+        around = set(frozenset(self.simplices[nb]) for nb in outside.values()
+                if nb is not None)
+        if any(frozenset(simp) in around for simp in new_simplices):
+            raise IncrementalUpdateError("the new simplices overlap the old")
+
+        # with the boundaries matching, the new simplices can only cover more
+        # than the old ones did by overlapping
+        old_volume = sum(abs(self._volume(self.simplices[simp_idx]))
+                for simp_idx in old)
+        new_volume = sum(abs(self._volume(simp)) for simp in new_simplices)
+        if abs(new_volume - old_volume) > 1e-7 * old_volume:
+            raise IncrementalUpdateError("the new simplices don't fill the hole")
+
+        # reuse the old simplices' indices first
+        indices = old[:len(new_simplices)]
+        while len(indices) < len(new_simplices):
+            indices.append(len(self.simplices))
+            self.simplices.append(None)
+            self.neighbors.append(None)
+
+        for simp_idx in old[len(new_simplices):]:
+            self.simplices[simp_idx] = None
+            self.neighbors[simp_idx] = None
+
+        for new_idx, simp in enumerate(new_simplices):
+            self.simplices[indices[new_idx]] = list(simp)
+
+        for new_idx, simp in enumerate(new_simplices):
+            simp_idx = indices[new_idx]
+            cur_neighbors = []
+
+            for vert_idx_idx in range(4):
+                facet = simplex_facet(simp, vert_idx_idx)
+                own = owners[facet]
+
+                if len(own) == 2:
+                    other = own[0] if own[1] == new_idx else own[1]
+                    cur_neighbors.append(indices[other])
+                    continue
+
+                nb = outside[facet]
+                cur_neighbors.append(nb)
+                if nb is not None:
+                    nb_simp = self.simplices[nb]
+                    for nb_vert_idx_idx in range(4):
+                        if simplex_facet(nb_simp, nb_vert_idx_idx) == facet:
+                            self.neighbors[nb][nb_vert_idx_idx] = simp_idx
+
+            self.neighbors[simp_idx] = cur_neighbors
+            for slot in simp:
+                self.vertex_simplex[slot] = simp_idx
+            self.last_simplex = simp_idx
+
+    def _boundary_facets(self, region):
+        """ the facets around the boundary of a region of simplices, and the
+        simplex on the other side of each (or None on the hull) """
+        region_set = set(region)
+        outside = {}
+        for simp_idx in region:
+            simp = self.simplices[simp_idx]
+            for vert_idx_idx, nb in enumerate(self.neighbors[simp_idx]):
+                if nb is None or nb not in region_set:
+                    outside[simplex_facet(simp, vert_idx_idx)] = nb
+        return outside
+
+    def _flat_patches(self, outside, new_simplices):
+        """ where the boundary facets in outside split four coplanar points
+        (like the square face of a grid cell) along one diagonal, and
+        new_simplices split them along the other, the flat simplex of the four
+        points joins the two up, the same way qhull's flat simplices do.
+        returns those flat simplices """
+        owners = facet_owners(new_simplices)
+        new_boundary = set(facet for facet, own in owners.items()
+                if len(own) == 1)
+        old_only = sorted(set(outside) - new_boundary)
+        new_only = new_boundary - set(outside)
+
+        patches = []
+        for idx, facet in enumerate(old_only):
+            for other in old_only[idx+1:]:
+                quad = set(facet) | set(other)
+                if len(quad) != 4:
+                    continue
+
+                # the triangles of the other diagonal
+                x, y = set(facet) ^ set(other)
+                flipped = [tuple(sorted((x, y, shared)))
+                        for shared in set(facet) & set(other)]
+                if not all(tri in new_only for tri in flipped):
+                    continue
+
+                # if the simplex on the other side is already the flat simplex
+                # of these points, the hole grows to take it in instead
+                nb = outside[facet]
+                if nb is not None and set(self.simplices[nb]) == quad:
+                    continue
+
+                a, b, c, d = (self.points[vert] for vert in quad)
+                if abs(orient(a, b, c, d)) <= self.flat_orient:
+                    patches.append(sorted(quad))
+
+        return patches
+
+    def _locate(self, point):
+        """ walks from simplex to simplex towards the point, returning the
+        simplex that contains it """
+        simp_idx = self.last_simplex
+        if simp_idx is None or self.simplices[simp_idx] is None:
+            simp_idx = next((simp_idx for simp_idx, simp
+                in enumerate(self.simplices) if simp is not None), None)
+            if simp_idx is None:
+                raise IncrementalUpdateError("no simplices to search")
+
+        for _ in range(len(self.simplices)):
+            if self._is_flat(simp_idx):
+                crossing = self._flat_crossing(simp_idx, point)
+            else:
+                crossing = self._crossing(simp_idx, point)
+
+            if crossing is None:
+                return simp_idx
+
+            simp_idx = self.neighbors[simp_idx][crossing]
+            if simp_idx is None:
+                raise IncrementalUpdateError("point is outside of the hull")
+
+        raise IncrementalUpdateError("couldn't locate point")
+
+    def _crossing(self, simp_idx, point):
+        """ the facet of a simplex that point is behind, or None if the simplex
+        contains it """
+        simp = [self.points[vert] for vert in self.simplices[simp_idx]]
+        for vert_idx_idx in range(4):
+            facet = simp[:vert_idx_idx] + simp[vert_idx_idx+1:]
+            inside = orient(facet[0], facet[1], facet[2], simp[vert_idx_idx])
+            side = orient(facet[0], facet[1], facet[2], point)
+            if inside * side < 0:
+                return vert_idx_idx
+        return None
+
+    def _flat_crossing(self, simp_idx, point):
+        """ a flat simplex never contains the point, so this picks the facet
+        whose neighbor lies on the same side of the simplex's plane as the
+        point, or any neighbor if the point is on the plane """
+        simp = self.simplices[simp_idx]
+        fallback = None
+
+        for vert_idx_idx, nb in enumerate(self.neighbors[simp_idx]):
+            if nb is None:
+                continue
+            facet = simp[:vert_idx_idx] + simp[vert_idx_idx+1:]
+            a, b, c = (self.points[vert] for vert in facet)
+            far = next(vert for vert in self.simplices[nb] if vert not in facet)
+            if orient(a, b, c, point) * orient(a, b, c, self.points[far]) > 0:
+                return vert_idx_idx
+            if fallback is None:
+                fallback = vert_idx_idx
+
+        if fallback is None:
+            raise IncrementalUpdateError("point is outside of the hull")
+        return fallback
+
+    def _incident_simplices(self, slot):
+        """ every simplex using a slot, found by walking around it from the
+        last simplex we know of that used it """
+        start = self.vertex_simplex.get(slot, None)
+        if start is None or self.simplices[start] is None \
+                or slot not in self.simplices[start]:
+            start = next((simp_idx for simp_idx, simp in enumerate(self.simplices)
+                if simp is not None and slot in simp), None)
+            if start is None:
+                raise IncrementalUpdateError("point isn't in any simplex")
+
+        ball = set([start])
+        to_visit = [start]
+        while to_visit:
+            simp_idx = to_visit.pop()
+            simp = self.simplices[simp_idx]
+            for vert_idx_idx, nb in enumerate(self.neighbors[simp_idx]):
+                # only cross facets that include our slot
+                if simp[vert_idx_idx] == slot or nb is None or nb in ball:
+                    continue
+                ball.add(nb)
+                to_visit.append(nb)
+        return ball
+
+    def _on_hull(self, slot):
+        """ whether a hull facet touches a slot, which removing it would
+        change """
+        for simp_idx in self._incident_simplices(slot):
+            simp = self.simplices[simp_idx]
+            for vert_idx_idx, nb in enumerate(self.neighbors[simp_idx]):
+                if nb is None and simp[vert_idx_idx] != slot:
+                    return True
+        return False
+
+    def _in_circumsphere(self, simp_idx, point):
+        a, b, c, d = (self.points[vert] for vert in self.simplices[simp_idx])
+        sphere = circumsphere(a, b, c, d)
+        if sphere is None:
+            raise IncrementalUpdateError("degenerate simplex")
+        center, radius2 = sphere
+        dist2 = sum((point[axis] - center[axis]) ** 2 for axis in range(3))
+        return dist2 < radius2 * (1 - 1e-12)
+
+    def _contains(self, simp_idx, point):
+        a, b, c, d = (self.points[vert] for vert in self.simplices[simp_idx])
+        volume = orient(a, b, c, d)
+        if abs(volume) <= self.flat_orient:
+            return False
+        eps = -1e-9 * volume ** 2
+        return (orient(point, b, c, d) * volume >= eps
+            and orient(a, point, c, d) * volume >= eps
+            and orient(a, b, point, d) * volume >= eps
+            and orient(a, b, c, point) * volume >= eps)
+
+    def _inner_points(self, simp):
+        """ points that are inside of a simplex, to test which region it is
+        in.  that's its centroid, unless it's flat, when its centroid is on
+        its plane, which can be on the boundary of the region.  then it's the
+        points just off either side of it, which both need to be inside """
+        points = [self.points[vert] for vert in simp]
+        centroid = tuple(sum(point[axis] for point in points) / 4.0
+                for axis in range(3))
+        a, b, c, d = points
+        if abs(orient(a, b, c, d)) > self.flat_orient:
+            return [centroid]
+
+        # the normal of its plane, from whichever pair of edges is widest
+        edges = [tuple(point[axis] - a[axis] for axis in range(3))
+                for point in (b, c, d)]
+        normal = max((cross(u, v) for u, v in itertools.combinations(edges, 2)),
+                key=lambda n: sum(v * v for v in n))
+        length = sum(v * v for v in normal) ** 0.5
+        if not length:
+            return [centroid]
+
+        offset = self.flat_offset / length
+        return [tuple(centroid[axis] + sign * offset * normal[axis]
+            for axis in range(3)) for sign in (-1, 1)]
+
+    def _is_flat(self, simp_idx):
+        a, b, c, d = (self.points[vert] for vert in self.simplices[simp_idx])
+        return abs(orient(a, b, c, d)) <= self.flat_orient
+
+    def _volume(self, simp):
+        a, b, c, d = (self.points[vert] for vert in simp)
+        return orient(a, b, c, d) / 6.0
+
+
+def orient(a, b, c, d):
+    """ six times the signed volume of the tetrahedron abcd """
+    bx, by, bz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    cx, cy, cz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    dx, dy, dz = d[0] - a[0], d[1] - a[1], d[2] - a[2]
+    return (bx * (cy * dz - cz * dy)
+            - by * (cx * dz - cz * dx)
+            + bz * (cx * dy - cy * dx))
+
+
+def cross(u, v):
+    return (u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2],
+            u[0] * v[1] - u[1] * v[0])
+
+
+def circumsphere(a, b, c, d):
+    """ returns the center and squared radius of the sphere through the four
+    points of a tetrahedron, or None if it is flat """
+    b = [b[axis] - a[axis] for axis in range(3)]
+    c = [c[axis] - a[axis] for axis in range(3)]
+    d = [d[axis] - a[axis] for axis in range(3)]
+
+    cd, db, bc = cross(c, d), cross(d, b), cross(b, c)
+    denom = 2.0 * sum(b[axis] * cd[axis] for axis in range(3))
+    if denom == 0:
+        return None
+
+    b2, c2, d2 = (sum(v[axis] ** 2 for axis in range(3)) for v in (b, c, d))
+    offset = [(b2 * cd[axis] + c2 * db[axis] + d2 * bc[axis]) / denom
+            for axis in range(3)]
+
+    center = tuple(a[axis] + offset[axis] for axis in range(3))
+    radius2 = sum(offset[axis] ** 2 for axis in range(3))
+    return center, radius2
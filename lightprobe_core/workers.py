@@ -0,0 +1,173 @@
+""" baking in parallel, across background blender processes.  nothing here knows
+about blender itself: the work is split into jobs, a command is launched for
+each job, and the results that the workers write back are merged together.  a
+job is a json file holding the task that every worker shares (what kind of work
+it is, and its settings), the items this worker is responsible for, and where
+to write the results:
+
+    {"kind": ..., "items": [item, ...], "results": path, ...}
+
+and the results are json too, rewritten after every item, so that the parent
+can follow the progress.  items are keyed by their string form:
+
+    {"results": {item: result}, "errors": {item: message}} """
+
+import os
+import json
+import time
+import subprocess
+
+from .formats import atomic_write
+
+
+# how often the parent checks on its workers, in seconds
+WORKER_POLL_INTERVAL = 0.25
+
+# how much of a failed worker's output to keep in its error message
+WORKER_LOG_TAIL = 2000
+
+
+def split_jobs(items, num_workers):
+    """ splits items into at most num_workers non-empty chunks.  they are dealt
+    out round-robin, since neighboring items (probes created one after another,
+    or consecutive frames) usually take about as long as each other """
+    chunks = [items[i::num_workers] for i in range(num_workers)]
+    return [chunk for chunk in chunks if chunk]
+
+
+def threads_per_worker(num_workers, num_cpus=None):
+    """ the render threads to give each worker, so that together they don't
+    oversubscribe the machine """
+    num_cpus = num_cpus or os.cpu_count() or 1
+    return max(1, num_cpus // num_workers)
+
+
+def blender_worker_command(binary, blend_path, script, job_path, threads=None):
+    """ the command line for a background blender running script on a job """
+    command = [binary, "-b", blend_path]
+    if threads:
+        command += ["-t", str(threads)]
+    command += ["--python", script, "--", job_path]
+    return command
+
+
+def write_job(filepath, job):
+    with atomic_write(filepath) as h:
+        json.dump(job, h)
+
+
+def read_job(filepath):
+    with open(filepath, "r") as h:
+        return json.load(h)
+
+
+def write_results(filepath, results):
+    with atomic_write(filepath) as h:
+        json.dump(results, h)
+
+
+def read_results(filepath):
+    """ returns the results a worker has written so far.  they are written
+    atomically, so they are either missing or complete """
+    results = {"results": {}, "errors": {}}
+    if os.path.exists(filepath):
+        with open(filepath, "r") as h:
+            results.update(json.load(h))
+    return results
+
+
+class WorkerPool(object):
+    """ a worker process for every job (a list of items), all running at once.
+    make_command(job_path) returns the command line of a worker, and task is
+    the part of the job shared by all of them.  poll doesn't block, so the pool
+    can be driven from a modal operator """
+
+    def __init__(self, jobs, work_dir, make_command, task=None):
+        self.workers = []
+
+        try:
+            for idx, items in enumerate(jobs):
+                job_path = os.path.join(work_dir, "job-%d.json" % idx)
+                results_path = os.path.join(work_dir, "results-%d.json" % idx)
+                log_path = os.path.join(work_dir, "worker-%d.log" % idx)
+
+                job = dict(task or {}, items=items, results=results_path)
+                write_job(job_path, job)
+
+                with open(log_path, "wb") as log:
+                    proc = subprocess.Popen(make_command(job_path), stdout=log,
+                            stderr=subprocess.STDOUT)
+                self.workers.append((proc, items, results_path, log_path))
+        except:
+            self.kill()
+            raise
+
+    def poll(self):
+        """ returns (number of items done, whether any worker is running) """
+        num_done = 0
+        running = False
+        for proc, _, results_path, _ in self.workers:
+            if proc.poll() is None:
+                running = True
+            results = read_results(results_path)
+            num_done += len(results["results"]) + len(results["errors"])
+        return num_done, running
+
+    def kill(self):
+        for proc, _, _, _ in self.workers:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+    def collect(self):
+        """ returns (results, errors), mappings of item to result and item to
+        error message.  every item ends up in one of them: the items a worker
+        never reported on, because it crashed or was killed, get the end of its
+        output as their error """
+        results = {}
+        errors = {}
+        for proc, items, results_path, log_path in self.workers:
+            worker_results = read_results(results_path)
+            results.update(worker_results["results"])
+            errors.update(worker_results["errors"])
+
+            missing = [str(item) for item in items
+                    if str(item) not in worker_results["results"]
+                    and str(item) not in worker_results["errors"]]
+            if missing:
+                message = "worker exited with code %s:\n%s" % (proc.returncode,
+                        read_log_tail(log_path))
+                for item in missing:
+                    errors[item] = message
+
+        return results, errors
+
+
+def run_workers(jobs, work_dir, make_command, progress_fn=None, task=None,
+        poll_interval=WORKER_POLL_INTERVAL):
+    """ runs a WorkerPool to completion, calling progress_fn(num_done) as the
+    workers report back, and returns its results and errors """
+    pool = WorkerPool(jobs, work_dir, make_command, task)
+
+    try:
+        last_done = None
+        while True:
+            num_done, running = pool.poll()
+            if progress_fn and num_done != last_done:
+                progress_fn(num_done)
+                last_done = num_done
+
+            if not running:
+                break
+            time.sleep(poll_interval)
+    finally:
+        pool.kill()
+
+    return pool.collect()
+
+
+def read_log_tail(log_path, size=WORKER_LOG_TAIL):
+    with open(log_path, "rb") as h:
+        h.seek(0, os.SEEK_END)
+        h.seek(max(0, h.tell() - size))
+        return h.read().decode("utf-8", "replace")
@@ -0,0 +1,12 @@
+""" the tests only need lightprobe_core, which runs without blender, so they
+import it as a top level package from the root of the add-on.  the add-on's own
+__init__ imports bpy, so pytest must not collect it as a package either, which
+the pytest.ini next to this file sees to by making this directory its rootdir:
+
+    python -m pytest tests
+    python -m unittest discover -s tests """
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
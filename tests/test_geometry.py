@@ -0,0 +1,80 @@
+""" tests of casting rays out from the center of a probe mesh, on the cube
+sphere that the benchmarks use:
+
+    python -m unittest discover -s tests """
+
+import unittest
+
+import numpy as np
+
+from lightprobe_core.geometry import (ProbeMeshIndex, shared_probe_mesh,
+        clear_probe_mesh_cache, PROBE_MESH_CACHE_SIZE)
+from lightprobe_core.benchmark import make_probe_mesh
+
+
+class ProbeMeshIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.verts, self.triangles, _ = make_probe_mesh()
+        self.index = ProbeMeshIndex(self.verts, self.triangles)
+
+    def check_hit(self, direction, tri_idx, location):
+        """ the hit is on the ray """
+        self.assertIsNotNone(tri_idx)
+        corners = np.asarray(self.verts)[self.triangles[tri_idx]]
+        # intersect's coordinates are of the 2nd, 3rd and 1st corners
+        point = np.dot(np.roll(location, 1), corners)
+        np.testing.assert_allclose(point / np.linalg.norm(point), direction,
+                atol=1e-6)
+
+    def test_seams(self):
+        # rays along the x = y plane run down the edges between two faces of
+        # the cube, and through the corners of the triangles along them.  the
+        # first used to miss both triangles, on a 64x128 theta/phi grid
+        directions = [[0.62361251, 0.62361251, 0.47139674]]
+        directions += [[1.0, 1.0, z] for z in np.linspace(-1, 1, 33)]
+        directions += self.verts
+
+        for direction in directions:
+            direction = np.asarray(direction) / np.linalg.norm(direction)
+            tri_idx, location = self.index.intersect(tuple(direction * 100))
+            self.check_hit(direction, tri_idx, location)
+
+    def test_hole(self):
+        # a ray through a hole in the mesh takes the triangle closest to it
+        # instead of failing
+        triangles = list(self.triangles)
+        hole = triangles.pop(100)
+        index = ProbeMeshIndex(self.verts, triangles)
+
+        direction = np.asarray(self.verts)[hole].mean(axis=0)
+        direction /= np.linalg.norm(direction)
+        tri_idx, location = index.cast(direction)
+        self.assertIsNotNone(tri_idx)
+        self.assertTrue(set(triangles[tri_idx]) & set(hole))
+        self.assertAlmostEqual(sum(location), 1.0)
+        self.assertTrue(min(location) >= 0)
+
+
+class SharedProbeMeshTest(unittest.TestCase):
+    def test_evicts_least_recent(self):
+        clear_probe_mesh_cache()
+        meshes = [make_probe_mesh(subdivisions) for subdivisions in
+                range(1, PROBE_MESH_CACHE_SIZE + 2)]
+
+        first = shared_probe_mesh(*meshes[0])
+        self.assertIs(shared_probe_mesh(*meshes[0]), first)
+
+        # using the first mesh again keeps it, and the second falls out
+        second = shared_probe_mesh(*meshes[1])
+        for mesh in meshes[2:-1]:
+            shared_probe_mesh(*mesh)
+        self.assertIs(shared_probe_mesh(*meshes[0]), first)
+        shared_probe_mesh(*meshes[-1])
+
+        self.assertIs(shared_probe_mesh(*meshes[0]), first)
+        self.assertIsNot(shared_probe_mesh(*meshes[1]), second)
+        clear_probe_mesh_cache()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+""" tests of adaptive SH projection, against a dense uniform grid of the same
+cells.  the radiance is a function of direction, so no probe mesh is needed:
+
+    python -m unittest discover -s tests """
+
+import unittest
+
+import numpy as np
+
+from lightprobe_core.quadrature import (project_sh_adaptive,
+        quadrature_shape, quadrature_directions, cell_contributions,
+        QUADRATURE_MAX_DEPTH)
+from lightprobe_core.cubemap import SOLID_ANGLE_SCALE
+
+
+def cube_faces(dirs):
+    """ radiance like a probe's lightmap: a ramp across each face of a cube
+    around the probe, with a hard edge where the faces meet """
+    axis = np.abs(dirs).argmax(axis=1)
+    face = 2 * axis + (dirs[np.arange(len(dirs)), axis] < 0)
+    ramp = dirs[:, 0] + 0.5 * dirs[:, 1] - 0.25 * dirs[:, 2]
+    return np.column_stack((1.0 + 0.3 * face + 0.5 * ramp, 0.5 + 0.2 * (face
+        % 3) - 0.3 * ramp, 2.0 - 0.2 * face + ramp))
+
+
+def smooth(dirs):
+    """ radiance with no edges, like a sky """
+    return np.column_stack((1.0 + dirs[:, 2], 1.0 + 0.5 * dirs[:, 0] * dirs[:, 1],
+        1.5 + np.sin(3 * dirs[:, 0])))
+
+
+def lamp(dirs):
+    """ a bright lamp on a dim sky, the detail of which is all in one place """
+    lamp_dir = np.array([0.3, 0.5, 0.81]) / np.linalg.norm([0.3, 0.5, 0.81])
+    lit = 5.0 * (dirs.dot(lamp_dir) > 0.95)
+    return np.column_stack((0.5 + 0.2 * dirs[:, 2] + lit, 0.4 + 0.0 * lit,
+        0.6 + 0.3 * dirs[:, 2]))
+
+
+def sampler(radiance_fn):
+    return lambda depth, indices: radiance_fn(quadrature_directions(depth,
+        indices))
+
+
+def dense_projection(radiance_fn, depth=QUADRATURE_MAX_DEPTH):
+    """ every cell at depth """
+    z_res, phi_res = quadrature_shape(depth)
+    z_idx, phi_idx = np.divmod(np.arange(z_res * phi_res), phi_res)
+    cells = np.column_stack((np.full(len(z_idx), depth), z_idx, phi_idx))
+    radiance = radiance_fn(quadrature_directions(depth, np.arange(len(cells))))
+    return cell_contributions(cells, radiance).sum(axis=0) * SOLID_ANGLE_SCALE
+
+
+class AdaptiveProjectionTest(unittest.TestCase):
+    def check_tolerances(self, radiance_fn):
+        """ whenever refinement says it converged, the coefficients are within
+        tolerance of the dense grid """
+        reference = dense_projection(radiance_fn)
+        scale = np.abs(reference[0]).max()
+
+        for tolerance in (0.05, 0.02, 0.01, 0.005, 0.002):
+            coeffs, num_samples, converged = project_sh_adaptive(
+                    sampler(radiance_fn), tolerance)
+            self.assertTrue(converged)
+            self.assertLess(np.abs(coeffs - reference).max() / scale,
+                    tolerance)
+
+    def test_hard_edges(self):
+        self.check_tolerances(cube_faces)
+
+    def test_smooth(self):
+        self.check_tolerances(smooth)
+
+    def test_fewer_samples_than_uniform(self):
+        # the uniform grid that's as accurate as refinement takes more samples
+        reference = dense_projection(lamp)
+        scale = np.abs(reference[0]).max()
+
+        coeffs, num_samples, converged = project_sh_adaptive(sampler(lamp),
+                0.02)
+        self.assertTrue(converged)
+        error = np.abs(coeffs - reference).max() / scale
+
+        for depth in range(QUADRATURE_MAX_DEPTH + 1):
+            uniform = dense_projection(lamp, depth)
+            if np.abs(uniform - reference).max() / scale <= error:
+                break
+        z_res, phi_res = quadrature_shape(depth)
+        self.assertGreater(z_res * phi_res, num_samples)
+
+    def test_max_samples(self):
+        # refinement that runs out of samples says so, instead of returning as
+        # though it converged
+        coeffs, num_samples, converged = project_sh_adaptive(
+                sampler(cube_faces), 1e-5, max_samples=4000)
+        self.assertFalse(converged)
+        self.assertLessEqual(num_samples, 4000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+""" tests of the probe volume lookups, on coefficients that are linear in
+position, which blending by barycentric weights gives back exactly:
+
+    python -m unittest discover -s tests """
+
+import unittest
+
+import numpy as np
+
+from lightprobe_core.tetra import Tetrahedralization
+from lightprobe_core.query import ProbeVolume, NO_NEIGHBOR
+
+
+LINEAR = np.array([[1.0, -2.0, 0.5], [0.3, 0.7, -1.1], [2.0, 0.1, 0.4]])
+
+
+def linear_coeffs(points):
+    """ (N x 4 x 3) coefficients that are linear in position """
+    colors = np.asarray(points).dot(LINEAR) + 1.0
+    return np.stack((colors, 2 * colors, -colors, colors + 3), axis=1)
+
+
+def make_volume(points):
+    points = np.asarray(points).tolist()
+    keys = ["probe%d" % idx for idx in range(len(points))]
+    simplices, neighbors = Tetrahedralization(keys, points).export(keys)
+    neighbors = [[NO_NEIGHBOR if nb is None else nb for nb in cur]
+            for cur in neighbors]
+    return ProbeVolume(points, linear_coeffs(points), simplices, neighbors)
+
+
+class ProbeVolumeTest(unittest.TestCase):
+    def check_linear(self, points, num_queries=1000, seed=0):
+        """ points inside the hull get the coefficients at the point, and
+        points outside of it those of the closest point on the hull.  the hull
+        of the points is their bounding box """
+        volume = make_volume(points)
+        lo, hi = np.min(points, axis=0), np.max(points, axis=0)
+        rand = np.random.RandomState(seed)
+        inside = rand.uniform(lo, hi, (num_queries, 3))
+        outside = rand.uniform(lo - 2, hi + 2, (num_queries, 3))
+
+        for queries in (inside, outside):
+            expected = linear_coeffs(np.clip(queries, lo, hi))
+            np.testing.assert_allclose(volume.query_many(queries), expected,
+                    atol=1e-9)
+            volume.last_simplex = 0
+            np.testing.assert_allclose([volume.query(point)
+                for point in queries], expected, atol=1e-9)
+
+        probes, weights = volume._search(inside)
+        np.testing.assert_allclose(np.einsum("mk,mkcr->mcr", weights,
+            volume.coeffs[probes]), linear_coeffs(inside), atol=1e-9)
+
+    def check_interior(self, points, num_queries=500, seed=0):
+        """ like check_linear, for hulls that aren't boxes: points inside of
+        the hull, made of random blends of a few probes and of pairs of probes,
+        which puts some of them on the planes and edges of a grid """
+        volume = make_volume(points)
+        rand = np.random.RandomState(seed)
+        probes = rand.randint(len(points), size=(num_queries, 4))
+        blends = np.einsum("mk,mki->mi", rand.dirichlet(np.ones(4),
+            num_queries), points[probes])
+        probes = rand.randint(len(points), size=(num_queries, 2))
+        t = rand.uniform(size=(num_queries, 1))
+        pairs = t * points[probes[:, 0]] + (1 - t) * points[probes[:, 1]]
+
+        # points on a plane of float32 probes are only on it up to rounding
+        for queries in (blends, pairs):
+            expected = linear_coeffs(queries)
+            np.testing.assert_allclose(volume.query_many(queries), expected,
+                    atol=1e-5)
+            volume.last_simplex = 0
+            np.testing.assert_allclose([volume.query(point)
+                for point in queries], expected, atol=1e-5)
+
+    def rotated_grid(self, shape, spacing, angle=0.37):
+        """ a float32 grid of probes, rotated about z """
+        points = np.stack(np.meshgrid(*[np.arange(n) * spacing
+            for n in shape], indexing="ij"), axis=-1).reshape(-1, 3)
+        c, s = np.cos(angle), np.sin(angle)
+        rotation = np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+        return points.dot(rotation.T).astype(np.float32).astype(float)
+
+    def test_rotated_grids(self):
+        # the probes of each grid plane are only coplanar up to rounding, which
+        # is larger than the flatness of some of its flat simplices
+        self.check_interior(self.rotated_grid((3, 5, 4), 0.33))
+        self.check_interior(self.rotated_grid((5, 5, 2), 2.1))
+
+    def test_jittered_grid(self):
+        points = self.rotated_grid((4, 4, 3), 1.0)
+        rand = np.random.RandomState(2)
+        self.check_interior(points + rand.uniform(-1e-7, 1e-7, points.shape))
+
+    def test_rotated_grid_outside(self):
+        # points outside of the hull take the closest point on it
+        points = self.rotated_grid((3, 5, 4), 0.33)
+        volume = make_volume(points)
+        rand = np.random.RandomState(3)
+        queries = rand.uniform(points.min(axis=0) - 1, points.max(axis=0) + 1,
+                (500, 3))
+        queries = queries[[volume._outside_hull(point) for point in queries]]
+        probes, weights = volume._clamp_to_hull(queries)
+        np.testing.assert_allclose(volume.query_many(queries), np.einsum(
+            "mk,mkcr->mcr", weights, volume.coeffs[probes]), atol=1e-9)
+
+    def test_grid(self):
+        # delaunay tetrahedralizations of grids have flat simplices
+        points = np.stack(np.meshgrid(*[np.arange(5.0)] * 3, indexing="ij"),
+                axis=-1).reshape(-1, 3)
+        self.assertTrue(len(make_volume(points).flat.simplices))
+        self.check_linear(points)
+
+    def test_float32_grid(self):
+        # like the binary format's probe locations
+        points = np.stack(np.meshgrid(np.arange(5) * 0.1, np.arange(5) * 0.3,
+            np.arange(5) * 0.7, indexing="ij"), axis=-1).reshape(-1, 3)
+        self.check_linear(points.astype(np.float32).astype(float))
+
+    def test_random_cloud(self):
+        rand = np.random.RandomState(1)
+        points = rand.uniform(-10, 10, (200, 3))
+        points = np.concatenate((points, [[x, y, z] for x in (-10, 10)
+            for y in (-10, 10) for z in (-10, 10)]))
+        self.check_linear(points)
+
+
+if __name__ == "__main__":
+    unittest.main()
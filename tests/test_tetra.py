@@ -0,0 +1,133 @@
+""" tests of the tetrahedralization and neighbor structure.  these only need
+lightprobe_core, which runs without blender, so they import it as a top level
+package (importing the add-on itself needs bpy):
+
+    python -m unittest discover -s tests """
+
+import random
+import itertools
+import unittest
+
+from pyhull.delaunay import DelaunayTri as Delaunay
+
+from lightprobe_core.tetra import (build_neighbors, orient,
+        Tetrahedralization, IncrementalUpdateError)
+
+
+def linear_search_neighbors(simplices):
+    """ the neighbor search that build_neighbors replaced, which compares every
+    facet against every other simplex """
+    neighbors = []
+    for simp_idx, simp in enumerate(simplices):
+        cur_neighbors = []
+        neighbors.append(cur_neighbors)
+
+        for vert_idx_idx, vert_idx in enumerate(simp):
+            to_match = list(simp)
+            to_match.pop(vert_idx_idx)
+            to_match = set(to_match)
+
+            neighbor = None
+            for search_simp_idx, search_simp in enumerate(simplices):
+                if simp_idx == search_simp_idx:
+                    continue
+                if to_match < set(search_simp):
+                    neighbor = search_simp_idx
+                    break
+
+            cur_neighbors.append(neighbor)
+
+    return neighbors
+
+
+def random_cloud(num_points, seed=0):
+    rand = random.Random(seed)
+    return [[rand.uniform(-10, 10) for _ in range(3)]
+            for _ in range(num_points)]
+
+
+def grid(size):
+    return [[float(v) for v in point]
+            for point in itertools.product(range(size), repeat=3)]
+
+
+class BuildNeighborsTest(unittest.TestCase):
+    def check_matches_linear_search(self, points):
+        simplices = Delaunay(points).vertices
+        self.assertTrue(len(simplices))
+        self.assertEqual(build_neighbors(simplices),
+                linear_search_neighbors(simplices))
+
+    def test_random_cloud(self):
+        self.check_matches_linear_search(random_cloud(200))
+
+    def test_grid(self):
+        self.check_matches_linear_search(grid(4))
+
+
+def total_volume(points, simplices):
+    return sum(abs(orient(*[points[vert] for vert in simp]))
+            for simp in simplices) / 6.0
+
+
+class TetrahedralizationTest(unittest.TestCase):
+    def check_valid(self, points, simplices, neighbors):
+        """ the simplices tile the hull of the points, and the neighbors are
+        what build_neighbors makes of them """
+        expected = total_volume(points, Delaunay(points).vertices)
+        self.assertAlmostEqual(total_volume(points, simplices), expected)
+        self.assertEqual(neighbors, build_neighbors(simplices))
+        self.assertEqual(set(vert for simp in simplices for vert in simp),
+                set(range(len(points))))
+
+    def test_rebuild_is_qhull(self):
+        points = grid(4)
+        keys = [str(idx) for idx in range(len(points))]
+        simplices, _ = Tetrahedralization(keys, points).export(keys)
+        self.assertEqual(simplices,
+                [list(simp) for simp in Delaunay(points).vertices])
+
+    def test_grid_updates(self):
+        rand = random.Random(1)
+        points = dict((str(idx), point) for idx, point in enumerate(grid(6)))
+        tetra = Tetrahedralization(list(points), list(points.values()))
+
+        def inner():
+            return [key for key, point in sorted(points.items())
+                    if all(0.5 < v < 3.5 for v in point)]
+
+        for step in range(15):
+            key = rand.choice(inner())
+            if step % 3 == 0:
+                points[key] = [v + rand.uniform(-0.4, 0.4)
+                        for v in points[key]]
+            elif step % 3 == 1:
+                points["new-%d" % step] = [v + rand.uniform(-0.5, 0.5)
+                        for v in points[key]]
+            else:
+                del points[key]
+
+            tetra.update(list(points), list(points.values()))
+            simplices, neighbors = tetra.export(list(points))
+            self.check_valid(list(points.values()), simplices, neighbors)
+
+    def test_hull_moves(self):
+        # moving a corner of the grid, or an inner point out past the hull,
+        # needs a rebuild, which the update says before it changes anything
+        points = grid(4)
+        keys = [str(idx) for idx in range(len(points))]
+        tetra = Tetrahedralization(keys, points)
+        before = tetra.export(keys)
+
+        corner = points.index([0, 0, 0])
+        inner = points.index([1, 1, 1])
+        for idx, point in ((corner, [-0.5, 0.2, 0.1]), (inner, [1, 1, -2])):
+            moved = list(points)
+            moved[idx] = point
+            with self.assertRaises(IncrementalUpdateError):
+                tetra.update(keys, moved)
+            self.assertEqual(tetra.export(keys), before)
+
+
+if __name__ == "__main__":
+    unittest.main()